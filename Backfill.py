@@ -0,0 +1,52 @@
+import logging
+import sys
+import multiprocessing
+from DuplicateClusterAssignment import DuplicateClusterAssignment
+from viglink_image_match.fetcher import ImageFetcher
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def backfill(url_file, es_endpoint, memcache_endpoint, fetch_workers=64, sign_workers=None, cluster_workers=None,
+             chunk_size=10000):
+    '''
+    Cluster and index every image url listed in a file, one url per line, with a single bulk pass.
+    :param url_file: path of the file of image urls.
+    :param es_endpoint: Elasticsearch host.
+    :param memcache_endpoint: memcached host.
+    :param fetch_workers: number of concurrent downloads.
+    :param sign_workers: number of processes to compute signatures on (default: one per cpu).
+    :param cluster_workers: number of threads to compare signatures on (default: one per cpu).
+    :param chunk_size: number of images to download and sign at a time.
+    '''
+
+    with open(url_file) as f:
+        image_urls = [line.strip() for line in f if line.strip()]
+
+    logger.info("Backfilling %d images from %s" % (len(image_urls), url_file))
+
+    dca = DuplicateClusterAssignment(elasticsearch_endpoint=es_endpoint, es_index='images_0.1', distance_threshold=0.1,
+                                     memcached_endpoint=memcache_endpoint,
+                                     fetcher=ImageFetcher(workers=fetch_workers))
+
+    cluster_ids = dca.backfill(image_urls,
+                               sign_workers=sign_workers or multiprocessing.cpu_count(),
+                               cluster_workers=cluster_workers or multiprocessing.cpu_count(),
+                               chunk_size=chunk_size,
+                               memcached_persist=True)
+    dca.close()
+
+    logger.info("Indexed %d of %d images" % (len([c for c in cluster_ids if c is not None]), len(image_urls)))
+
+
+def main():
+    url_file = sys.argv[1]
+    es_endpoint = sys.argv[2]
+    memcache_endpoint = sys.argv[3]
+
+    backfill(url_file, es_endpoint, memcache_endpoint)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+import logging
+import hashlib
+import time
+from collections import OrderedDict
+from threading import Lock, Thread, Event
+from pymemcache.client.base import PooledClient
+from pymemcache.client.hash import HashClient
+
+logger = logging.getLogger(__name__)
+
+
+def memcached_client(endpoints, port=11211, pool_size=8):
+    '''
+    Thread safe memcached client for one or more memcached nodes.
+    :param endpoints: memcached host, or list of hosts. Keys are spread over several hosts by consistent hashing.
+    :param port: memcached port.
+    :param pool_size: maximum number of connections per host.
+    :return: a pymemcache PooledClient for a single host, or a pooling HashClient for several.
+    '''
+
+    if not isinstance(endpoints, (list, tuple)):
+        endpoints = [endpoints]
+
+    servers = [(endpoint, port) for endpoint in endpoints]
+    if len(servers) == 1:
+        return PooledClient(servers[0], max_pool_size=pool_size)
+    return HashClient(servers, use_pooling=True, max_pool_size=pool_size)
+
+
+def threshold_field(threshold):
+    '''
+    Name of the field holding the cluster id at a distance threshold, under 'clusterids' in document metadata.
+    Elasticsearch expands dots in field names into nested objects, so they are replaced by underscores.
+    :param threshold: distance threshold.
+    :return: the field name, e.g. 't0_1' for 0.1.
+    '''
+
+    return 't%s' % str(threshold).replace('.', '_')
+
+
+class ClusterIdStore:
+    def __init__(self, client, ses=None, distance_thresholds=None, batch_size=500, flush_interval=1.,
+                 cache_size=100000, cache_ttl=300.):
+        '''
+        Cluster ids by image url, with batched writes to memcached and a read-through lookup.
+
+        Writes are buffered and sent with one set_many per batch_size entries, and at least every flush_interval
+        seconds. Lookups go through three tiers: a local LRU cache whose entries expire after cache_ttl seconds,
+        then memcached, then the Elasticsearch documents of the images. Values found in a lower tier are cached in
+        the tiers above.
+
+        The primary cluster id of an image is stored under the md5 of its url, and with several distance thresholds
+        the others under the md5 followed by '_' and the threshold.
+
+        :param client: memcached client, e.g. from memcached_client. Anything with get_many and set_many works, such
+            as pymemcache.test.utils.MockMemcacheClient for testing.
+        :param ses: optional SignatureES with path_ids, to look up cluster ids that are not in memcached.
+        :param distance_thresholds: list of distance thresholds, the first being the primary one (default: one
+            threshold).
+        :param batch_size: maximum number of entries per set_many.
+        :param flush_interval: flush buffered writes at least this often, in seconds.
+        :param cache_size: maximum number of entries in the local cache.
+        :param cache_ttl: how long to keep entries in the local cache, in seconds.
+        '''
+
+        self.client = client
+        self.ses = ses
+        self.distance_thresholds = distance_thresholds or [None]
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+
+        # memcached key -> (expiry time, value), least recently used first
+        self._cache = OrderedDict()
+        self._cache_lock = Lock()
+
+        # writes waiting for the next set_many
+        self._buffer = {}
+        self._buffer_lock = Lock()
+        self._flush_lock = Lock()
+        self._flusher = None
+        self._closed = Event()
+
+    def key(self, image_url, threshold=None):
+        '''
+        Memcached key of a cluster id.
+        :param image_url: url of image.
+        :param threshold: distance threshold, or None for the primary one.
+        :return: the key.
+        '''
+
+        key = hashlib.md5(image_url).hexdigest()
+        if threshold is None or threshold == self.distance_thresholds[0]:
+            return key
+        return '%s_%s' % (key, threshold)
+
+    def items(self, image_url, cluster_ids):
+        '''
+        Memcached entries for the cluster ids of an image.
+        :param image_url: url of image.
+        :param cluster_ids: cluster id, or dict of cluster ids by distance threshold.
+        :return: dict of memcached values by key.
+        '''
+
+        if not isinstance(cluster_ids, dict):
+            return {self.key(image_url): str(cluster_ids)}
+        return dict((self.key(image_url, threshold), str(cluster_ids[threshold]))
+                    for threshold in self.distance_thresholds)
+
+    def set(self, image_url, cluster_ids):
+        '''
+        Queue the cluster ids of an image for writing to memcached.
+        :param image_url: url of image.
+        :param cluster_ids: cluster id, or dict of cluster ids by distance threshold.
+        '''
+
+        self.set_many({image_url: cluster_ids})
+
+    def set_many(self, cluster_ids_by_url):
+        '''
+        Queue the cluster ids of many images for writing to memcached.
+        :param cluster_ids_by_url: dict of cluster ids (or dicts of cluster ids by distance threshold) by image url.
+        '''
+
+        items = {}
+        for image_url, cluster_ids in cluster_ids_by_url.items():
+            items.update(self.items(image_url, cluster_ids))
+
+        self._queue(items)
+
+    def _queue(self, items):
+        # cache entries locally and buffer them for the next set_many
+        for key, value in items.items():
+            self._remember(key, value)
+
+        with self._buffer_lock:
+            self._buffer.update(items)
+            full = len(self._buffer) >= self.batch_size
+
+            if self._flusher is None:
+                self._flusher = Thread(target=self._flush_periodically)
+                self._flusher.daemon = True
+                self._flusher.start()
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write all buffered cluster ids to memcached.
+        '''
+
+        with self._flush_lock:
+            with self._buffer_lock:
+                buffered = self._buffer
+                self._buffer = {}
+
+            keys = list(buffered.keys())
+            for start in range(0, len(keys), self.batch_size):
+                batch = dict((key, buffered[key]) for key in keys[start:start + self.batch_size])
+                try:
+                    # recent pymemcache versions return the keys that failed, older ones True
+                    failed = self.client.set_many(batch)
+                    if isinstance(failed, list) and failed:
+                        logger.error("Failed to write %d cluster ids to memcached" % len(failed))
+                except Exception:
+                    logger.error("Failed to write %d cluster ids to memcached" % len(batch), exc_info=True)
+
+    def close(self):
+        '''
+        Write buffered cluster ids and stop the periodic flush.
+        '''
+
+        self._closed.set()
+        self.flush()
+
+    def get_cluster_ids(self, image_urls, threshold=None):
+        '''
+        Look up the cluster ids of many images, in the local cache, then memcached, then Elasticsearch.
+        :param image_urls: list of image urls.
+        :param threshold: distance threshold, or None for the primary one.
+        :return: list of cluster ids, in the order of image_urls, with None for images that were not found.
+        '''
+
+        keys = [self.key(image_url, threshold) for image_url in image_urls]
+        found = dict((key, self._recall(key)) for key in set(keys))
+
+        missing = [key for key, value in found.items() if value is None]
+        if missing:
+            try:
+                for key, value in self.client.get_many(missing).items():
+                    if value is not None:
+                        found[key] = value.decode('utf-8') if isinstance(value, bytes) else value
+                        self._remember(key, found[key])
+            except Exception:
+                logger.error("Failed to read %d cluster ids from memcached" % len(missing), exc_info=True)
+
+        missing_urls = list(OrderedDict.fromkeys(image_url for image_url, key in zip(image_urls, keys)
+                                                 if found[key] is None))
+        if missing_urls and self.ses is not None:
+            recovered = {}
+            for image_url, metadata in zip(missing_urls, self.ses.paths_metadata(missing_urls)):
+                cluster_id = self.metadata_cluster_id(metadata, threshold)
+                if cluster_id is not None:
+                    found[self.key(image_url, threshold)] = cluster_id
+                    recovered[self.key(image_url, threshold)] = cluster_id
+
+            # write back, so the next lookup stops at memcached
+            if recovered:
+                self._queue(recovered)
+
+        return [found[key] for key in keys]
+
+    def metadata_cluster_id(self, metadata, threshold=None):
+        '''
+        Cluster id at a distance threshold in the metadata of an Elasticsearch document. Documents indexed with a
+        single threshold only have 'clusterid', which is the cluster id at the primary threshold.
+        :param metadata: document metadata, or None.
+        :param threshold: distance threshold, or None for the primary one.
+        :return: the cluster id, or None if the document has none at threshold.
+        '''
+
+        if not metadata:
+            return None
+        if threshold is None or threshold == self.distance_thresholds[0]:
+            return metadata.get('clusterid')
+        return (metadata.get('clusterids') or {}).get(threshold_field(threshold))
+
+    def _remember(self, key, value):
+        with self._cache_lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (time.time() + self.cache_ttl, value)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _recall(self, key):
+        with self._cache_lock:
+            entry = self._cache.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                return None
+
+            # most recently used last
+            self._cache[key] = entry
+            return entry[1]
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.error("Periodic memcached flush failure", exc_info=True)
@@ -0,0 +1,196 @@
+from collections import deque
+import logging
+from threading import Lock, Thread
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from viglink_image_match.recent_records import RecentRecords
+from viglink_image_match.signature_database_base import normalized_distances
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# tells a stage worker to exit
+_STOP = object()
+
+# number of latest assignments to check searches against, see _search
+_MAX_ASSIGNED = 1024
+
+
+class ClusteringPipeline:
+    def __init__(self, dca, fetch_workers=16, sign_workers=2, search_workers=8, index_workers=4, queue_size=32,
+                 memcached_persist=False, on_done=None):
+        '''
+        Staged version of DuplicateClusterAssignment.insert_and_cluster for a single worker process.
+
+        Each image goes through four stages, each with its own pool of threads and a bounded queue in front:
+            1.  fetch:  skip the image if it is already indexed, otherwise download it (if dca has a fetcher).
+            2.  sign:   compute its signature record.
+            3.  search: find its near-duplicates and assign a cluster id.
+            4.  index:  index image and cluster id, and optionally write the cluster id to memcached.
+
+        Network waits in one stage overlap with signature work in another. When a queue is full, the stage
+        feeding it blocks, and ultimately so does submit, which applies backpressure to the message consumer.
+
+        Searches run concurrently, but an image only becomes searchable once it is indexed, so two near-duplicates
+        in flight at the same time could miss each other and start two clusters. Each image is therefore claimed
+        in the in-memory overlay of recent records (see DuplicateClusterAssignment.claim_cluster_ids) as soon as
+        its cluster ids are assigned, and its search is repeated if a near-duplicate was assigned while it was
+        searching. A claim stays in the overlay for its ttl even if indexing fails.
+
+        :param dca: DuplicateClusterAssignment instance.
+        :param fetch_workers: number of concurrent downloads.
+        :param sign_workers: number of concurrent signature computations.
+        :param search_workers: number of concurrent Elasticsearch searches.
+        :param index_workers: number of concurrent Elasticsearch index requests.
+        :param queue_size: maximum number of images waiting in front of each stage.
+        :param memcached_persist: boolean whether to write cluster ids to memcached.
+        :param on_done: optional callback on_done(image_url, context) called once an image has left the
+            pipeline, whether or not it succeeded. context is whatever was passed to submit.
+        '''
+
+        self.dca = dca
+        self.memcached_persist = memcached_persist
+        self.on_done = on_done
+
+        if dca.ses.recent_records is None:
+            dca.ses.recent_records = RecentRecords(N=dca.ses.N)
+
+        # signatures of the latest assignments, and the number of assignments so far
+        self._assign_lock = Lock()
+        self._assigned = deque(maxlen=_MAX_ASSIGNED)
+        self._n_assigned = 0
+
+        stages = [(self._fetch, fetch_workers),
+                  (self._sign, sign_workers),
+                  (self._search, search_workers),
+                  (self._index, index_workers)]
+
+        self.queues = [Queue(maxsize=queue_size) for _ in stages]
+        self.workers_per_stage = [n_workers for _, n_workers in stages]
+        self.threads = []
+
+        for i, (handler, n_workers) in enumerate(stages):
+            next_queue = self.queues[i + 1] if i + 1 < len(stages) else None
+            for _ in range(n_workers):
+                t = Thread(target=self._run_stage, args=(handler, self.queues[i], next_queue))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def submit(self, image_url, context=None):
+        '''
+        Add an image to the pipeline. Blocks while the pipeline is full.
+        :param image_url: Image url to be clustered and indexed.
+        :param context: anything to pass back to on_done, e.g. the message the url came from.
+        '''
+
+        self.queues[0].put({'url': image_url, 'context': context})
+
+    def join(self):
+        '''
+        Wait until every submitted image has left the pipeline.
+        '''
+
+        # items only move forward, so once a stage is drained its output is already queued for the next
+        for q in self.queues:
+            q.join()
+
+    def stop(self):
+        '''
+        Drain the pipeline, stop all worker threads, write buffered documents and cluster ids, and stop the periodic
+        flushes.
+        '''
+
+        self.join()
+        for q, n_workers in zip(self.queues, self.workers_per_stage):
+            for _ in range(n_workers):
+                q.put(_STOP)
+        for t in self.threads:
+            t.join()
+        self.dca.close()
+
+    def _run_stage(self, handler, in_queue, out_queue):
+        while True:
+            item = in_queue.get()
+            if item is _STOP:
+                in_queue.task_done()
+                return
+
+            try:
+                forward = handler(item)
+            except Exception:
+                logger.error("Indexing pipeline failure for image: %s" % item['url'], exc_info=True)
+                forward = False
+
+            try:
+                if forward and out_queue is not None:
+                    out_queue.put(item)
+                else:
+                    self._done(item)
+            finally:
+                in_queue.task_done()
+
+    def _done(self, item):
+        if self.on_done is not None:
+            try:
+                self.on_done(item['url'], item['context'])
+            except Exception:
+                logger.error("on_done callback failure for image: %s" % item['url'], exc_info=True)
+
+    def _fetch(self, item):
+        # skip images that are already indexed, before downloading them
+        if self.dca.is_indexed(item['url']):
+            logger.info("This image is already stored in elasticsearch: %s" % item['url'])
+            return False
+        if self.dca.fetcher is not None:
+            # images with a cached signature are neither downloaded nor signed again
+            item['record'] = self.dca.cached_image_record(item['url'])
+            if item['record'] is None:
+                item['bytes'] = self.dca.fetcher.fetch(item['url'])
+        return True
+
+    def _sign(self, item):
+        if item.get('record') is None:
+            item['record'] = self.dca.make_image_record(item['url'], image_bytes=item.pop('bytes', None))
+        return True
+
+    def _search(self, item):
+        while True:
+            with self._assign_lock:
+                start = self._n_assigned
+            item['cluster_ids'], item['representative_hits'] = self.dca.assign_cluster_ids(item['url'],
+                                                                                           item['record'])
+            if item['cluster_ids'] is None:
+                return False
+
+            with self._assign_lock:
+                if not self._assigned_near(item['record'], start):
+                    self.dca.claim_cluster_ids(item['url'], item['record'], item['cluster_ids'])
+                    self._assigned.append(item['record']['signature'])
+                    self._n_assigned += 1
+                    return True
+            logger.info("Searching again for image: %s, a near-duplicate was assigned meanwhile" % item['url'])
+
+    def _assigned_near(self, rec, start):
+        # whether an image assigned since the start-th assignment is a near-duplicate of rec; call with
+        # _assign_lock held. Those the search may have missed are claimed now, so a repeated search finds them.
+        n_new = self._n_assigned - start
+        if n_new == 0:
+            return False
+        if n_new > len(self._assigned):
+            return True
+        signatures = np.array(list(self._assigned)[-n_new:], dtype='int8')
+        dists = normalized_distances(np.array([rec['signature']], dtype='int8'), signatures)
+        return bool(np.any(dists < self.dca.ses.distance_cutoff))
+
+    def _index(self, item):
+        self.dca.index_image_with_clusterid(item['url'], image_clusterid=item['cluster_ids'],
+                                            image_record=item['record'],
+                                            representative_hits=item['representative_hits'])
+
+        if self.memcached_persist:
+            self.dca.memcached_insert_cluster_ids(item['url'], item['cluster_ids'])
+        return False
@@ -1,39 +1,188 @@
 import uuid
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import logging
 import hashlib
 
-from viglink_image_match.elasticsearch_driver import SignatureES
+from viglink_image_match.elasticsearch_driver import SignatureES, path_id
+from viglink_image_match.signature_database_base import make_record, make_records, make_record_from_signature
+from viglink_image_match.signature_database_base import record_words, normalized_distances
+from viglink_image_match.clustering import cluster_signatures
+from viglink_image_match.goldberg import CorruptImageError
+from viglink_image_match.fetcher import FetchError
+from viglink_image_match.recent_records import RecentRecords
+from viglink_image_match.representatives import ClusterRepresentatives
+from ClusterIdStore import ClusterIdStore, memcached_client, threshold_field
 from elasticsearch import Elasticsearch
-from pymemcache.client.base import Client
+import numpy as np
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
 class DuplicateClusterAssignment:
-    def __init__(self, elasticsearch_endpoint, es_index, distance_threshold, memcached_endpoint):
+    def __init__(self, elasticsearch_endpoint, es_index, distance_threshold, memcached_endpoint, fetcher=None,
+                 word_layout='fields', recent_ttl=30., max_representatives=0):
+        '''
+        :param elasticsearch_endpoint: Elasticsearch host.
+        :param es_index: name of the Elasticsearch index.
+        :param distance_threshold: maximum distance between near-duplicates, or a list of them. With a list, every
+            image is searched for once at the loosest threshold and gets one cluster id per threshold, all stored in
+            the same document. The first threshold is the primary one, whose cluster id is stored as 'clusterid'
+            and under the plain memcached key.
+        :param memcached_endpoint: memcached host, or list of hosts to spread cluster ids over.
+        :param fetcher: optional ImageFetcher to download images with.
+        :param word_layout: word layout of the index, 'fields' or 'tokens'.
+        :param recent_ttl: how long to search recently indexed images in memory, in seconds, or None not to.
+        :param max_representatives: if positive, keep up to this many representative images per cluster in a
+            secondary index, '<es_index>_representatives', and assign clusters by searching those first (see
+            ClusterRepresentatives). Only supported with a single distance threshold.
+        '''
+
+        if isinstance(distance_threshold, (list, tuple)):
+            self.distance_thresholds = list(distance_threshold)
+        else:
+            self.distance_thresholds = [distance_threshold]
+
         self.es_client = Elasticsearch(hosts=[{'host': elasticsearch_endpoint, 'port': 9200}])
 
-        # if images index does not exist, create it
-        indeces = self.es_client.indices.get('*').keys()
+        # documents are keyed by a hash of the image url, so indexing is idempotent. Images indexed in the last
+        # recent_ttl seconds are also searched in memory, so that a burst of near-duplicates is clustered together
+        # before Elasticsearch refreshes the index.
+        self.ses = SignatureES(self.es_client, index=es_index, distance_cutoff=max(self.distance_thresholds),
+                               word_layout=word_layout, path_ids=True)
+        if recent_ttl:
+            self.ses.recent_records = RecentRecords(N=self.ses.N, ttl=recent_ttl)
+
+        # if the index does not exist, create it with the signature mapping; otherwise check its mapping
+        self.ses.create_index()
+        self.memcached_client = memcached_client(memcached_endpoint)
+
+        # batched cluster id writes, and read-through cluster id lookups
+        self.cluster_id_store = ClusterIdStore(self.memcached_client, ses=self.ses,
+                                               distance_thresholds=self.distance_thresholds)
+
+        # optional pooled downloader; if None, images are downloaded by the signature pipeline itself
+        self.fetcher = fetcher
+
+        self.representatives = None
+        if max_representatives:
+            if len(self.distance_thresholds) > 1:
+                raise ValueError('Cluster representatives only support a single distance threshold')
+
+            # representatives are searched within threshold + spread, with the default spread of threshold / 2
+            threshold = self.distance_thresholds[0]
+            representative_ses = SignatureES(self.es_client, index=es_index + '_representatives',
+                                             distance_cutoff=1.5 * threshold, word_layout=word_layout, path_ids=True)
+            if recent_ttl:
+                representative_ses.recent_records = RecentRecords(N=representative_ses.N, ttl=recent_ttl)
+            representative_ses.create_index()
+            self.representatives = ClusterRepresentatives(representative_ses, threshold,
+                                                          max_representatives=max_representatives)
+
+    def make_image_record(self, image_url, image_bytes=None):
+        '''
+        Download an image and compute its signature record, once for both search and indexing. Images in the
+        signature cache are not downloaded.
+        :param image_url: url of image.
+        :param image_bytes: raw image data, if already downloaded.
+        :return: image record as returned by make_record.
+        '''
+
+        if image_bytes is None and self.fetcher is not None:
+            # a cached signature saves the download too
+            image_record = self.cached_image_record(image_url)
+            if image_record is not None:
+                return image_record
+            image_bytes = self.fetcher.fetch(image_url)
+
+        if image_bytes is not None:
+            return make_record(image_url, self.ses.gis, self.ses.k, self.ses.N, img=image_bytes, bytestream=True,
+                               cache=self.ses.signature_cache, word_layout=self.ses.word_layout)
+
+        return make_record(image_url, self.ses.gis, self.ses.k, self.ses.N, cache=self.ses.signature_cache,
+                           word_layout=self.ses.word_layout)
+
+    def cached_image_record(self, image_url):
+        '''
+        Look an image up by url in the signature cache, without downloading it.
+        :param image_url: url of image.
+        :return: image record as returned by make_record, or None if there is no cache or the image is not in it.
+        '''
+
+        cache = self.ses.signature_cache
+        if cache is None:
+            return None
+
+        cached = cache.get(cache.keys_for(image_url, self.ses.gis, self.ses.k, self.ses.N))
+        if cached is None:
+            return None
+
+        signature, words = cached
+        return make_record_from_signature(image_url, signature, self.ses.k, self.ses.N, words=words,
+                                          word_layout=self.ses.word_layout)
+
+    def is_indexed(self, image_url):
+        '''
+        Check whether an image url is already indexed, with a single document lookup.
+        :param image_url: url of image.
+        :return: boolean whether the image is indexed.
+        '''
+
+        return self.ses.path_exists(image_url)
+
+    def make_image_records(self, image_urls, sign_workers=None):
+        '''
+        Download many images concurrently (if there is a fetcher) and compute their signature records together.
+        Images in the signature cache are neither downloaded nor signed.
+        :param image_urls: list of image urls.
+        :param sign_workers: number of processes to compute signatures on.
+        :return: list of image records, in the order of image_urls, with None for images that could not be
+            downloaded or signed.
+        '''
+
+        records = [self.cached_image_record(image_url) for image_url in image_urls]
+        missing = [i for i, rec in enumerate(records) if rec is None]
 
-        if 'images' not in indeces:
-            self.es_client.indices.create(index="images", ignore=400)
+        if self.fetcher is not None:
+            images = self.fetcher.fetch_many([image_urls[i] for i in missing])
+            fetched = [i for i, image in zip(missing, images) if not isinstance(image, FetchError)]
+            signed = make_records([image_urls[i] for i in fetched], self.ses.gis, self.ses.k, self.ses.N,
+                                  imgs=[image for image in images if not isinstance(image, FetchError)],
+                                  bytestream=True, workers=sign_workers, word_layout=self.ses.word_layout)
+        else:
+            fetched = missing
+            signed = make_records([image_urls[i] for i in missing], self.ses.gis, self.ses.k, self.ses.N,
+                                  workers=sign_workers, word_layout=self.ses.word_layout)
+
+        cache = self.ses.signature_cache
+        for i, rec in zip(fetched, signed):
+            if not isinstance(rec, CorruptImageError):
+                records[i] = rec
+                if cache is not None:
+                    cache.put(cache.keys_for(image_urls[i], self.ses.gis, self.ses.k, self.ses.N),
+                              rec['signature'], record_words(rec, self.ses.N))
 
-        self.ses = SignatureES(self.es_client, index=es_index, distance_cutoff=distance_threshold)
-        self.memcached_client = Client((memcached_endpoint, 11211))
+        return records
 
-    def get_near_duplicates(self, image_url):
+    def get_near_duplicates(self, image_url, image_record=None, with_distances=False):
         '''
         Given an image url, find its near-duplicates using 'image-match' library.
         :param image_url: Query image.
-        :return: List of near-duplicates.
+        :param image_record: precomputed record of the query image. If not given, the image is first looked up by
+            url, and only downloaded and signed if it is not indexed yet.
+        :param with_distances: boolean whether to return full search results, with distances, instead of metadata.
+        :return: List of near-duplicates, within the loosest distance threshold.
         '''
 
         image_exists = False
 
-        search_results = self.ses.search_image(image_url)
+        if image_record is None:
+            if self.is_indexed(image_url):
+                logger.info("This image is already stored in elasticsearch")
+                return [True, []]
+            image_record = self.make_image_record(image_url)
+
+        search_results = self.ses.search_record(image_record)
 
         if len(search_results) > 0:
             for res in search_results:
@@ -45,17 +194,130 @@ class DuplicateClusterAssignment:
             logger.info("Found %d near-duplicates for image: %s" % (len(search_results), image_url))
             logger.info("Near-duplicate: %s" % [r['path'] for r in search_results])
 
+        if with_distances:
+            return [image_exists, search_results]
         return [image_exists, [res['metadata'] for res in search_results]]
 
-    def index_image_with_clusterid(self, image_url, image_clusterid):
+    def index_image_with_clusterid(self, image_url, image_clusterid, image_record=None, representative_hits=None):
         '''
-        Index an image url and corresponding cluster id into elasticsearch.
+        Index an image url and corresponding cluster id into elasticsearch, and update cluster representatives.
         :param image_url: url of image to be indexed.
-        :param image_clusterid: cluster id of image to be indexed.
+        :param image_clusterid: cluster id of image to be indexed, or dict of cluster ids by distance threshold as
+            returned by get_cluster_ids.
+        :param image_record: precomputed record of the image. Computed from image_url if not given.
+        :param representative_hits: representatives near the image, as returned by assign_cluster_ids.
         '''
 
         logger.info("Indexing image: %s with cluster id %s" % (image_url, str(image_clusterid)))
-        self.ses.add_image(image_url, metadata={'clusterid': image_clusterid})
+        if image_record is None:
+            image_record = self.ses.add_image(image_url, metadata=self.cluster_metadata(image_clusterid))
+        else:
+            image_record['metadata'] = self.cluster_metadata(image_clusterid)
+            self.ses.insert_single_record(image_record)
+
+        if self.representatives is not None:
+            self.representatives.add_member(image_record, image_record['metadata']['clusterid'],
+                                            hits=representative_hits)
+
+    def assign_cluster_ids(self, image_url, image_record):
+        '''
+        Search for the near-duplicates of an image and compute its cluster ids. With cluster representatives, search
+        those first, and only search individual images when the representatives are ambiguous.
+        :param image_url: url of image.
+        :param image_record: record of the image.
+        :return: tuple of the cluster ids as returned by get_cluster_ids, or None if the image is already indexed,
+            and the representatives near the image, to pass on to index_image_with_clusterid.
+        '''
+
+        representative_hits = None
+        if self.representatives is not None:
+            representative_hits = self.representatives.search(image_record)
+            near_dups = self.representatives.near_duplicates(image_record, hits=representative_hits)
+            if near_dups is not None:
+                logger.info("Assigned image: %s from %d cluster representatives"
+                            % (image_url, len(representative_hits)))
+                return {self.distance_thresholds[0]: self.get_cluster_id(near_dups, image_url)}, representative_hits
+
+        # one search at the loosest threshold serves every threshold
+        image_exists, near_dups = self.get_near_duplicates(image_url, image_record=image_record,
+                                                           with_distances=True)
+        if image_exists:
+            return None, representative_hits
+        return self.get_cluster_ids(near_dups, image_url), representative_hits
+
+    def claim_cluster_ids(self, image_url, image_record, cluster_ids):
+        '''
+        Make an image searchable in memory with its cluster ids before it is indexed, so that near-duplicates
+        searched for meanwhile join its cluster. Indexing the image later replaces the claim. Needs recent_ttl.
+        :param image_url: url of image.
+        :param image_record: record of the image.
+        :param cluster_ids: cluster ids of the image, as returned by assign_cluster_ids.
+        '''
+
+        self.ses.recent_records.add(path_id(image_url), dict(image_record, metadata=self.cluster_metadata(cluster_ids)))
+
+    def cluster_metadata(self, cluster_ids):
+        '''
+        Document metadata for the cluster ids of an image.
+        :param cluster_ids: cluster id, or dict of cluster ids by distance threshold.
+        :return: dict with the primary cluster id as 'clusterid' and, with several thresholds, all cluster ids by
+            threshold as 'clusterids', keyed by threshold_field(threshold), e.g. 't0_1'.
+        '''
+
+        if not isinstance(cluster_ids, dict):
+            return {'clusterid': cluster_ids}
+
+        metadata = {'clusterid': cluster_ids[self.distance_thresholds[0]]}
+        if len(self.distance_thresholds) > 1:
+            metadata['clusterids'] = dict((threshold_field(threshold), cluster_ids[threshold])
+                                          for threshold in self.distance_thresholds)
+        return metadata
+
+    def get_cluster_ids(self, search_results, image_url, batch_near_duplicates=None):
+        '''
+        Given the near-duplicates of an image at the loosest threshold, compute its cluster id for every distance
+        threshold by majority vote over the near-duplicates within that threshold.
+        :param search_results: near-duplicates, as returned by get_near_duplicates with with_distances=True.
+        :param image_url: url of image.
+        :param batch_near_duplicates: optional list of (distance, cluster ids) tuples of other, not yet searchable
+            near-duplicates, with cluster ids as returned by this method.
+        :return: dict of cluster ids by distance threshold.
+        '''
+
+        cluster_ids = {}
+        for threshold in self.distance_thresholds:
+            near_dups = [self._threshold_metadata(res['metadata'], threshold)
+                         for res in search_results if res['dist'] < threshold]
+            near_dups.extend({'clusterid': ids[threshold]}
+                             for dist, ids in batch_near_duplicates or [] if dist < threshold)
+            cluster_ids[threshold] = self.get_cluster_id(near_dups, image_url)
+
+        return cluster_ids
+
+    def _threshold_metadata(self, metadata, threshold):
+        # the cluster id of a near-duplicate at one threshold, in the format get_cluster_id expects. Documents
+        # indexed with a single threshold only vote at the primary one.
+        cluster_id = self.cluster_id_store.metadata_cluster_id(metadata, threshold)
+        if cluster_id is None:
+            return None
+        return {'clusterid': cluster_id}
+
+    def stored_cluster_ids(self, metadata):
+        '''
+        Cluster ids stored in the document metadata of an indexed image.
+        :param metadata: document metadata, as returned by SignatureES.paths_metadata.
+        :return: dict of cluster ids by distance threshold, with None for thresholds the document has no cluster id
+            for.
+        '''
+
+        return dict((threshold, self.cluster_id_store.metadata_cluster_id(metadata, threshold))
+                    for threshold in self.distance_thresholds)
+
+    def _cluster_id_result(self, cluster_ids):
+        # cluster ids as returned to callers: a plain cluster id with a single threshold
+        if cluster_ids is None or len(self.distance_thresholds) > 1:
+            return cluster_ids
+        return cluster_ids[self.distance_thresholds[0]]
 
     def get_cluster_id(self, near_duplicates, image_url):
         '''
@@ -82,8 +344,51 @@ class DuplicateClusterAssignment:
             return random_cluster_id
 
     def memcached_insert(self, key, value):
+        '''
+        Queue a cluster id for writing to memcached. Writes are batched, see ClusterIdStore.
+        :param key: url of image.
+        :param value: cluster id.
+        '''
+
+        self.cluster_id_store.set(key, value)
+
+    def memcached_items(self, image_url, cluster_ids):
+        '''
+        Memcached entries for the cluster ids of an image. The primary cluster id is stored under the md5 of the url,
+        and the others under the md5 followed by '_' and the threshold.
+        :param image_url: url of image.
+        :param cluster_ids: dict of cluster ids by distance threshold.
+        :return: dict of memcached values by key.
+        '''
+
+        return self.cluster_id_store.items(image_url, cluster_ids)
+
+    def memcached_insert_cluster_ids(self, image_url, cluster_ids):
+        '''
+        Queue the cluster ids of an image for writing to memcached, in the same batch.
+        :param image_url: url of image.
+        :param cluster_ids: dict of cluster ids by distance threshold.
+        '''
+
+        self.cluster_id_store.set(image_url, cluster_ids)
+
+    def lookup_cluster_ids(self, image_urls, threshold=None):
+        '''
+        Look up the cluster ids of already clustered images, in a local cache, then memcached, then Elasticsearch.
+        :param image_urls: list of image urls.
+        :param threshold: distance threshold, or None for the primary one.
+        :return: list of cluster ids, in the order of image_urls, with None for images that were not found.
+        '''
+
+        return self.cluster_id_store.get_cluster_ids(image_urls, threshold=threshold)
 
-        self.memcached_client.set('%s' % hashlib.md5(key).hexdigest(), str(value))
+    def close(self):
+        '''
+        Send buffered Elasticsearch documents and memcached writes.
+        '''
+
+        self.ses.close()
+        self.cluster_id_store.close()
 
     def insert_and_cluster(self, image_url, memcached_persist=False):
         '''
@@ -97,16 +402,226 @@ class DuplicateClusterAssignment:
         '''
 
         try:
-            image_exists, near_dups = self.get_near_duplicates(image_url)
-            if not image_exists:
-                cluster_id = self.get_cluster_id(near_dups, image_url)
-                self.index_image_with_clusterid(image_url, image_clusterid=cluster_id)
+            # replayed messages stop here, before any download or signature work
+            if self.is_indexed(image_url):
+                logger.info("This image is already stored in elasticsearch")
+                return
+
+            # fetch and sign the image once for both search and indexing
+            image_record = self.make_image_record(image_url)
+
+            cluster_ids, representative_hits = self.assign_cluster_ids(image_url, image_record)
+            if cluster_ids is not None:
+                self.index_image_with_clusterid(image_url, image_clusterid=cluster_ids,
+                                                image_record=image_record, representative_hits=representative_hits)
 
                 if memcached_persist:
-                    self.memcached_insert(image_url, cluster_id)
+                    self.memcached_insert_cluster_ids(image_url, cluster_ids)
+        except Exception:
+            logger.error("Indexing pipeline failure", exc_info=True)
+
+    def insert_and_cluster_batch(self, image_urls, sign_workers=None, memcached_persist=False):
+        '''
+        Batched version of insert_and_cluster, for bursts of images that may be near-duplicates of each other.
+            1.  Skip images that are already indexed, with one lookup for the whole batch.
+            2.  Download and sign the remaining images together.
+            3.  Search for near-duplicates of all of them with one batched search, and compare them with each other
+                with one distance matrix.
+            4.  Assign cluster ids in batch order, as insert_and_cluster would if every image were searchable as
+                soon as it is indexed: each image votes over its indexed near-duplicates and the earlier images of
+                the batch it is close to.
+            5.  Index all images with their cluster ids in bulk, and optionally write the cluster ids to memcached
+                in one request.
+
+        :param image_urls: list of image urls to be clustered and indexed.
+        :param sign_workers: number of processes to compute signatures on.
+        :param memcached_persist: boolean whether to write cluster ids to memcached.
+        :return: list of cluster ids (or, with several thresholds, dicts of cluster ids by threshold), in the order
+            of image_urls, with None for images that were already indexed or could not be downloaded, signed or
+            indexed.
+        '''
+
+        cluster_ids = {}
+
+        try:
+            # replayed messages stop here, before any download or signature work
+            unique_urls = list(OrderedDict.fromkeys(image_urls))
+            new_urls = [url for url, exists in zip(unique_urls, self.ses.paths_exist(unique_urls)) if not exists]
+            logger.info("%d of %d images in batch are already stored in elasticsearch"
+                        % (len(unique_urls) - len(new_urls), len(unique_urls)))
+
+            records = [rec for rec in self.make_image_records(new_urls, sign_workers=sign_workers) if rec is not None]
+            if not records:
+                return [None] * len(image_urls)
+
+            search_results = self.ses.search_records(records)
+
+            # near-duplicate pairs within the batch
+            signatures = np.array([rec['signature'] for rec in records], dtype='int8')
+            batch_dists = normalized_distances(signatures, signatures)
+
+            assigned = {}
+            to_index = []
+            for i, (rec, results) in enumerate(zip(records, search_results)):
+                image_url = rec['path']
+                if any(res['path'] == image_url for res in results):
+                    logger.info("This image is already stored in elasticsearch")
+                    continue
+
+                batch_near_dups = [(batch_dists[i, j], assigned[records[j]['path']])
+                                   for j in np.flatnonzero(batch_dists[i, :i] < self.ses.distance_cutoff)
+                                   if records[j]['path'] in assigned]
+                logger.info("Found %d near-duplicates for image: %s" % (len(results) + len(batch_near_dups), image_url))
+
+                assigned[image_url] = self.get_cluster_ids(results, image_url, batch_near_duplicates=batch_near_dups)
+                rec['metadata'] = self.cluster_metadata(assigned[image_url])
+                to_index.append(rec)
+
+            indexed = []
+            for rec, error in zip(to_index, self.ses.insert_records(to_index)):
+                if error is None:
+                    cluster_ids[rec['path']] = assigned[rec['path']]
+                    indexed.append(rec)
+                else:
+                    logger.error("Failed to index image: %s (%s)" % (rec['path'], error))
+
+            if self.representatives is not None and indexed:
+                self._add_batch_representatives(records, indexed, batch_dists)
+
+            if memcached_persist and cluster_ids:
+                self.cluster_id_store.set_many(cluster_ids)
         except Exception:
             logger.error("Indexing pipeline failure", exc_info=True)
 
+        return [self._cluster_id_result(cluster_ids.get(url)) for url in image_urls]
+
+    def _add_batch_representatives(self, records, indexed, batch_dists):
+        # one batched search of the representative index, plus the representatives added earlier in the batch,
+        # which that search cannot have found, and one count of the representatives of the batch's clusters
+        rows = dict((rec['path'], i) for i, rec in enumerate(records))
+        cutoff = self.representatives.ses.distance_cutoff
+        self.representatives.counts([rec['metadata']['clusterid'] for rec in indexed])
+        added = []
+        for rec, hits in zip(indexed, self.representatives.ses.search_records(indexed)):
+            i = rows[rec['path']]
+            hits = hits + [{'path': records[j]['path'], 'dist': batch_dists[i, j],
+                            'metadata': {'clusterid': cluster_id}}
+                           for j, cluster_id in added if batch_dists[i, j] < cutoff]
+            if self.representatives.add_member(rec, rec['metadata']['clusterid'], hits=hits):
+                added.append((i, rec['metadata']['clusterid']))
+
+    def backfill(self, image_urls, sign_workers=None, cluster_workers=None, chunk_size=10000,
+                 memcached_persist=False):
+        '''
+        Cluster and index a whole corpus at once, e.g. to backfill a catalog into an empty index.
+
+            1.  Download (if there is a fetcher) and sign images in chunks, signing each chunk on a process pool.
+            2.  Cluster all images by single linkage: only images sharing a word are compared, and near-duplicate
+                pairs are merged with union-find (see cluster_signatures).
+            3.  Bulk index every image with its cluster id, and optionally write all cluster ids to memcached.
+
+        The cluster id of a cluster is the md5 of its first url, as get_cluster_id would assign when the first
+        image arrives, and does not depend on the order of the rest. Images already in the index are neither
+        signed nor reclustered: they keep the cluster ids stored in their documents. They are not clustered with
+        the new ones either, so this is meant for initial loads rather than for live traffic.
+
+        :param image_urls: list of image urls.
+        :param sign_workers: number of processes to compute signatures on.
+        :param cluster_workers: number of threads to compare signatures on.
+        :param chunk_size: number of images to download and sign at a time.
+        :param memcached_persist: boolean whether to write cluster ids to memcached.
+        :return: list of cluster ids (or, with several thresholds, dicts of cluster ids by threshold), in the order
+            of image_urls, with None for images that could not be downloaded, signed or indexed. Images already
+            indexed get their stored cluster ids.
+        '''
+
+        k, N = self.ses.k, self.ses.N
+
+        # only signatures and words are kept in memory, not records or image data
+        cluster_ids = {}
+        urls = []
+        signature_chunks = []
+        word_chunks = []
+        for start in range(0, len(image_urls), chunk_size):
+            chunk = image_urls[start:start + chunk_size]
+            stored = {}
+            for image_url, metadata in zip(chunk, self.ses.paths_metadata(chunk)):
+                if metadata is not None:
+                    stored[image_url] = self.stored_cluster_ids(metadata)
+            cluster_ids.update(stored)
+            if memcached_persist:
+                self.cluster_id_store.set_many(dict((url, ids) for url, ids in stored.items()
+                                                    if None not in ids.values()))
+
+            chunk = [image_url for image_url in chunk if image_url not in stored]
+            recs = [rec for rec in self.make_image_records(chunk, sign_workers=sign_workers) if rec is not None]
+            if recs:
+                urls.extend(rec['path'] for rec in recs)
+                signature_chunks.append(np.array([rec['signature'] for rec in recs], dtype='int8'))
+                word_chunks.append(np.array([record_words(rec, N) for rec in recs], dtype=np.int64))
+            logger.info("Signed %d of %d images (%d already indexed)"
+                        % (min(start + chunk_size, len(image_urls)), len(image_urls), len(cluster_ids)))
+
+        if urls:
+            signatures = np.concatenate(signature_chunks)
+            words = np.concatenate(word_chunks)
+            del signature_chunks, word_chunks
+            first_rows = {}
+            for threshold in self.distance_thresholds:
+                first_rows[threshold] = cluster_signatures(signatures, words, threshold, workers=cluster_workers)
+                logger.info("Clustered %d images into %d clusters at threshold %s"
+                            % (len(urls), len(np.unique(first_rows[threshold])), threshold))
+
+            for start in range(0, len(urls), chunk_size):
+                rows = range(start, min(start + chunk_size, len(urls)))
+                batch_ids = dict((urls[row], dict((threshold, hashlib.md5(urls[first_rows[threshold][row]]).hexdigest())
+                                                  for threshold in self.distance_thresholds))
+                                 for row in rows)
+                records = [make_record_from_signature(urls[row], signatures[row], k, N,
+                                                      metadata=self.cluster_metadata(batch_ids[urls[row]]),
+                                                      words=words[row].tolist(),
+                                                      word_layout=self.ses.word_layout)
+                           for row in rows]
+
+                for rec, error in zip(records, self.ses.insert_records(records)):
+                    if error is None:
+                        cluster_ids[rec['path']] = batch_ids[rec['path']]
+                    else:
+                        logger.error("Failed to index image: %s (%s)" % (rec['path'], error))
+
+                if memcached_persist:
+                    self.cluster_id_store.set_many(dict((url, ids) for url, ids in batch_ids.items()
+                                                        if url in cluster_ids))
+
+            if self.representatives is not None:
+                self._backfill_representatives(urls, signatures, words, first_rows[self.distance_thresholds[0]],
+                                               cluster_ids, chunk_size)
+
+        return [self._cluster_id_result(cluster_ids.get(url)) for url in image_urls]
+
+    def _backfill_representatives(self, urls, signatures, words, first_rows, cluster_ids, chunk_size):
+        # medoid-first representatives of every bulk-clustered cluster, among its indexed members
+        indexed = np.array([url in cluster_ids for url in urls])
+        order = np.argsort(first_rows, kind='mergesort')
+        order = order[indexed[order]]
+        starts = np.flatnonzero(np.concatenate(([True], first_rows[order][1:] != first_rows[order][:-1])))
+
+        representatives = []
+        for members in np.split(order, starts[1:]) if order.shape[0] > 0 else []:
+            cluster_id = cluster_ids[urls[members[0]]][self.distance_thresholds[0]]
+            for i in self.representatives.choose(signatures[members]):
+                row = members[i]
+                representatives.append(make_record_from_signature(urls[row], signatures[row], self.ses.k, self.ses.N,
+                                                                  metadata={'clusterid': cluster_id},
+                                                                  words=words[row].tolist(),
+                                                                  word_layout=self.ses.word_layout))
+            if len(representatives) >= chunk_size:
+                self.representatives.ses.insert_records(representatives)
+                representatives = []
+
+        if representatives:
+            self.representatives.ses.insert_records(representatives)
+
 # def main():
 #     es = Elasticsearch()
 #     # es.indices.delete(index='images', ignore=[400, 404])
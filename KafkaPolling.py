@@ -3,6 +3,8 @@ import sys
 import boto3
 import multiprocessing
 from DuplicateClusterAssignment import DuplicateClusterAssignment
+from ClusteringPipeline import ClusteringPipeline
+from viglink_image_match.fetcher import ImageFetcher
 from time import sleep
 from kafka import KafkaConsumer
 
@@ -10,13 +12,25 @@ logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
 logger = logging.getLogger(__name__)
 
 
-def kafka_polling(kafka_topic, kafka_group_id, kafka_host, es_endpoint, memcache_endpoint, process_id):
+def kafka_polling(kafka_topic, kafka_group_id, kafka_host, es_endpoint, memcache_endpoint, process_id,
+                  fetch_workers=16, sign_workers=2, search_workers=8, index_workers=4, queue_size=32):
     logger.warning(
         "Process %d: Beginning to poll Kafka. Topic: %s, groupid: %s, host: %s" % (
             process_id, kafka_topic, kafka_group_id, kafka_host))
 
     dca = DuplicateClusterAssignment(elasticsearch_endpoint=es_endpoint, es_index='images_0.1', distance_threshold=0.1,
-                                     memcached_endpoint=memcache_endpoint)
+                                     memcached_endpoint=memcache_endpoint,
+                                     fetcher=ImageFetcher(workers=fetch_workers))
+
+    def message_processed(image_url, message):
+        # TODO: not deleting message for testing purposes. Change this when finished testing
+        # message.delete()
+        logger.warning("Process %d: message processed" % process_id)
+
+    # fetch, sign, search and index concurrently; submit blocks while the pipeline is full
+    pipeline = ClusteringPipeline(dca, fetch_workers=fetch_workers, sign_workers=sign_workers,
+                                  search_workers=search_workers, index_workers=index_workers,
+                                  queue_size=queue_size, on_done=message_processed)
 
     # Kafka client config
     consumer = KafkaConsumer(kafka_topic, group_id=kafka_group_id, bootstrap_servers=[kafka_host])
@@ -28,15 +42,7 @@ def kafka_polling(kafka_topic, kafka_group_id, kafka_host, es_endpoint, memcache
         logger.warning('Process %d: Received image url %s' % (process_id, image_url))
 
         # cluster image
-        try:
-            dca.insert_and_cluster(image_url)
-        except Exception:
-            logger.error("Process %d: Failed to write to memcached" % process_id, exc_info=True)
-
-        finally:
-            # TODO: not deleting message for testing purposes. Change this when finished testing
-            # message.delete()
-            logger.warning("Process %d: message processed" % process_id)
+        pipeline.submit(image_url, message)
 
 
 def main():
@@ -3,19 +3,33 @@ import sys
 import boto3
 import multiprocessing
 from DuplicateClusterAssignment import DuplicateClusterAssignment
+from ClusteringPipeline import ClusteringPipeline
+from viglink_image_match.fetcher import ImageFetcher
 from time import sleep
 
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
 logger = logging.getLogger(__name__)
 
 
-def sqs_polling(queue_name, memcached_endpoint, es_endpoint, process_id):
+def sqs_polling(queue_name, memcached_endpoint, es_endpoint, process_id,
+                fetch_workers=16, sign_workers=2, search_workers=8, index_workers=4, queue_size=32):
     # SQS client config
     sqs = boto3.resource('sqs', region_name='us-east-1')
     queue = sqs.get_queue_by_name(QueueName=queue_name)
 
     dca = DuplicateClusterAssignment(elasticsearch_endpoint=es_endpoint, es_index='images_0.1', distance_threshold=0.1,
-                                     memcached_endpoint=memcached_endpoint)
+                                     memcached_endpoint=memcached_endpoint,
+                                     fetcher=ImageFetcher(workers=fetch_workers))
+
+    def message_processed(image_url, message):
+        # TODO: not deleting message for testing purposes. Change this when finished testing
+        # message.delete()
+        logger.warning("Process %d: message processed" % process_id)
+
+    # fetch, sign, search and index concurrently; submit blocks while the pipeline is full
+    pipeline = ClusteringPipeline(dca, fetch_workers=fetch_workers, sign_workers=sign_workers,
+                                  search_workers=search_workers, index_workers=index_workers,
+                                  queue_size=queue_size, on_done=message_processed)
 
     no_messages = False
 
@@ -40,16 +54,8 @@ def sqs_polling(queue_name, memcached_endpoint, es_endpoint, process_id):
 
             image_url = message.body
 
-            try:
-                # cluster image
-                dca.insert_and_cluster(image_url)
-            except Exception:
-                logger.error("Process %d: Failed to write to memcached" % process_id, exc_info=True)
-
-            finally:
-                # TODO: not deleting message for testing purposes. Change this when finished testing
-                # message.delete()
-                logger.warning("Process %d: message processed" % process_id)
+            # cluster image
+            pipeline.submit(image_url, message)
 
 
 def main():
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the package and the top-level scripts use implicit relative imports, so put both
+# directories on the path and import modules by their bare names
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'viglink_image_match'))
+sys.path.insert(0, root)
@@ -0,0 +1,197 @@
+from elasticsearch.exceptions import ConflictError, NotFoundError, RequestError
+from elasticsearch.serializer import JSONSerializer
+import fnmatch
+import itertools
+import json
+
+
+class FakeIndices(object):
+    def __init__(self, es):
+        self.es = es
+        self.mappings = {}
+        self.templates = {}
+
+    def exists(self, index):
+        return index in self.mappings
+
+    def create(self, index, body=None, ignore=()):
+        if index in self.mappings:
+            if 400 in (ignore if isinstance(ignore, (list, tuple)) else (ignore,)):
+                return {'error': {'type': 'resource_already_exists_exception'}, 'status': 400}
+            raise RequestError(400, 'resource_already_exists_exception', {})
+        self.mappings[index] = (body or {}).get('mappings', {})
+        return {'acknowledged': True}
+
+    def get_mapping(self, index):
+        if index not in self.mappings:
+            raise NotFoundError(404, 'index_not_found_exception', {})
+        return {index: {'mappings': self.mappings[index]}}
+
+    def put_template(self, name, body):
+        self.templates[name] = body
+        return {'acknowledged': True}
+
+
+class FakeTransport(object):
+    serializer = JSONSerializer()
+
+
+class FakeElasticsearch(object):
+    """In-memory stand-in for the parts of the Elasticsearch client that the drivers use
+
+    Documents are searchable as soon as they are indexed. Scores are the number of
+    matching word terms.
+
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.indices = FakeIndices(self)
+        self.transport = FakeTransport()
+        self.requests = []
+        self._ids = itertools.count()
+
+    def _store(self, index):
+        return self.docs.setdefault(index, {})
+
+    def index(self, index, body, doc_type=None, id=None, op_type='index', refresh=False):
+        self.requests.append('index')
+        if id is None:
+            id = 'auto_%d' % next(self._ids)
+        if op_type == 'create' and id in self._store(index):
+            raise ConflictError(409, 'version_conflict_engine_exception', {})
+        self._store(index)[id] = json.loads(json.dumps(body, default=self.transport.serializer.default))
+        return {'_id': id, 'result': 'created'}
+
+    def bulk(self, body, *args, **kwargs):
+        self.requests.append('bulk')
+        lines = [json.loads(line) for line in body.split('\n') if line.strip()]
+        items = []
+        while lines:
+            action = lines.pop(0)
+            op, meta = list(action.items())[0]
+            store = self._store(meta['_index'])
+            doc_id = meta.get('_id') or 'auto_%d' % next(self._ids)
+            if op == 'delete':
+                status = 200 if store.pop(doc_id, None) is not None else 404
+                items.append({op: {'_id': doc_id, 'status': status}})
+                continue
+
+            source = lines.pop(0)
+            if op == 'create' and doc_id in store:
+                items.append({op: {'_id': doc_id, 'status': 409,
+                                   'error': {'type': 'version_conflict_engine_exception'}}})
+                continue
+            store[doc_id] = source
+            items.append({op: {'_id': doc_id, 'status': 201}})
+
+        return {'errors': any('error' in list(item.values())[0] for item in items), 'items': items}
+
+    def exists(self, index, id, doc_type=None):
+        self.requests.append('exists')
+        return id in self._store(index)
+
+    def mget(self, index, body, doc_type=None, _source=True):
+        self.requests.append('mget')
+        docs = []
+        for doc_id in body['ids']:
+            source = self._store(index).get(doc_id)
+            doc = {'_id': doc_id, 'found': source is not None}
+            if source is not None and _source is not False:
+                doc['_source'] = _filter_source(source, includes=_source if isinstance(_source, list) else None)
+            docs.append(doc)
+        return {'docs': docs}
+
+    def count(self, index, body, doc_type=None):
+        self.requests.append('count')
+        return {'count': len(self._matching(index, body['query']))}
+
+    def search(self, index=None, body=None, doc_type=None, size=10, timeout=None, scroll=None, **kwargs):
+        self.requests.append('search')
+        hits = sorted(self._matching(index, body.get('query', {'match_all': {}})), key=lambda hit: -hit[1])
+        aggregations = dict((name, _terms_aggregation(spec['terms'], hits))
+                            for name, spec in body.get('aggs', {}).items())
+        if scroll is None:
+            hits = hits[:body.get('size', size)]
+        excludes = (body.get('_source') or {}).get('excludes', [])
+        response = {'_scroll_id': 'scroll',
+                    'hits': {'hits': [{'_id': doc_id, '_score': score,
+                                       '_source': _filter_source(source, excludes=excludes)}
+                                      for doc_id, score, source in hits]}}
+        if aggregations:
+            response['aggregations'] = aggregations
+        return response
+
+    def msearch(self, body):
+        self.requests.append('msearch')
+        responses = []
+        for header, query in zip(body[::2], body[1::2]):
+            responses.append(self.search(index=header['index'], body=query, size=query.get('size', 10)))
+            self.requests.pop()
+        return {'responses': responses}
+
+    def scroll(self, *args, **kwargs):
+        return {'_scroll_id': 'scroll', 'hits': {'hits': []}}
+
+    def clear_scroll(self, *args, **kwargs):
+        return {}
+
+    def _matching(self, index, query):
+        # (id, score, source) of the documents matching a query
+        matches = []
+        for doc_id, source in self._store(index).items():
+            score = _score(query, source)
+            if score is not None:
+                matches.append((doc_id, score, source))
+        return matches
+
+
+def _field(source, name):
+    for part in name.split('.'):
+        if not isinstance(source, dict):
+            return None
+        source = source.get(part)
+    return source
+
+
+def _score(query, source):
+    # number of matching terms, or None if the document does not match
+    if 'match_all' in query:
+        return 1.
+    if 'term' in query:
+        name, value = list(query['term'].items())[0]
+        return 1. if _field(source, name) == value else None
+    if 'terms' in query:
+        name, values = list(query['terms'].items())[0]
+        return 1. if _field(source, name) in values else None
+    if 'terms_set' in query:
+        name, spec = list(query['terms_set'].items())[0]
+        values = set(source.get(name) or [])
+        matched = len([term for term in spec['terms'] if term in values])
+        needed = min(len(spec['terms']), spec['minimum_should_match_script']['params']['min_word_match'])
+        return float(matched) if matched >= needed and matched > 0 else None
+    if 'bool' in query:
+        scores = [_score(clause, source) for clause in query['bool'].get('should', [])]
+        matched = len([score for score in scores if score is not None])
+        if matched < max(query['bool'].get('minimum_should_match', 1), 1):
+            return None
+        return float(matched)
+    raise ValueError('Unsupported query %r' % query)
+
+
+def _terms_aggregation(spec, hits):
+    # buckets of a terms aggregation over the matching documents, most frequent first
+    counts = {}
+    for doc_id, score, source in hits:
+        value = _field(source, spec['field'])
+        if value is not None:
+            counts[value] = counts.get(value, 0) + 1
+    buckets = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:spec.get('size', 10)]
+    return {'buckets': [{'key': key, 'doc_count': count} for key, count in buckets]}
+
+
+def _filter_source(source, includes=None, excludes=()):
+    if includes is not None:
+        return dict((key, value) for key, value in source.items() if key in includes)
+    return dict((key, value) for key, value in source.items()
+                if not any(fnmatch.fnmatch(key, pattern) for pattern in excludes))
@@ -0,0 +1,149 @@
+import hashlib
+import time
+
+import pytest
+
+pytest.importorskip('pymemcache')
+
+import ClusterIdStore as cluster_id_store
+from ClusterIdStore import ClusterIdStore, threshold_field
+from pymemcache.test.utils import MockMemcacheClient
+
+
+class RecordingClient(MockMemcacheClient):
+    def __init__(self, *args, **kwargs):
+        MockMemcacheClient.__init__(self, *args, **kwargs)
+        self.set_many_sizes = []
+        self.get_many_calls = 0
+
+    def set_many(self, values, *args, **kwargs):
+        self.set_many_sizes.append(len(values))
+        return MockMemcacheClient.set_many(self, values, *args, **kwargs)
+
+    def get_many(self, keys, *args, **kwargs):
+        self.get_many_calls += 1
+        return MockMemcacheClient.get_many(self, keys, *args, **kwargs)
+
+
+class FailingClient(RecordingClient):
+    def get_many(self, keys, *args, **kwargs):
+        raise IOError('memcached is down')
+
+
+class MetadataES(object):
+    # the paths_metadata lookup of SignatureES, over a dict of metadata by url
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.lookups = []
+
+    def paths_metadata(self, paths):
+        self.lookups.append(list(paths))
+        return [self.metadata.get(path) for path in paths]
+
+
+def url(i):
+    return b'http://images.example.com/%d.jpg' % i
+
+
+def md5(image_url):
+    return hashlib.md5(image_url).hexdigest()
+
+
+def test_keys():
+    store = ClusterIdStore(RecordingClient(), distance_thresholds=[0.4, 0.2])
+    assert store.key(url(0)) == store.key(url(0), 0.4) == md5(url(0))
+    assert store.key(url(0), 0.2) == md5(url(0)) + '_0.2'
+    assert store.items(url(0), {0.4: 'a', 0.2: 'b'}) == {md5(url(0)): 'a', md5(url(0)) + '_0.2': 'b'}
+    assert threshold_field(0.2) == 't0_2'
+
+
+def test_writes_are_batched_by_count():
+    client = RecordingClient()
+    store = ClusterIdStore(client, batch_size=3, flush_interval=60.)
+    for i in range(7):
+        store.set(url(i), 'cluster_%d' % i)
+    assert client.set_many_sizes == [3, 3]
+
+    store.close()
+    assert client.set_many_sizes == [3, 3, 1]
+    assert client.get(md5(url(6))) == b'cluster_6'
+
+    store = ClusterIdStore(client, batch_size=3, flush_interval=60.)
+    store.set_many(dict((url(i), 'cluster_%d' % i) for i in range(8)))
+    assert client.set_many_sizes[3:] == [3, 3, 2]
+    store.close()
+
+
+def test_writes_are_flushed_periodically():
+    client = RecordingClient()
+    store = ClusterIdStore(client, batch_size=100, flush_interval=0.01)
+    store.set(url(0), 'a')
+
+    deadline = time.time() + 5.
+    while client.get(md5(url(0))) is None and time.time() < deadline:
+        time.sleep(0.01)
+    assert client.get(md5(url(0))) == b'a'
+    assert client.set_many_sizes[0] == 1
+    store.close()
+
+
+def test_local_cache_is_lru_with_ttl(monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(cluster_id_store.time, 'time', lambda: now[0])
+
+    client = RecordingClient()
+    store = ClusterIdStore(client, flush_interval=60., cache_size=2, cache_ttl=10.)
+    store.set_many({url(0): 'a', url(1): 'b'})
+    assert store.get_cluster_ids([url(0)]) == ['a']
+
+    # url(1) is now the least recently used, and is evicted by url(2)
+    store.set(url(2), 'c')
+    store.flush()
+    assert store.get_cluster_ids([url(0), url(2)]) == ['a', 'c']
+    assert client.get_many_calls == 0
+
+    client.delete_many([md5(url(i)) for i in range(3)])
+    assert store.get_cluster_ids([url(0), url(1), url(2)]) == ['a', None, 'c']
+
+    now[0] += 11.
+    assert store.get_cluster_ids([url(0), url(2)]) == [None, None]
+    store.close()
+
+
+def test_lookups_fall_back_to_memcached():
+    client = RecordingClient()
+    writer = ClusterIdStore(client, distance_thresholds=[0.4, 0.2])
+    writer.set_many({url(0): {0.4: 'a', 0.2: 'b'}, url(1): {0.4: 'c', 0.2: 'd'}})
+    writer.close()
+
+    reader = ClusterIdStore(client, distance_thresholds=[0.4, 0.2])
+    assert reader.get_cluster_ids([url(0), url(1), url(0), url(2)]) == ['a', 'c', 'a', None]
+    assert reader.get_cluster_ids([url(1)], threshold=0.2) == ['d']
+    assert client.get_many_calls == 2
+
+    # found values are cached locally
+    client.delete_many([md5(url(0))])
+    assert reader.get_cluster_ids([url(0)]) == ['a']
+    assert client.get_many_calls == 2
+    reader.close()
+
+
+def test_lookups_read_through_to_elasticsearch():
+    metadata = {url(0): {'clusterid': 'a', 'clusterids': {threshold_field(0.4): 'a', threshold_field(0.2): 'b'}},
+                # indexed with a single threshold
+                url(1): {'clusterid': 'c'}}
+    ses = MetadataES(metadata)
+    client = FailingClient()
+    store = ClusterIdStore(client, ses=ses, distance_thresholds=[0.4, 0.2], flush_interval=60.)
+
+    assert store.get_cluster_ids([url(0), url(1), url(2), url(0)], threshold=0.2) == ['b', None, None, 'b']
+    assert ses.lookups == [[url(0), url(1), url(2)]]
+    assert store.get_cluster_ids([url(0), url(1)]) == ['a', 'c']
+
+    # recovered values are cached and written back to memcached
+    assert store.get_cluster_ids([url(0)], threshold=0.2) == ['b']
+    assert len(ses.lookups) == 2
+    store.close()
+    assert client.get(md5(url(0)) + '_0.2') == b'b'
+    assert client.get(md5(url(1))) == b'c'
+    assert client.get(md5(url(1)) + '_0.2') is None
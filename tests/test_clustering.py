@@ -0,0 +1,74 @@
+from clustering import UnionFind, block_pairs, cluster_signatures
+from signature_database_base import normalized_distances, signatures_to_words
+from test_embedded_driver import near_duplicate_signatures
+import numpy as np
+import pytest
+
+
+def connected_components(adjacency):
+    # label of every node: the smallest node of its component, by depth-first search
+    labels = -np.ones(adjacency.shape[0], dtype=np.int64)
+    for start in range(adjacency.shape[0]):
+        if labels[start] >= 0:
+            continue
+        labels[start] = start
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            for neighbour in np.flatnonzero(adjacency[node]):
+                if labels[neighbour] < 0:
+                    labels[neighbour] = start
+                    stack.append(neighbour)
+    return labels
+
+
+def brute_force_clusters(signatures, words, distance_cutoff):
+    # single linkage over all pairs that share a word at some position
+    shared = np.zeros((signatures.shape[0], signatures.shape[0]), dtype=bool)
+    for position in range(words.shape[1]):
+        shared |= words[:, position][:, np.newaxis] == words[:, position][np.newaxis, :]
+    near = normalized_distances(signatures, signatures) < distance_cutoff
+    return connected_components(shared & near)
+
+
+def test_union_find_matches_connected_components():
+    rng = np.random.default_rng(0)
+    n = 200
+    a, b = rng.integers(0, n, 150), rng.integers(0, n, 150)
+    adjacency = np.zeros((n, n), dtype=bool)
+    adjacency[a, b] = adjacency[b, a] = True
+
+    clusters = UnionFind(n)
+    clusters.union_many(a[:70], b[:70])
+    clusters.union_many(a[70:], b[70:])
+
+    np.testing.assert_array_equal(clusters.roots(), connected_components(adjacency))
+    np.testing.assert_array_equal(clusters.roots(np.array([5, 0, 5])), connected_components(adjacency)[[5, 0, 5]])
+
+
+def test_block_pairs():
+    column = np.array([3, 1, 3, 2, 3, 1, 7, 3, 3])
+    a, b, large = block_pairs(column, max_block_size=4, small_block_size=2)
+    assert sorted(zip(a.tolist(), b.tolist())) == [(1, 5)]
+    assert large == []
+
+    a, b, large = block_pairs(column, max_block_size=5, small_block_size=2)
+    assert [rows.tolist() for rows in large] == [[0, 2, 4, 7, 8]]
+
+
+@pytest.mark.parametrize('small_block_size,workers', [(32, None), (2, None), (32, 4)])
+@pytest.mark.parametrize('distance_cutoff', [0.2, 0.45])
+def test_cluster_signatures_matches_brute_force(small_block_size, workers, distance_cutoff):
+    rng = np.random.default_rng(0)
+    signatures = np.concatenate([near_duplicate_signatures(rng, 10, 6, noise=0.05),
+                                 near_duplicate_signatures(rng, 10, 6, noise=0.2),
+                                 near_duplicate_signatures(rng, 20, 1)])
+    signatures = signatures[rng.permutation(signatures.shape[0])]
+    words = signatures_to_words(signatures, 16, 63)
+
+    labels = cluster_signatures(signatures, words, distance_cutoff, small_block_size=small_block_size,
+                                chunk_size=100, workers=workers)
+
+    expected = brute_force_clusters(signatures, words, distance_cutoff)
+    assert 20 < len(np.unique(expected)) < signatures.shape[0]
+    np.testing.assert_array_equal(labels, expected)
@@ -0,0 +1,135 @@
+import threading
+import time
+
+from ClusteringPipeline import ClusteringPipeline
+import numpy as np
+
+
+class FakeSES(object):
+    N = 63
+    distance_cutoff = 0.4
+    recent_records = None
+
+
+class FakeDCA(object):
+    # records every stage call, with one unrelated signature per image; fetches wait for fetch_gate
+    def __init__(self, indexed=()):
+        self.ses = FakeSES()
+        self.fetcher = None
+        self.indexed = set(indexed)
+        self.calls = []
+        self.lock = threading.Lock()
+        self.fetch_gate = threading.Event()
+        self.fetch_gate.set()
+        self.closed = False
+        self.rng = np.random.default_rng(0)
+
+    def record(self, stage, image_url):
+        with self.lock:
+            self.calls.append((stage, image_url))
+
+    def is_indexed(self, image_url):
+        self.fetch_gate.wait()
+        self.record('fetch', image_url)
+        return image_url in self.indexed
+
+    def make_image_record(self, image_url, image_bytes=None):
+        self.record('sign', image_url)
+        with self.lock:
+            signature = self.rng.integers(-2, 3, size=648).astype('int8')
+        return {'path': image_url, 'signature': signature}
+
+    def assign_cluster_ids(self, image_url, image_record):
+        self.record('search', image_url)
+        return {0.4: 'cluster_' + image_url}, None
+
+    def claim_cluster_ids(self, image_url, image_record, cluster_ids):
+        self.record('claim', image_url)
+
+    def index_image_with_clusterid(self, image_url, image_clusterid, image_record=None, representative_hits=None):
+        self.record('index', image_url)
+
+    def memcached_insert_cluster_ids(self, image_url, cluster_ids):
+        self.record('memcached', image_url)
+
+    def close(self):
+        self.closed = True
+
+
+def test_stages_run_in_order():
+    dca = FakeDCA(indexed=['1'])
+    done = []
+    pipeline = ClusteringPipeline(dca, fetch_workers=2, sign_workers=2, search_workers=2, index_workers=2,
+                                  memcached_persist=True, on_done=lambda url, context: done.append((url, context)))
+    assert pipeline.dca.ses.recent_records is not None
+
+    urls = [str(i) for i in range(20)]
+    for url in urls:
+        pipeline.submit(url, context='message ' + url)
+    pipeline.join()
+
+    assert sorted(done) == sorted((url, 'message ' + url) for url in urls)
+    for url in urls:
+        stages = [stage for stage, image_url in dca.calls if image_url == url]
+        if url == '1':
+            assert stages == ['fetch']
+        else:
+            assert stages == ['fetch', 'sign', 'search', 'claim', 'index', 'memcached']
+    pipeline.stop()
+
+
+def test_single_workers_keep_submit_order():
+    dca = FakeDCA()
+    done = []
+    pipeline = ClusteringPipeline(dca, fetch_workers=1, sign_workers=1, search_workers=1, index_workers=1,
+                                  on_done=lambda url, context: done.append(url))
+    urls = [str(i) for i in range(10)]
+    for url in urls:
+        pipeline.submit(url)
+    pipeline.stop()
+    assert done == urls
+
+
+def test_submit_blocks_while_pipeline_is_full():
+    dca = FakeDCA()
+    dca.fetch_gate.clear()
+    pipeline = ClusteringPipeline(dca, fetch_workers=1, sign_workers=1, search_workers=1, index_workers=1,
+                                  queue_size=2)
+
+    # one image waits in the fetch worker, and two in the fetch queue
+    submitted = []
+
+    def submit_all():
+        for i in range(4):
+            pipeline.submit(str(i))
+            submitted.append(i)
+
+    submitter = threading.Thread(target=submit_all)
+    submitter.daemon = True
+    submitter.start()
+
+    deadline = time.time() + 5.
+    while len(submitted) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert submitted == [0, 1, 2]
+    assert pipeline.queues[0].qsize() == 2
+
+    dca.fetch_gate.set()
+    submitter.join(5.)
+    assert submitted == [0, 1, 2, 3]
+    pipeline.stop()
+
+
+def test_stop_drains_and_stops_workers():
+    dca = FakeDCA()
+    done = []
+    pipeline = ClusteringPipeline(dca, fetch_workers=3, sign_workers=2, search_workers=2, index_workers=2,
+                                  on_done=lambda url, context: done.append(url))
+    for i in range(10):
+        pipeline.submit(str(i))
+    pipeline.stop()
+
+    assert len(done) == 10
+    assert dca.closed
+    assert not any(t.is_alive() for t in pipeline.threads)
@@ -0,0 +1,279 @@
+import hashlib
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pymemcache')
+
+import ClusterIdStore as cluster_id_store
+import DuplicateClusterAssignment as duplicate_cluster_assignment
+from DuplicateClusterAssignment import DuplicateClusterAssignment
+from fakes import FakeElasticsearch
+from pymemcache.test.utils import MockMemcacheClient
+from signature_database_base import make_record_from_signature, normalized_distance
+from viglink_image_match.goldberg import CorruptImageError
+
+
+class Hashlib(object):
+    # cluster ids hash urls as bytes, as str is under Python 2
+    @staticmethod
+    def md5(url):
+        return hashlib.md5(url if isinstance(url, bytes) else url.encode('utf-8'))
+
+
+def md5(url):
+    return Hashlib.md5(url).hexdigest()
+
+
+@pytest.fixture
+def signatures(monkeypatch):
+    # signatures by url, which the patched make_records signs images with
+    by_url = {}
+
+    def make_records(paths, gis, k, N, workers=None, word_layout='fields', **kwargs):
+        return [make_record_from_signature(path, by_url[path], k, N, word_layout=word_layout) if path in by_url
+                else CorruptImageError() for path in paths]
+
+    monkeypatch.setattr(duplicate_cluster_assignment, 'make_records', make_records)
+    monkeypatch.setattr(duplicate_cluster_assignment, 'hashlib', Hashlib)
+    monkeypatch.setattr(cluster_id_store, 'hashlib', Hashlib)
+    monkeypatch.setattr(duplicate_cluster_assignment, 'Elasticsearch', lambda hosts: FakeElasticsearch())
+    monkeypatch.setattr(duplicate_cluster_assignment, 'memcached_client', lambda endpoints: MockMemcacheClient())
+    return by_url
+
+
+def variant(rng, signature, fraction):
+    # a near-duplicate: signature with a fraction of its entries changed
+    changed = rng.choice(signature.shape[0], int(fraction * signature.shape[0]), replace=False)
+    variant = signature.copy()
+    variant[changed] = np.where(variant[changed] == 0, 1, -variant[changed])
+    return variant
+
+
+def distance(a, b):
+    return normalized_distance(a[np.newaxis], b)[0]
+
+
+def test_batch_joins_known_and_in_batch_clusters(signatures):
+    rng = np.random.default_rng(0)
+    known, new, other = rng.integers(-2, 3, size=(3, 648)).astype('int8')
+    signatures.update({'known_0': known, 'known_1': variant(rng, known, 0.02),
+                       'new_0': new, 'new_1': variant(rng, new, 0.02), 'new_2': variant(rng, new, 0.03),
+                       'other': other})
+
+    dca = DuplicateClusterAssignment('localhost', 'images', 0.3, 'localhost')
+    assert dca.insert_and_cluster_batch(['known_0']) == [md5('known_0')]
+
+    # an already indexed url, a near-duplicate of it, a new cluster with near-duplicates later in the same batch,
+    # and an unrelated image
+    urls = ['known_0', 'new_0', 'known_1', 'new_1', 'other', 'new_2', 'new_1']
+    cluster_ids = dca.insert_and_cluster_batch(urls, memcached_persist=True)
+    assert cluster_ids == [None, md5('new_0'), md5('known_0'), md5('new_0'), md5('other'), md5('new_0'),
+                           md5('new_0')]
+
+    assert len(dca.es_client.docs['images']) == 6
+    assert dca.es_client.requests.count('msearch') == 2
+
+    dca.close()
+    assert dca.lookup_cluster_ids(['known_1', 'new_2', 'other']) == [md5('known_0'), md5('new_0'), md5('other')]
+    assert dca.memcached_client.get(md5('new_2')) == md5('new_0').encode('utf-8')
+
+
+def test_batch_writes_every_threshold(signatures):
+    rng = np.random.default_rng(1)
+    base = rng.integers(-2, 3, size=648).astype('int8')
+    close, far = variant(rng, base, 0.02), variant(rng, base, 0.08)
+    assert distance(close, base) < 0.2 < distance(far, base) < 0.4
+    signatures.update({'base': base, 'close': close, 'far': far})
+
+    dca = DuplicateClusterAssignment('localhost', 'images', [0.4, 0.2], 'localhost')
+    cluster_ids = dca.insert_and_cluster_batch(['base', 'close', 'far'], memcached_persist=True)
+    assert cluster_ids == [{0.4: md5('base'), 0.2: md5('base')},
+                           {0.4: md5('base'), 0.2: md5('base')},
+                           {0.4: md5('base'), 0.2: md5('far')}]
+    dca.close()
+
+    client = dca.memcached_client
+    for url, ids in zip(['base', 'close', 'far'], cluster_ids):
+        assert client.get(md5(url)) == ids[0.4].encode('utf-8')
+        assert client.get(md5(url) + '_0.2') == ids[0.2].encode('utf-8')
+    assert client.get(md5('far') + '_0.4') is None
+
+
+def test_cluster_metadata_uses_threshold_fields(signatures):
+    dca = DuplicateClusterAssignment('localhost', 'images', [0.4, 0.2], 'localhost')
+    assert dca.cluster_metadata({0.4: 'a', 0.2: 'b'}) == {'clusterid': 'a', 'clusterids': {'t0_4': 'a', 't0_2': 'b'}}
+
+    signatures['image'] = np.random.default_rng(2).integers(-2, 3, size=648).astype('int8')
+    dca.insert_and_cluster_batch(['image'])
+    metadata = list(dca.es_client.docs['images'].values())[0]['metadata']
+    assert metadata == {'clusterid': md5('image'), 'clusterids': {'t0_4': md5('image'), 't0_2': md5('image')}}
+    assert dca.stored_cluster_ids(metadata) == {0.4: md5('image'), 0.2: md5('image')}
+
+    single = DuplicateClusterAssignment('localhost', 'images', 0.4, 'localhost')
+    assert single.cluster_metadata({0.4: 'a'}) == {'clusterid': 'a'}
+
+
+def test_legacy_documents_vote_at_the_primary_threshold(signatures):
+    rng = np.random.default_rng(3)
+    base = rng.integers(-2, 3, size=648).astype('int8')
+    signatures.update({'new': variant(rng, base, 0.01), 'other': variant(rng, base, 0.01)})
+
+    dca = DuplicateClusterAssignment('localhost', 'images', [0.4, 0.2], 'localhost')
+
+    # indexed before there were several thresholds
+    legacy = make_record_from_signature('legacy', base, dca.ses.k, dca.ses.N, metadata={'clusterid': 'legacy'})
+    dca.ses.insert_single_record(legacy)
+    assert dca.stored_cluster_ids({'clusterid': 'legacy'}) == {0.4: 'legacy', 0.2: None}
+
+    search_results = [{'dist': 0.05, 'metadata': {'clusterid': 'legacy'}},
+                      {'dist': 0.05, 'metadata': {'clusterid': 'legacy'}},
+                      {'dist': 0.1, 'metadata': dca.cluster_metadata({0.4: 'a', 0.2: 'b'})}]
+    assert dca.get_cluster_ids(search_results, 'image') == {0.4: 'legacy', 0.2: 'b'}
+
+    assert dca.insert_and_cluster_batch(['new', 'other']) == [{0.4: 'legacy', 0.2: md5('new')},
+                                                             {0.4: 'legacy', 0.2: md5('new')}]
+
+
+def clustered_signatures(rng, sizes, fraction=0.02):
+    # urls and signatures of clusters of near-duplicates, named <cluster>_<member>
+    by_url = {}
+    for cluster, size in enumerate(sizes):
+        base = rng.integers(-2, 3, size=648).astype('int8')
+        for member in range(size):
+            by_url['%d_%d' % (cluster, member)] = variant(rng, base, fraction) if member else base
+    return by_url
+
+
+def first_urls(urls):
+    # the first url of every cluster, in the order of urls
+    first = {}
+    for url in urls:
+        first.setdefault(url.split('_')[0], url)
+    return first
+
+
+def test_backfill_cluster_ids_are_md5_of_the_first_url(signatures):
+    rng = np.random.default_rng(4)
+    signatures.update(clustered_signatures(rng, [4, 3, 1]))
+
+    for order in range(2):
+        urls = sorted(signatures)
+        rng.shuffle(urls)
+        dca = DuplicateClusterAssignment('localhost', 'images', 0.3, 'localhost', recent_ttl=None)
+        cluster_ids = dca.backfill(urls + ['missing'], chunk_size=3, memcached_persist=True)
+        dca.close()
+
+        first = first_urls(urls)
+        assert cluster_ids == [md5(first[url.split('_')[0]]) for url in urls] + [None]
+        assert len(dca.es_client.docs['images']) == len(urls)
+        for url, cluster_id in zip(urls, cluster_ids):
+            assert dca.memcached_client.get(md5(url)) == cluster_id.encode('utf-8')
+
+
+def test_backfill_keeps_stored_cluster_ids(signatures):
+    rng = np.random.default_rng(5)
+    signatures.update(clustered_signatures(rng, [3, 2]))
+
+    # at the second threshold, every image is a cluster of its own
+    dca = DuplicateClusterAssignment('localhost', 'images', [0.3, 0.01], 'localhost', recent_ttl=None)
+    indexed = make_record_from_signature('0_0', signatures.pop('0_0'), dca.ses.k, dca.ses.N,
+                                         metadata={'clusterid': 'stored'})
+    dca.ses.insert_single_record(dict(indexed))
+    document = dict(list(dca.es_client.docs['images'].values())[0])
+
+    # 0_0 is not signed again: make_records has no signature for it
+    cluster_ids = dca.backfill(['0_0', '0_1', '1_0', '0_2', '1_1'], memcached_persist=True)
+    dca.close()
+
+    assert cluster_ids == [{0.3: 'stored', 0.01: None},
+                           {0.3: md5('0_1'), 0.01: md5('0_1')},
+                           {0.3: md5('1_0'), 0.01: md5('1_0')},
+                           {0.3: md5('0_1'), 0.01: md5('0_2')},
+                           {0.3: md5('1_0'), 0.01: md5('1_1')}]
+    assert list(dca.es_client.docs['images'].values())[0] == document
+    assert len(dca.es_client.docs['images']) == 5
+
+    # incomplete stored cluster ids are not written to memcached
+    assert dca.memcached_client.get(md5('0_0')) is None
+    assert dca.memcached_client.get(md5('0_2')) == md5('0_1').encode('utf-8')
+    assert dca.memcached_client.get(md5('0_2') + '_0.01') == md5('0_2').encode('utf-8')
+
+
+def test_backfill_representatives(signatures):
+    rng = np.random.default_rng(6)
+    signatures.update(clustered_signatures(rng, [5, 1]))
+    urls = sorted(signatures)
+
+    dca = DuplicateClusterAssignment('localhost', 'images', 0.3, 'localhost', recent_ttl=None, max_representatives=2)
+    cluster_ids = dca.backfill(urls, chunk_size=2)
+
+    representatives = list(dca.es_client.docs['images_representatives'].values())
+    by_cluster = {}
+    for representative in representatives:
+        by_cluster.setdefault(representative['metadata']['clusterid'], []).append(representative['path'])
+    assert sorted(by_cluster) == sorted(set(cluster_ids))
+    assert all(1 <= len(paths) <= 2 for paths in by_cluster.values())
+    for cluster_id, paths in by_cluster.items():
+        assert all(cluster_ids[urls.index(path)] == cluster_id for path in paths)
+
+
+def test_backfill_script(signatures, monkeypatch, tmpdir):
+    import Backfill
+
+    class Fetcher(object):
+        def __init__(self, workers=None):
+            pass
+
+        def fetch_many(self, urls):
+            return [b'image' for _ in urls]
+
+    es, client = FakeElasticsearch(), MockMemcacheClient()
+    monkeypatch.setattr(Backfill, 'ImageFetcher', Fetcher)
+    monkeypatch.setattr(duplicate_cluster_assignment, 'Elasticsearch', lambda hosts: es)
+    monkeypatch.setattr(duplicate_cluster_assignment, 'memcached_client', lambda endpoints: client)
+
+    signatures.update(clustered_signatures(np.random.default_rng(7), [2, 1], fraction=0.005))
+    url_file = tmpdir.join('urls.txt')
+    url_file.write('0_1\n\n1_0\n0_0\n')
+
+    Backfill.backfill(str(url_file), 'localhost', 'localhost', sign_workers=1, cluster_workers=1)
+
+    assert len(es.docs['images_0.1']) == 3
+    assert client.get(md5('0_0')) == client.get(md5('0_1')) == md5('0_1').encode('utf-8')
+    assert client.get(md5('1_0')) == md5('1_0').encode('utf-8')
+
+
+def test_pipeline_clusters_concurrent_near_duplicates(signatures):
+    from ClusteringPipeline import ClusteringPipeline
+
+    signatures.update(clustered_signatures(np.random.default_rng(8), [3]))
+    urls = sorted(signatures)
+
+    dca = DuplicateClusterAssignment('localhost', 'images', 0.3, 'localhost')
+    dca.make_image_record = lambda url, image_bytes=None: make_record_from_signature(url, signatures[url],
+                                                                                    dca.ses.k, dca.ses.N)
+
+    # every first search finishes before any image is assigned
+    barrier = threading.Barrier(len(urls), timeout=5.)
+    searched = set()
+    get_near_duplicates = dca.get_near_duplicates
+
+    def search(image_url, **kwargs):
+        results = get_near_duplicates(image_url, **kwargs)
+        if image_url not in searched:
+            searched.add(image_url)
+            barrier.wait()
+        return results
+
+    dca.get_near_duplicates = search
+
+    pipeline = ClusteringPipeline(dca, search_workers=len(urls), memcached_persist=True)
+    for url in urls:
+        pipeline.submit(url)
+    pipeline.stop()
+
+    cluster_ids = dca.lookup_cluster_ids(urls)
+    assert len(set(cluster_ids)) == 1
+    assert cluster_ids[0] in [md5(url) for url in urls]
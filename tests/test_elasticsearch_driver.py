@@ -0,0 +1,94 @@
+from elasticsearch_driver import SignatureES
+from fakes import FakeElasticsearch
+from recent_records import RecentRecords
+from signature_database_base import make_record_from_signature
+from test_embedded_driver import near_duplicate_signatures, records
+import numpy as np
+import pytest
+
+
+def result_key(results):
+    return sorted((result['id'], result['score'], round(result['dist'], 12)) for result in results)
+
+
+@pytest.mark.parametrize('word_layout,packed_signatures', [('fields', False), ('tokens', False),
+                                                            ('fields', True)])
+def test_search_records_matches_search_single_record(word_layout, packed_signatures):
+    rng = np.random.default_rng(0)
+    es = FakeElasticsearch()
+    ses = SignatureES(es, distance_cutoff=0.45, word_layout=word_layout, packed_signatures=packed_signatures)
+    recs = records(near_duplicate_signatures(rng, 8, 5), word_layout=word_layout)
+    for rec in recs:
+        ses.insert_single_record(dict(rec))
+
+    queries = records(near_duplicate_signatures(np.random.default_rng(0), 8, 5, noise=0.15),
+                      word_layout=word_layout)[::3]
+    del es.requests[:]
+    batched = ses.search_records(queries)
+    assert es.requests == ['msearch']
+
+    assert len(batched) == len(queries)
+    for query, results in zip(queries, batched):
+        expected = ses.search_single_record(dict(query))
+        assert len(expected) > 0
+        assert result_key(results) == result_key(expected)
+        for result in results:
+            assert result['metadata'] == {'i': int(result['path'].split('_')[1])}
+
+    assert ses.search_records([]) == []
+
+
+def test_packed_signatures_are_reranked_without_unpacking(monkeypatch):
+    import elasticsearch_driver
+
+    recs = records(near_duplicate_signatures(np.random.default_rng(1), 6, 4))
+    queries = records(near_duplicate_signatures(np.random.default_rng(1), 6, 4, noise=0.15))[::2]
+    drivers = [SignatureES(FakeElasticsearch(), distance_cutoff=0.45, packed_signatures=packed)
+               for packed in [False, True]]
+    for ses in drivers:
+        for rec in recs:
+            ses.insert_single_record(dict(rec))
+
+    expected = [result_key(results) for results in drivers[0].search_records(queries)]
+
+    monkeypatch.setattr(elasticsearch_driver, 'unpack_signatures', None)
+    assert [result_key(results) for results in drivers[1].search_records(queries)] == expected
+    assert [result_key(drivers[1].search_single_record(dict(query))) for query in queries] == expected
+    assert all(len(results) > 0 for results in expected)
+
+
+def test_create_index():
+    es = FakeElasticsearch()
+    ses = SignatureES(es, index='images_0.1', distance_cutoff=0.1)
+
+    assert ses.create_index(shards=1, replicas=0)
+    assert es.indices.mappings['images_0.1'] == {'image': ses.index_mapping()}
+    assert ses.verify_mapping() == []
+
+    # a second worker finds the index, and checks its mapping
+    assert not SignatureES(es, index='images_0.1', distance_cutoff=0.1).create_index()
+
+
+def test_create_index_created_concurrently(monkeypatch):
+    es = FakeElasticsearch()
+    SignatureES(es, index='images', distance_cutoff=0.1).create_index()
+
+    # the index appears between the existence check and the create request
+    monkeypatch.setattr(es.indices, 'exists', lambda index: False)
+    ses = SignatureES(es, index='images', distance_cutoff=0.1, packed_signatures=True)
+    assert not ses.create_index()
+    assert ses.verify_mapping() == ['signature']
+
+
+@pytest.mark.parametrize('word_layout', ['fields', 'tokens'])
+def test_recent_records_with_driver_word_count(word_layout):
+    es = FakeElasticsearch()
+    ses = SignatureES(es, distance_cutoff=0.45, N=31, word_layout=word_layout)
+    ses.recent_records = RecentRecords(N=ses.N)
+    recs = [make_record_from_signature('image_%d' % i, signature, ses.k, ses.N, word_layout=word_layout)
+            for i, signature in enumerate(near_duplicate_signatures(np.random.default_rng(0), 4, 2))]
+    for rec in recs:
+        ses.insert_single_record(dict(rec))
+
+    for rec, results in zip(recs, ses.recent_records.search(recs, ses.distance_cutoff)):
+        assert [result['score'] for result in results if result['path'] == rec['path']] == [ses.N]
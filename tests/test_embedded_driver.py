@@ -0,0 +1,168 @@
+from embedded_driver import SignatureEmbedded
+from signature_database_base import make_record_from_signature
+from signature_database_base import normalized_distance
+from signature_database_base import signatures_to_words
+import numpy as np
+
+
+def near_duplicate_signatures(rng, n_clusters, per_cluster, noise=0.1):
+    bases = rng.integers(-2, 3, size=(n_clusters, 648)).astype('int8')
+    signatures = np.repeat(bases, per_cluster, axis=0)
+    changed = rng.random(signatures.shape) < noise
+    signatures[changed] = rng.integers(-2, 3, size=np.sum(changed))
+    return signatures[rng.permutation(signatures.shape[0])]
+
+
+def records(signatures, word_layout='fields'):
+    return [make_record_from_signature('image_%d' % i, signature, 16, 63, metadata={'i': i},
+                                       word_layout=word_layout)
+            for i, signature in enumerate(signatures)]
+
+
+def rebuilt_postings(ses):
+    # inverted index built from scratch, as a reference
+    keys = (np.arange(ses.N, dtype=np.int64) * ses.word_base + ses.words).ravel()
+    order = np.argsort(keys, kind='mergesort')
+    posting_keys, starts = np.unique(keys[order], return_index=True)
+    return posting_keys, np.append(starts, keys.shape[0]), order // ses.N
+
+
+def brute_force_search(signatures, rec, distance_cutoff):
+    words = signatures_to_words(signatures, 16, 63)
+    counts = np.sum(words == signatures_to_words(np.array(rec['signature']), 16, 63), axis=1)
+    dists = normalized_distance(signatures, np.array(rec['signature']))
+    return dict((int(row), int(counts[row])) for row in np.flatnonzero((counts > 0) & (dists < distance_cutoff)))
+
+
+def test_incremental_merges_match_a_full_rebuild():
+    rng = np.random.default_rng(0)
+    signatures = near_duplicate_signatures(rng, 20, 10)
+    ses = SignatureEmbedded(merge_threshold=37, distance_cutoff=0.45, size=1000)
+
+    for rec in records(signatures):
+        ses.insert_single_record(rec)
+    ses.merge()
+
+    posting_keys, posting_starts, posting_rows = rebuilt_postings(ses)
+    assert np.array_equal(ses.posting_keys, posting_keys)
+    assert np.array_equal(ses.posting_starts, posting_starts)
+    assert np.array_equal(ses.posting_rows, posting_rows)
+    assert np.array_equal(ses.signatures, signatures)
+
+
+def test_search_matches_brute_force_with_pending_images():
+    rng = np.random.default_rng(1)
+    signatures = near_duplicate_signatures(rng, 15, 8)
+    ses = SignatureEmbedded(merge_threshold=50, distance_cutoff=0.45, size=1000)
+
+    recs = records(signatures, word_layout='tokens')
+    for rec in recs:
+        ses.insert_single_record(rec)
+    assert ses.n_pending > 0
+
+    for rec in recs[::7]:
+        expected = brute_force_search(signatures, rec, 0.45)
+        results = ses.search_single_record(rec)
+        assert dict((result['id'], result['score']) for result in results) == expected
+        for result in results:
+            assert result['path'] == 'image_%d' % result['id']
+            assert result['metadata'] == {'i': result['id']}
+
+
+def test_search_exact_matches_brute_force():
+    rng = np.random.default_rng(2)
+    signatures = near_duplicate_signatures(rng, 10, 6, noise=0.3)
+    ses = SignatureEmbedded(distance_cutoff=0.3)
+    recs = records(signatures)
+    for rec in recs:
+        ses.insert_single_record(rec)
+
+    for rec, matches in zip(recs, ses.search_exact(recs)):
+        dists = normalized_distance(signatures, np.array(rec['signature']))
+        assert sorted(match['id'] for match in matches) == list(np.flatnonzero(dists < 0.3))
+        for match in matches:
+            assert np.isclose(match['dist'], dists[match['id']])
+
+    assert 0. <= ses.recall(recs) <= 1.
+
+
+def test_save_and_load(tmpdir):
+    rng = np.random.default_rng(3)
+    signatures = near_duplicate_signatures(rng, 5, 4)
+    ses = SignatureEmbedded(path=str(tmpdir), distance_cutoff=0.45)
+    recs = records(signatures)
+    for rec in recs:
+        ses.insert_single_record(rec)
+    ses.save()
+
+    loaded = SignatureEmbedded(path=str(tmpdir), distance_cutoff=0.45)
+    assert len(loaded) == len(recs)
+    for rec in recs:
+        assert loaded.search_single_record(dict(rec)) == ses.search_single_record(dict(rec))
+
+
+def test_load_index_saved_without_norms(tmpdir):
+    rng = np.random.default_rng(4)
+    signatures = near_duplicate_signatures(rng, 5, 4)
+    ses = SignatureEmbedded(path=str(tmpdir), distance_cutoff=0.45)
+    recs = records(signatures)
+    for rec in recs:
+        ses.insert_single_record(rec)
+    ses.save()
+    tmpdir.join('signature_squared_norms.npy').remove()
+
+    loaded = SignatureEmbedded(path=str(tmpdir), distance_cutoff=0.45)
+    assert np.array_equal(loaded.signature_squared_norms, np.sum(signatures.astype(int)**2, axis=1))
+    for rec in recs:
+        assert loaded.search_single_record(dict(rec)) == ses.search_single_record(dict(rec))
+
+
+def test_save_over_memory_mapped_index(tmpdir):
+    rng = np.random.default_rng(5)
+    signatures = near_duplicate_signatures(rng, 10, 4)
+    ses = SignatureEmbedded(path=str(tmpdir), distance_cutoff=0.45)
+    recs = records(signatures)
+    for rec in recs[:30]:
+        ses.insert_single_record(rec)
+    ses.save()
+
+    # nothing pending: every array is still a memory map of the file it is saved to
+    loaded = SignatureEmbedded(path=str(tmpdir), distance_cutoff=0.45)
+    assert isinstance(loaded.signatures, np.memmap)
+    loaded.save()
+
+    reloaded = SignatureEmbedded(path=str(tmpdir), distance_cutoff=0.45)
+    assert np.array_equal(reloaded.signatures, signatures[:30])
+    assert not [name for name in tmpdir.listdir() if name.ext == '.tmp']
+
+    # and with pending images on top of the memory-mapped segment
+    for rec in recs[30:]:
+        reloaded.insert_single_record(rec)
+    reloaded.save()
+    reloaded = SignatureEmbedded(path=str(tmpdir), distance_cutoff=0.45)
+    assert np.array_equal(reloaded.signatures, signatures)
+    for rec in recs[::5]:
+        results = reloaded.search_single_record(dict(rec))
+        assert dict((result['id'], result['score']) for result in results) == \
+            brute_force_search(signatures, rec, 0.45)
+
+
+def test_search_image_in_all_orientations():
+    from test_goldberg import orientations, png_bytes, smooth_image
+
+    rng = np.random.default_rng(6)
+    image = smooth_image(rng, 300, 400)
+    ses = SignatureEmbedded(distance_cutoff=0.1)
+    for i, transformed in enumerate(orientations(image)):
+        ses.add_image('orientation_%d' % i, img=png_bytes(transformed), bytestream=True)
+    ses.add_image('inverted', img=png_bytes(255 - image), bytestream=True)
+
+    results = ses.search_image(png_bytes(image), bytestream=True, all_orientations=True)
+    assert sorted(result['path'] for result in results) == sorted(['orientation_%d' % i for i in range(8)] +
+                                                                  ['inverted'])
+    assert all(result['dist'] == 0. for result in results)
+
+    assert [result['path'] for result in ses.search_image(png_bytes(image), bytestream=True)] == ['orientation_0']
+    approximate = ses.search_image(png_bytes(image), bytestream=True, all_orientations=True,
+                                   approximate_orientations=True)
+    assert set(['orientation_0', 'inverted']) <= set(result['path'] for result in approximate)
@@ -0,0 +1,91 @@
+from fetcher import ImageFetcher, FetchError
+from threading import Thread
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import pytest
+
+
+IMAGE = b'\x89PNG' + b'x' * 1000
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/image.png':
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(IMAGE)))
+            self.end_headers()
+            self.wfile.write(IMAGE)
+        elif self.path == '/unsized.png':
+            # no content-length, so the size is only known while streaming
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(IMAGE)
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetch(server):
+    fetcher = ImageFetcher(workers=2, retries=0)
+    try:
+        assert fetcher.fetch(server + '/image.png') == IMAGE
+        assert fetcher.fetch(server + '/unsized.png') == IMAGE
+    finally:
+        fetcher.close()
+
+
+def test_fetch_not_found(server):
+    fetcher = ImageFetcher(workers=2, retries=0)
+    try:
+        with pytest.raises(FetchError):
+            fetcher.fetch(server + '/missing.png')
+    finally:
+        fetcher.close()
+
+
+def test_fetch_max_bytes(server):
+    fetcher = ImageFetcher(workers=2, retries=0, max_bytes=len(IMAGE) - 1)
+    try:
+        with pytest.raises(FetchError):
+            fetcher.fetch(server + '/image.png')
+        with pytest.raises(FetchError):
+            fetcher.fetch(server + '/unsized.png')
+    finally:
+        fetcher.close()
+
+    fetcher = ImageFetcher(workers=2, retries=0, max_bytes=len(IMAGE))
+    try:
+        assert fetcher.fetch(server + '/image.png') == IMAGE
+    finally:
+        fetcher.close()
+
+
+def test_fetch_many(server):
+    fetcher = ImageFetcher(workers=4, retries=0)
+    try:
+        results = fetcher.fetch_many([server + '/image.png', server + '/missing.png', server + '/unsized.png'])
+        assert results[0] == IMAGE
+        assert isinstance(results[1], FetchError)
+        assert results[2] == IMAGE
+
+        assert [url for url, _ in fetcher.imap([server + '/image.png', server + '/missing.png'])] == \
+            [server + '/image.png', server + '/missing.png']
+    finally:
+        fetcher.close()
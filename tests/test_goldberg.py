@@ -0,0 +1,215 @@
+from goldberg import ImageSignature, CorruptImageError, _downscaled_grey
+import numpy as np
+import pytest
+
+
+def per_window_mean_level(image, x_coords, y_coords, P=None):
+    # the original compute_mean_level, one np.mean per grid point
+    if P is None:
+        P = max([2.0, int(0.5 + min(image.shape)/20.)])
+
+    avg_grey = np.zeros((x_coords.shape[0], y_coords.shape[0]))
+
+    for i, x in enumerate(x_coords):
+        lower_x_lim = int(max([x - P/2, 0]))
+        upper_x_lim = int(min([lower_x_lim + P, image.shape[0]]))
+        for j, y in enumerate(y_coords):
+            lower_y_lim = int(max([y - P/2, 0]))
+            upper_y_lim = int(min([lower_y_lim + P, image.shape[1]]))
+
+            avg_grey[i, j] = np.mean(image[lower_x_lim:upper_x_lim,
+                                     lower_y_lim:upper_y_lim])
+
+    return avg_grey
+
+
+def assert_same_levels(levels, expected, dtype=np.float64):
+    # integer images are summed exactly; float ones up to rounding
+    if np.issubdtype(dtype, np.integer):
+        assert np.array_equal(levels, expected)
+    else:
+        np.testing.assert_allclose(levels, expected, rtol=1e-6 if dtype == np.float32 else 1e-12)
+
+
+def random_image(rng, dtype):
+    shape = rng.integers(10, 900, size=2)
+    image = rng.random(shape)
+    if dtype == np.uint8:
+        return (image * 255).astype(np.uint8)
+    return image.astype(dtype)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.uint8])
+def test_mean_level_matches_per_window_mean(dtype):
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        image = random_image(rng, dtype)
+        x_coords, y_coords = ImageSignature.compute_grid_points(image, window=ImageSignature.crop_image(image))
+
+        expected = per_window_mean_level(image, x_coords, y_coords)
+        assert_same_levels(ImageSignature.compute_mean_level(image, x_coords, y_coords), expected, dtype)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.uint8])
+def test_mean_level_matches_per_window_mean_for_large_boxes(dtype):
+    rng = np.random.default_rng(1)
+    image = (rng.random((700, 500)) * 255).astype(dtype)
+    x_coords, y_coords = ImageSignature.compute_grid_points(image)
+
+    for P in [2, 3, 17, 95, 160]:
+        expected = per_window_mean_level(image, x_coords, y_coords, P=P)
+        assert_same_levels(ImageSignature.compute_mean_level(image, x_coords, y_coords, P=P), expected, dtype)
+
+
+def test_mean_level_matches_per_window_mean_on_a_large_image():
+    rng = np.random.default_rng(7)
+    image = rng.random((3000, 4000))
+    x_coords, y_coords = ImageSignature.compute_grid_points(image, window=ImageSignature.crop_image(image))
+
+    expected = per_window_mean_level(image, x_coords, y_coords)
+    assert_same_levels(ImageSignature.compute_mean_level(image, x_coords, y_coords), expected)
+
+
+def test_mean_level_of_a_stack():
+    rng = np.random.default_rng(2)
+    images = rng.random((3, 300, 400))
+    grids = [ImageSignature.compute_grid_points(image, window=ImageSignature.crop_image(image))
+             for image in images]
+    x_coords = np.array([grid[0] for grid in grids])
+    y_coords = np.array([grid[1] for grid in grids])
+
+    levels = ImageSignature.compute_mean_level(images, x_coords, y_coords)
+    for image, (x, y), level in zip(images, grids, levels):
+        assert_same_levels(level, per_window_mean_level(image, x, y))
+
+    shared = ImageSignature.compute_mean_level(images, grids[0][0], grids[0][1])
+    for image, level in zip(images, shared):
+        assert_same_levels(level, per_window_mean_level(image, grids[0][0], grids[0][1]))
+
+
+def test_signatures_of_noise_are_unchanged(monkeypatch):
+    rng = np.random.default_rng(3)
+    images = [rng.integers(0, 256, size=(200, 300, 3)).astype(np.uint8) for _ in range(20)]
+
+    gis = ImageSignature()
+    signatures = [gis.generate_signature(image) for image in images]
+
+    monkeypatch.setattr(ImageSignature, 'compute_mean_level', staticmethod(per_window_mean_level))
+    for image, signature in zip(images, signatures):
+        assert np.array_equal(signature, gis.generate_signature(image))
+
+
+def png_bytes(image):
+    from PIL import Image
+    from io import BytesIO
+
+    buf = BytesIO()
+    Image.fromarray(image).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def test_generate_signatures_matches_generate_signature():
+    rng = np.random.default_rng(4)
+    images = [png_bytes(rng.integers(0, 256, size=(120, 160, 3)).astype(np.uint8)) for _ in range(6)]
+    images.insert(2, b'not an image')
+
+    gis = ImageSignature()
+    for workers in [None, 2]:
+        signatures = gis.generate_signatures(images, bytestream=True, workers=workers)
+
+        assert len(signatures) == len(images)
+        assert isinstance(signatures[2], CorruptImageError)
+        for image, signature in zip(images[:2] + images[3:], signatures[:2] + signatures[3:]):
+            assert np.array_equal(signature, gis.generate_signature(image, bytestream=True))
+
+
+def smooth_image(rng, height, width):
+    from PIL import Image
+
+    small = rng.integers(0, 256, size=(6, 8, 3)).astype(np.uint8)
+    return np.asarray(Image.fromarray(small).resize((width, height), Image.BILINEAR))
+
+
+def orientations(image):
+    # the image rotated by 90 * (i / 2) degrees and, for odd i, mirrored left to right
+    rotated = [np.rot90(image, i // 2) for i in range(8)]
+    return [np.ascontiguousarray(np.fliplr(r) if i % 2 else r) for i, r in enumerate(rotated)]
+
+
+def test_orientation_signatures_are_signatures_of_transformed_images():
+    rng = np.random.default_rng(5)
+    gis = ImageSignature()
+    for shape in [(300, 400), (333, 333)]:
+        image = smooth_image(rng, *shape)
+        signatures = gis.generate_orientation_signatures(image)
+
+        assert signatures.shape == (16, 648)
+        for i, transformed in enumerate(orientations(image)):
+            assert np.array_equal(signatures[i], gis.generate_signature(transformed))
+            assert np.array_equal(signatures[8 + i], gis.generate_signature(255 - transformed))
+
+        assert np.array_equal(gis.generate_orientation_signatures(png_bytes(image), bytestream=True), signatures)
+
+
+def test_approximate_orientation_signatures():
+    rng = np.random.default_rng(6)
+    gis = ImageSignature()
+    image = smooth_image(rng, 300, 400)
+    exact = gis.generate_orientation_signatures(image)
+    approximate = gis.generate_orientation_signatures(image, approximate=True)
+
+    assert np.array_equal(approximate, gis.compute_orientation_signatures(exact[0]))
+
+    # identity and inversion are exact, rotations and mirror images only approximate
+    dists = np.array([gis.normalized_distance(a, b) for a, b in zip(approximate, exact)])
+    assert dists[0] == dists[8] == 0.
+    assert np.all(dists < 0.2)
+    assert np.max(dists) > 0.
+
+
+def jpeg_bytes(image):
+    from PIL import Image
+    from io import BytesIO
+
+    buf = BytesIO()
+    Image.fromarray(image).save(buf, format='JPEG', quality=90)
+    return buf.getvalue()
+
+
+def test_downscaled_grey_decodes_jpegs_in_draft_mode():
+    from PIL import Image
+    from io import BytesIO
+
+    image = smooth_image(np.random.default_rng(6), 1200, 1600)
+    for data, decoded_size in [(jpeg_bytes(image), (400, 300)), (png_bytes(image), (1600, 1200))]:
+        img = Image.open(BytesIO(data))
+        grey = _downscaled_grey(img, 300)
+
+        # libjpeg scales by 1/4 while decoding, and the rest is resized
+        assert img.size == decoded_size
+        assert grey.shape == (225, 300)
+        assert grey.dtype == np.float32
+        assert 0. <= grey.min() and grey.max() <= 1.
+        full = ImageSignature.preprocess_image(data, bytestream=True)
+        assert abs(grey.mean() - full.mean()) < 0.01
+
+
+def test_preprocess_image_with_max_size():
+    image = smooth_image(np.random.default_rng(7), 600, 450)
+    grey = ImageSignature.preprocess_image(jpeg_bytes(image), bytestream=True, max_size=200)
+    assert grey.shape == (200, 150)
+    assert grey.dtype == np.float32
+
+    # smaller images and arrays are not resized
+    assert ImageSignature.preprocess_image(png_bytes(image), bytestream=True, max_size=1000).shape == (600, 450)
+    assert ImageSignature.preprocess_image(image, max_size=200).shape == (600, 450)
+
+
+def test_downscale_drift_is_bounded():
+    rng = np.random.default_rng(8)
+    images = [jpeg_bytes(smooth_image(rng, 1200, 1600)) for _ in range(3)]
+
+    drift = ImageSignature(max_size=512).downscale_drift(images, bytestream=True)
+    assert drift.shape == (3,)
+    assert np.all(drift < 0.11)
+    assert np.all(ImageSignature().downscale_drift(images, bytestream=True) == 0.)
@@ -0,0 +1,95 @@
+from elasticsearch_driver import SignatureES
+from fakes import FakeElasticsearch
+from representatives import ClusterRepresentatives
+from test_embedded_driver import near_duplicate_signatures, records
+import numpy as np
+
+
+def representatives(max_representatives=3):
+    ses = SignatureES(FakeElasticsearch(), index='images_representatives', distance_cutoff=1.5 * 0.4, path_ids=True)
+    return ClusterRepresentatives(ses, 0.4, max_representatives=max_representatives)
+
+
+def test_near_duplicates_falls_back_without_hits():
+    reps = representatives()
+    rec = records(near_duplicate_signatures(np.random.default_rng(0), 1, 1))[0]
+    assert reps.near_duplicates(rec) is None
+    assert reps.near_duplicates(rec, hits=[]) is None
+
+
+def test_near_duplicates_of_one_cluster():
+    reps = representatives()
+    recs = records(near_duplicate_signatures(np.random.default_rng(0), 2, 3, noise=0.05))
+    reps.add_member(recs[0], 'a')
+
+    hits = reps.search(recs[0])
+    assert reps.near_duplicates(recs[0], hits=hits) == [{'clusterid': 'a'}]
+    assert reps.near_duplicates(recs[0], hits=hits + [dict(hits[0], metadata={'clusterid': 'b'})]) is None
+
+
+def test_add_member_with_hits_does_not_search():
+    reps = representatives(max_representatives=2)
+    recs = records(near_duplicate_signatures(np.random.default_rng(0), 1, 3, noise=0.05))
+    assert reps.add_member(recs[0], 'a', hits=[])
+
+    del reps.ses.es.requests[:]
+    assert not reps.add_member(recs[1], 'a', hits=[{'path': recs[0]['path'], 'dist': 0.01,
+                                                    'metadata': {'clusterid': 'a'}}])
+    assert reps.ses.es.requests == []
+
+
+class UnrefreshedElasticsearch(FakeElasticsearch):
+    # documents indexed since the last refresh are stored, but neither searched nor counted
+    def __init__(self):
+        FakeElasticsearch.__init__(self)
+        self.refreshed = set()
+
+    def refresh(self):
+        self.refreshed = set((index, doc_id) for index, docs in self.docs.items() for doc_id in docs)
+
+    def _matching(self, index, query):
+        return [match for match in FakeElasticsearch._matching(self, index, query)
+                if (index, match[0]) in self.refreshed]
+
+
+def test_burst_of_members_stops_at_max_representatives():
+    es = UnrefreshedElasticsearch()
+    ses = SignatureES(es, index='images_representatives', distance_cutoff=1.5 * 0.4, path_ids=True)
+    reps = ClusterRepresentatives(ses, 0.4, max_representatives=2)
+
+    # unrelated images, so that none is within spread of another
+    recs = records(near_duplicate_signatures(np.random.default_rng(0), 6, 1))
+    assert reps.add_member(recs[0], 'a', hits=[])
+    es.refresh()
+
+    # a fresh process, whose searches find none of the burst
+    reps = ClusterRepresentatives(ses, 0.4, max_representatives=2)
+    del es.requests[:]
+    added = [reps.add_member(rec, 'a', hits=[]) for rec in recs[1:4]]
+    assert added == [True, False, False]
+    assert reps.add_member(recs[4], 'b', hits=[]) and reps.add_member(recs[5], 'b', hits=[])
+    assert len(es.docs['images_representatives']) == 4
+
+    # one count of each cluster, seeded from the index
+    assert es.requests.count('search') == 2
+    assert 'count' not in es.requests
+    assert reps.counts(['a', 'b', 'c']) == {'a': 2, 'b': 2, 'c': 0}
+
+
+def test_counts_are_seeded_with_one_aggregation():
+    es = FakeElasticsearch()
+    ses = SignatureES(es, index='images_representatives', distance_cutoff=1.5 * 0.4, path_ids=True)
+    recs = records(near_duplicate_signatures(np.random.default_rng(1), 2, 3, noise=0.3))
+    ClusterRepresentatives(ses, 0.4).add_cluster(recs[:3], 'a')
+    ClusterRepresentatives(ses, 0.4).add_cluster(recs[3:4], 'b')
+
+    reps = ClusterRepresentatives(ses, 0.4, max_clusters=2)
+    stored = len([doc for doc in es.docs['images_representatives'].values() if doc['metadata']['clusterid'] == 'a'])
+    del es.requests[:]
+    assert reps.counts(['a', 'b', 'c', 'b']) == {'a': stored, 'b': 1, 'c': 0}
+    assert es.requests == ['search']
+
+    # the least recently used cluster was dropped, and is counted again
+    assert reps.counts(['b', 'c']) == {'b': 1, 'c': 0}
+    assert reps.counts(['a']) == {'a': stored}
+    assert es.requests == ['search', 'search']
@@ -0,0 +1,276 @@
+from goldberg import ImageSignature, CorruptImageError
+from signature_database_base import SignatureCache
+from signature_database_base import exact_matches
+from signature_database_base import get_words
+from signature_database_base import make_record
+from signature_database_base import make_record_from_signature
+from signature_database_base import make_records
+from signature_database_base import max_contrast
+from signature_database_base import normalized_distance
+from signature_database_base import normalized_distances
+from signature_database_base import pack_signatures
+from signature_database_base import packed_normalized_distance
+from signature_database_base import packed_squared_norms
+from signature_database_base import paired_normalized_distance
+from signature_database_base import signature_fingerprint
+from signature_database_base import signatures_to_words
+from signature_database_base import squared_norms
+from signature_database_base import unpack_signatures
+from signature_database_base import words_to_int
+from test_goldberg import png_bytes
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('word_layout', ['fields', 'tokens'])
+def test_make_records_matches_make_record(word_layout):
+    rng = np.random.default_rng(0)
+    images = [png_bytes(rng.integers(0, 256, size=(90, 130, 3)).astype(np.uint8)) for _ in range(5)]
+    images[3] = b'not an image'
+    paths = ['image_%d' % i for i in range(len(images))]
+    metadatas = [{'i': i} for i in range(len(images))]
+
+    gis = ImageSignature()
+    recs = make_records(paths, gis, 16, 63, imgs=images, bytestream=True, metadatas=metadatas, workers=2,
+                        word_layout=word_layout)
+
+    assert isinstance(recs[3], CorruptImageError)
+    for i in [0, 1, 2, 4]:
+        expected = make_record(paths[i], gis, 16, 63, img=images[i], bytestream=True, metadata=metadatas[i],
+                               word_layout=word_layout)
+        assert set(recs[i]) == set(expected)
+        for key in expected:
+            assert np.array_equal(recs[i][key], expected[key])
+
+
+def random_signatures(rng, count, length=648):
+    signatures = rng.integers(-2, 3, size=(count, length)).astype('int8')
+    signatures[rng.random((count, length)) < 0.4] = 0
+    return signatures
+
+
+def test_pack_signatures_round_trip():
+    rng = np.random.default_rng(1)
+    for length in [648, 10, 11]:
+        signatures = random_signatures(rng, 20, length)
+        packed = pack_signatures(signatures)
+
+        assert packed.dtype == np.uint8
+        assert packed.shape == (20, -(-length // 3))
+        assert np.array_equal(unpack_signatures(packed, length), signatures)
+        assert np.array_equal(unpack_signatures(pack_signatures(signatures[0]), length), signatures[0])
+
+    assert np.array_equal(pack_signatures(np.array([0, 1, 2, -2], dtype='int8')), [117, 60])
+
+
+def test_packed_distances_match_normalized_distance():
+    rng = np.random.default_rng(2)
+    targets = random_signatures(rng, 200)
+    targets[5] = 0
+    vec = targets[7] + (rng.random(648) < 0.05)
+    vec = np.clip(vec, -2, 2).astype('int8')
+
+    packed_targets = pack_signatures(targets)
+    assert np.array_equal(packed_squared_norms(packed_targets), np.sum(targets.astype(int)**2, axis=1))
+
+    expected = normalized_distance(targets, vec)
+    assert np.allclose(packed_normalized_distance(packed_targets, pack_signatures(vec)), expected,
+                       rtol=1e-12, atol=0)
+
+    # featureless against featureless is nan_value
+    assert packed_normalized_distance(packed_targets[5:6], pack_signatures(targets[5]), nan_value=0.5)[0] == 0.5
+
+    # one packed signature per target gives paired distances
+    queries = targets[::-1]
+    assert np.allclose(packed_normalized_distance(packed_targets, pack_signatures(queries)),
+                       paired_normalized_distance(targets, queries), rtol=1e-12, atol=0)
+
+
+def loop_words(array, k, N):
+    # the original get_words, one word at a time
+    word_positions = np.linspace(0, array.shape[0], N, endpoint=False).astype('int')
+    words = np.zeros((N, k)).astype('int8')
+    for i, pos in enumerate(word_positions):
+        if pos + k <= array.shape[0]:
+            words[i] = array[pos:pos+k]
+        else:
+            temp = array[pos:].copy()
+            temp.resize(k)
+            words[i] = temp
+    return words
+
+
+def test_get_words_matches_word_loop():
+    rng = np.random.default_rng(3)
+    signatures = random_signatures(rng, 10)
+    for k, N in [(16, 63), (10, 100), (30, 40)]:
+        words = get_words(signatures, k, N)
+        assert words.shape == (10, N, k)
+        for signature, signature_words in zip(signatures, words):
+            assert np.array_equal(signature_words, loop_words(signature, k, N))
+            assert np.array_equal(get_words(signature, k, N), loop_words(signature, k, N))
+
+
+def test_signatures_to_words_matches_per_signature_encoding():
+    rng = np.random.default_rng(4)
+    signatures = random_signatures(rng, 10)
+    words = signatures_to_words(signatures, 16, 63)
+
+    assert words.shape == (10, 63)
+    for signature, signature_words in zip(signatures, words):
+        expected = loop_words(signature, 16, 63)
+        max_contrast(expected)
+        assert np.array_equal(signature_words, words_to_int(expected))
+        assert np.array_equal(signatures_to_words(signature, 16, 63), signature_words)
+
+
+def brute_force_matches(queries, targets, distance_cutoff):
+    matches = []
+    for query_row, query in enumerate(queries):
+        dists = normalized_distance(targets, query)
+        matches.extend((query_row, int(target_row), dists[target_row])
+                       for target_row in np.flatnonzero(dists < distance_cutoff))
+    return matches
+
+
+def test_exact_matches_matches_brute_force():
+    rng = np.random.default_rng(5)
+    targets = random_signatures(rng, 300)
+    targets[10] = 0
+    queries = np.clip(targets[::3] + rng.integers(-1, 2, size=(100, 648)) * (rng.random((100, 648)) < 0.15),
+                      -2, 2).astype('int8')
+    queries[7] = 0
+
+    for block_size, workers in [(1024, None), (64, None), (37, 3)]:
+        query_rows, target_rows, dists = exact_matches(queries, targets, 0.4, block_size=block_size,
+                                                       workers=workers)
+        expected = brute_force_matches(queries, targets, 0.4)
+
+        assert len(expected) >= 99
+        assert sorted(zip(query_rows.tolist(), target_rows.tolist())) == sorted((q, t) for q, t, _ in expected)
+        assert np.allclose(sorted(dists), sorted(d for _, _, d in expected), rtol=1e-12, atol=0)
+
+        # sorted by query row, then by distance
+        order = np.lexsort((dists, query_rows))
+        assert np.array_equal(order, np.arange(order.shape[0]))
+
+    # featureless signatures only match each other when nan_value is below the cutoff
+    query_rows, target_rows, dists = exact_matches(queries[7:8], targets[10:11], 0.4, nan_value=0.)
+    assert list(target_rows) == [0] and list(dists) == [0.]
+    assert exact_matches(queries[7:8], targets[10:11], 0.4)[0].shape == (0,)
+
+
+def test_recall_audit_of_embedded_index():
+    from embedded_driver import SignatureEmbedded
+
+    rng = np.random.default_rng(6)
+    signatures = random_signatures(rng, 50)
+    ses = SignatureEmbedded(distance_cutoff=0.45, size=1000)
+    recs = [make_record_from_signature('image_%d' % i, signature, 16, 63) for i, signature in enumerate(signatures)]
+    for rec in recs:
+        ses.insert_single_record(rec)
+
+    # every image finds itself, by words and exactly
+    assert ses.recall(recs) == 1.
+
+
+def test_normalized_distances_match_normalized_distance():
+    rng = np.random.default_rng(7)
+    queries = random_signatures(rng, 40)
+    targets = random_signatures(rng, 70)
+    targets[3] = 0
+    queries[5] = 0
+    norms = squared_norms(targets)
+
+    assert np.array_equal(norms, np.sum(targets.astype(int)**2, axis=1))
+
+    dists = normalized_distances(queries, targets, block_size=16)
+    for query, row in zip(queries, dists):
+        expected = normalized_distance(targets, query)
+        assert np.allclose(row, expected, rtol=1e-12, atol=0)
+        assert np.array_equal(normalized_distance(targets, query, target_squared_norms=norms), expected)
+
+    assert np.allclose(paired_normalized_distance(queries, targets[:40]), dists[np.arange(40), np.arange(40)],
+                       rtol=1e-12, atol=0)
+
+    cutoff = np.sort(dists.ravel())[100]
+    query_rows, target_rows, cut = normalized_distances(queries, targets, distance_cutoff=cutoff, block_size=16)
+    assert sorted(zip(query_rows.tolist(), target_rows.tolist())) == \
+        sorted(zip(*[a.tolist() for a in np.nonzero(dists < cutoff)]))
+
+
+def cache_entry(rng):
+    return rng.integers(-2, 3, size=648).astype('int8'), rng.integers(0, 2**40, size=63).tolist()
+
+
+def test_signature_cache_evicts_least_recently_used():
+    rng = np.random.default_rng(0)
+    entries = [cache_entry(rng) for _ in range(3)]
+    # room for two entries under one short key each
+    cache = SignatureCache(max_bytes=2 * (648 + 8 * 63 + 1))
+
+    cache.put(['a'], *entries[0])
+    cache.put(['b'], *entries[1])
+    assert cache.get(['a']) is not None
+    cache.put(['c'], *entries[2])
+
+    assert cache.get(['b']) is None
+    for key, (signature, words) in zip(['a', 'c'], [entries[0], entries[2]]):
+        cached_signature, cached_words = cache.get([key])
+        np.testing.assert_array_equal(cached_signature, signature)
+        assert cached_words == words
+
+
+def test_signature_cache_counts_hits_and_misses():
+    cache = SignatureCache()
+    assert cache.get(['a']) is None
+    cache.put(['a', 'b'], *cache_entry(np.random.default_rng(1)))
+    assert cache.get(['b']) is not None
+    assert cache.get(['c', 'a']) is not None
+    assert cache.get(['d']) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # a hit is also stored under the keys that missed
+    assert cache.get(['c']) is not None
+    assert (cache.hits, cache.misses) == (3, 2)
+
+    cache.clear()
+    assert (cache.hits, cache.misses) == (0, 0)
+    assert cache.get(['a']) is None
+
+
+def test_signature_cache_persists_in_sqlite(tmpdir):
+    path = str(tmpdir.join('signatures.sqlite'))
+    signature, words = cache_entry(np.random.default_rng(2))
+    SignatureCache(path=path).put(['a', 'b'], signature, words)
+
+    # a new instance, with an empty in-process tier that holds no entry at all
+    cache = SignatureCache(max_bytes=0, path=path)
+    cached_signature, cached_words = cache.get(['c', 'b'])
+    np.testing.assert_array_equal(cached_signature, signature)
+    assert cached_words == words
+    assert cache.get(['c']) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_signature_cache_is_invalidated_by_signature_parameters(tmpdir):
+    image = png_bytes(np.random.default_rng(3).integers(0, 256, size=(90, 130, 3)).astype(np.uint8))
+    cache = SignatureCache(path=str(tmpdir.join('signatures.sqlite')))
+
+    gis = ImageSignature()
+    rec = make_record('image', gis, 16, 63, img=image, bytestream=True, cache=cache)
+    assert make_record('image', gis, 16, 63, img=image, bytestream=True, cache=cache)['signature'] == rec['signature']
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # changing a parameter after construction changes the fingerprint, and so the keys
+    fingerprint = signature_fingerprint(gis, 16, 63)
+    gis.n = 7
+    assert signature_fingerprint(gis, 16, 63) != fingerprint
+    assert signature_fingerprint(ImageSignature(), 16, 31) != fingerprint
+    assert cache.get(cache.keys_for('image', gis, 16, 63, img=image, bytestream=True)) is None
+
+    other = make_record('image', gis, 16, 63, img=image, bytestream=True, cache=cache)
+    assert len(other['signature']) != len(rec['signature'])
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert make_record('image', gis, 16, 63, img=image, bytestream=True, cache=cache)['signature'] == other['signature']
+    assert cache.hits == 2
@@ -0,0 +1,69 @@
+from signature_store import SignatureStore
+from multiprocessing import Process
+import numpy as np
+import pytest
+
+
+def add_signatures(path, first, count):
+    store = SignatureStore(path, sig_length=8, grow_rows=3)
+    for i in range(first, first + count):
+        store.add('doc_%d' % i, np.full(8, i % 5 - 2, dtype='int8'))
+
+
+def test_add_and_get(tmpdir):
+    rng = np.random.default_rng(0)
+    signatures = rng.integers(-2, 3, size=(10, 648)).astype('int8')
+    store = SignatureStore(str(tmpdir.join('images')), grow_rows=4)
+
+    for i, signature in enumerate(signatures):
+        store.add('doc_%d' % i, signature)
+    store.add('doc_3', signatures[0])
+
+    assert len(store) == 10
+    assert 'doc_3' in store and 'doc_10' not in store
+
+    found_signatures, found = store.get(['doc_7', 'missing', 'doc_3'])
+    assert list(found) == [True, False, True]
+    assert np.array_equal(found_signatures[0], signatures[7])
+    assert not np.any(found_signatures[1])
+    assert np.array_equal(found_signatures[2], signatures[3])
+
+    with pytest.raises(ValueError):
+        store.add('doc_11', signatures[0][:10])
+
+
+def test_reopen_and_refresh(tmpdir):
+    path = str(tmpdir.join('images'))
+    first = SignatureStore(path, sig_length=8, grow_rows=3)
+    first.add('a', np.ones(8, dtype='int8'))
+
+    second = SignatureStore(path, sig_length=8, grow_rows=3)
+    assert np.array_equal(second.get(['a'])[0][0], np.ones(8))
+
+    # rows appended through another instance are found on lookup
+    for i in range(5):
+        second.add('b%d' % i, np.full(8, -1, dtype='int8'))
+    signatures, found = first.get(['b4', 'a'])
+    assert list(found) == [True, True]
+    assert np.array_equal(signatures, [np.full(8, -1), np.ones(8)])
+
+    # a partially written id is ignored until it is complete
+    with open(path + '.ids', 'ab') as ids_file:
+        ids_file.write(b'partial')
+    first.refresh()
+    assert len(first) == 6
+
+
+def test_concurrent_appends(tmpdir):
+    path = str(tmpdir.join('images'))
+    processes = [Process(target=add_signatures, args=(path, first, 20)) for first in [0, 20, 40]]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    store = SignatureStore(path, sig_length=8)
+    assert len(store) == 60
+    signatures, found = store.get(['doc_%d' % i for i in range(60)])
+    assert np.all(found)
+    assert np.array_equal(signatures[:, 0], np.arange(60) % 5 - 2)
@@ -0,0 +1,175 @@
+from signature_database_base import normalized_distances
+from signature_database_base import paired_normalized_distance
+from signature_database_base import squared_norms
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+
+class UnionFind(object):
+    """Disjoint sets over the integers 0..n-1, with vectorized unions
+
+    Each set is labeled by its smallest member. union_many merges many pairs at
+    once, by repeatedly hooking the larger root of every pair onto the smaller one
+    and then compressing paths, so no Python loop runs over the pairs.
+
+    """
+
+    def __init__(self, n):
+        self.parents = np.arange(n, dtype=np.int64)
+
+    def union_many(self, a, b):
+        """Merge the sets of a[i] and b[i], for every i
+
+        Args:
+            a (numpy.ndarray): integer array of members
+            b (numpy.ndarray): integer array of members, the same size as a
+
+        """
+        a = np.asarray(a, dtype=np.int64)
+        b = np.asarray(b, dtype=np.int64)
+
+        while a.shape[0] > 0:
+            root_a = self.roots(a)
+            root_b = self.roots(b)
+            different = root_a != root_b
+            if not np.any(different):
+                return
+
+            a, b = a[different], b[different]
+            root_a, root_b = root_a[different], root_b[different]
+            np.minimum.at(self.parents, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+            self._compress()
+
+    def roots(self, members=None):
+        """Get set labels
+
+        Args:
+            members (Optional[numpy.ndarray]): integer array of members (default None, all)
+
+        Returns:
+            the smallest member of the set of each member
+
+        """
+        self._compress()
+        if members is None:
+            return self.parents.copy()
+        return self.parents[members]
+
+    def _compress(self):
+        # point every member straight at its root
+        while True:
+            grandparents = self.parents[self.parents]
+            if np.array_equal(grandparents, self.parents):
+                return
+            self.parents = grandparents
+
+
+def block_pairs(column, max_block_size=2048, small_block_size=32):
+    """Group images that share a word at one position into candidate pairs
+
+    Args:
+        column (numpy.ndarray): integer array of the words of every image at one position
+        max_block_size (Optional[int]): skip blocks with more images than this. Very
+            common words, e.g. those of blank regions, carry little information, and
+            similar pairs in them nearly always share another, rarer word (default 2048)
+        small_block_size (Optional[int]): blocks up to this size are expanded into pairs;
+            larger ones are returned as blocks, to compare as matrices (default 32)
+
+    Returns:
+        a tuple of two integer arrays, the first and second rows of every candidate
+            pair in small blocks, and a list of integer arrays, the rows of each
+            large block
+
+    """
+    order = np.argsort(column, kind='mergesort')
+    sorted_words = column[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_words[1:] != sorted_words[:-1])))
+    sizes = np.diff(np.append(starts, sorted_words.shape[0]))
+
+    a, b = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for size in np.unique(sizes[(sizes >= 2) & (sizes <= small_block_size)]):
+        # one row of members per block of this size, then every pair of columns
+        members = order[starts[sizes == size][:, np.newaxis] + np.arange(size)]
+        first, second = np.triu_indices(size, 1)
+        a.append(members[:, first].ravel())
+        b.append(members[:, second].ravel())
+
+    large = [order[start:start + size] for start, size in zip(starts, sizes)
+             if small_block_size < size <= max_block_size]
+
+    return np.concatenate(a), np.concatenate(b), large
+
+
+def cluster_signatures(signatures, words, distance_cutoff, max_block_size=2048, small_block_size=32,
+                       chunk_size=65536, workers=None):
+    """Cluster images by single linkage at distance_cutoff
+
+    Candidate pairs are images that share a word at the same position, as for a
+    database search. Distances are only computed within each (position, word) block,
+    pairs closer than distance_cutoff are merged with union-find, and pairs already in
+    the same cluster are not compared again, so every cluster is a connected component
+    of the near-duplicate graph.
+
+    Args:
+        signatures (numpy.ndarray): n x m int8 array of signatures
+        words (numpy.ndarray): n x N integer array of words of the signatures
+        distance_cutoff (float): maximum distance between near-duplicates
+        max_block_size (Optional[int]): size of the largest block to compare, as for
+            block_pairs (default 2048)
+        small_block_size (Optional[int]): size of the largest block to compare pair by
+            pair, as for block_pairs (default 32)
+        chunk_size (Optional[int]): number of pairs to compare at once (default 65536)
+        workers (Optional[int]): number of threads to compare pairs and blocks on (default None)
+
+    Returns:
+        an integer array of size n: the row of the first image of each image's cluster
+
+    """
+    signatures = np.asarray(signatures, dtype='int8')
+    words = np.asarray(words)
+    norms = squared_norms(signatures)
+    clusters = UnionFind(signatures.shape[0])
+
+    def near_pairs(pairs):
+        a, b = pairs
+        near = paired_normalized_distance(signatures[a], signatures[b]) < distance_cutoff
+        return a[near], b[near]
+
+    def near_block_pairs(rows):
+        query_rows, target_rows, _ = normalized_distances(signatures[rows], signatures[rows],
+                                                          target_squared_norms=norms[rows],
+                                                          distance_cutoff=distance_cutoff)
+        upper = query_rows < target_rows
+        return rows[query_rows[upper]], rows[target_rows[upper]]
+
+    pool = ThreadPool(workers) if workers else None
+    try:
+        for position in range(words.shape[1]):
+            a, b, large = block_pairs(words[:, position], max_block_size, small_block_size)
+
+            # near-duplicates share many words, so most pairs are already connected
+            new = clusters.roots(a) != clusters.roots(b)
+            a, b = a[new], b[new]
+
+            tasks = [(near_pairs, (a[start:start + chunk_size], b[start:start + chunk_size]))
+                     for start in range(0, a.shape[0], chunk_size)]
+            tasks.extend((near_block_pairs, rows) for rows in large)
+            if pool is not None:
+                near = pool.map(_apply, tasks)
+            else:
+                near = [_apply(task) for task in tasks]
+
+            if near:
+                clusters.union_many(np.concatenate([pair[0] for pair in near]),
+                                    np.concatenate([pair[1] for pair in near]))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return clusters.roots()
+
+
+def _apply(task):
+    function, argument = task
+    return function(argument)
@@ -1,9 +1,37 @@
 from signature_database_base import SignatureDatabaseBase
 from signature_database_base import normalized_distance
+from signature_database_base import paired_normalized_distance
+from signature_database_base import make_records
+from signature_database_base import make_record_from_signature
+from signature_database_base import signatures_to_words
+from signature_database_base import record_words, convert_record
+from signature_database_base import pack_signatures, unpack_signatures, packed_normalized_distance
+from goldberg import CorruptImageError
+from elasticsearch.helpers import streaming_bulk, scan
+from elasticsearch.exceptions import ConflictError, RequestError
 from datetime import datetime
+from threading import Lock, Thread, Event
 import numpy as np
+import base64
+import hashlib
+import json
+import logging
 from collections import deque
 
+logger = logging.getLogger(__name__)
+
+
+def path_id(path):
+    """Deterministic Elasticsearch document id for an image path or URL.
+
+    Args:
+        path (string): path or URL of the image
+
+    Returns:
+        the hex SHA-1 digest of path
+    """
+    return hashlib.sha1(path.encode('utf-8')).hexdigest()
+
 
 class SignatureES(SignatureDatabaseBase):
     """Elasticsearch driver for viglink_image_match
@@ -20,6 +48,31 @@ class SignatureES(SignatureDatabaseBase):
             doc_type (Optional[string]): a name for the document time (default 'image')
             timeout (Optional[int]): how long to wait on an Elasticsearch query, in seconds (default 10)
             size (Optional[int]): maximum number of Elasticsearch results (default 100)
+            signature_store (Optional[SignatureStore]): keyword only. Memory-mapped store of
+                signatures by document id. If given, search hits do not include signatures,
+                which are read from the store instead (default None)
+            bulk_size (Optional[int]): keyword only. Maximum number of documents per bulk
+                request (default 500)
+            bulk_bytes (Optional[int]): keyword only. Maximum size of a bulk request, in bytes
+                (default 5 MiB)
+            bulk_interval (Optional[float]): keyword only. Flush buffered records at least this
+                often, in seconds (default 1)
+            bulk_refresh (Optional[boolean or string]): keyword only. Refresh parameter for bulk
+                requests: False, True or 'wait_for' (default False)
+            packed_signatures (Optional[boolean]): keyword only. Store signatures as base64
+                encoded packed bytes (see pack_signatures) in a binary field, instead of lists of
+                integers. Use with an index created by create_index on a driver with
+                packed_signatures=True, whose mapping has the binary field. Hits are reranked
+                on the packed bytes, see packed_normalized_distance (default False)
+            min_word_match (Optional[int]): keyword only. Minimum number of words a document
+                must share with the query to be a search hit (default 1)
+            path_ids (Optional[boolean]): keyword only. Use path_id(path) as document id and
+                insert with op_type=create, so inserting the same path twice is a no-op, and
+                path_exists is a single document lookup (default False, ids chosen by
+                Elasticsearch)
+            recent_records (Optional[RecentRecords]): keyword only. Overlay of recently
+                inserted records, which searches also match against, so that records are found
+                before the next index refresh. Its N should match the driver's (default None)
             *args (Optional): Variable length argument list to pass to base constructor
             **kwargs (Optional): Arbitrary keyword arguments to pass to base constructor
 
@@ -43,6 +96,25 @@ class SignatureES(SignatureDatabaseBase):
         self.doc_type = doc_type
         self.timeout = timeout
         self.size = size
+        self.signature_store = kwargs.pop('signature_store', None)
+
+        self.bulk_size = kwargs.pop('bulk_size', 500)
+        self.bulk_bytes = kwargs.pop('bulk_bytes', 5 * 2**20)
+        self.bulk_interval = kwargs.pop('bulk_interval', 1.)
+        self.bulk_refresh = kwargs.pop('bulk_refresh', False)
+
+        self.packed_signatures = kwargs.pop('packed_signatures', False)
+        self.min_word_match = kwargs.pop('min_word_match', 1)
+        self.path_ids = kwargs.pop('path_ids', False)
+        self.recent_records = kwargs.pop('recent_records', None)
+
+        # records waiting for the next bulk request, with their callbacks
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._buffer_lock = Lock()
+        self._flush_lock = Lock()
+        self._flusher = None
+        self._closed = Event()
 
         super(SignatureES, self).__init__(*args, **kwargs)
 
@@ -52,24 +124,21 @@ class SignatureES(SignatureDatabaseBase):
         if 'metadata' in rec:
             rec.pop('metadata')
 
-        # build the 'should' list
-        should = [{'term': {word: rec[word]}} for word in rec]
         res = self.es.search(index=self.index,
                               doc_type=self.doc_type,
-                              body={'query': {
-                                       'bool': {'should': should}
-                                     },
-                                    '_source': {'excludes': ['simple_word_*']}
+                              body={'query': self._word_query(rec),
+                                    '_source': {'excludes': self._source_excludes()}
                                    },
                               size=self.size,
                               timeout=self.timeout)['hits']['hits']
 
-        sigs = np.array([x['_source']['signature'] for x in res])
+        if len(res) == 0:
+            return self._with_recent([dict(rec, path=path, signature=signature)], [[]])[0]
 
-        if sigs.size == 0:
-            return []
-
-        dists = normalized_distance(sigs, np.array(signature))
+        if self._packed_hits():
+            dists = packed_normalized_distance(self._hit_packed_signatures(res), pack_signatures(signature))
+        else:
+            dists = normalized_distance(self._hit_signatures(res), np.array(signature))
 
         formatted_res = [{'id': x['_id'],
                           'score': x['_score'],
@@ -81,14 +150,530 @@ class SignatureES(SignatureDatabaseBase):
             row['dist'] = dists[i]
         formatted_res = filter(lambda y: y['dist'] < self.distance_cutoff, formatted_res)
 
-        return formatted_res
+        return self._with_recent([dict(rec, path=path, signature=signature)], [list(formatted_res)])[0]
+
+    def search_records(self, recs):
+        """Search for matches to many records with a single _msearch request.
+
+        All hits are reranked together, with one vectorized distance computation.
+
+        Args:
+            recs (List[dict]): image records, in the format returned by make_record.
+                They are not modified
+
+        Returns:
+            a list with one list of matches per record, as returned by search_single_record
+        """
+        if len(recs) == 0:
+            return []
+
+        body = []
+        for rec in recs:
+            body.append({'index': self.index, 'type': self.doc_type})
+            body.append({'query': self._word_query(rec),
+                         '_source': {'excludes': self._source_excludes()},
+                         'size': self.size,
+                         'timeout': self.timeout})
+
+        responses = self.es.msearch(body=body)['responses']
+
+        hits = []
+        owners = []
+        for i, response in enumerate(responses):
+            if 'error' in response:
+                raise RuntimeError('Elasticsearch query failed: %r' % response['error'])
+            hits.extend(response['hits']['hits'])
+            owners.extend([i] * len(response['hits']['hits']))
+
+        results = [[] for _ in recs]
+        if len(hits) == 0:
+            return self._with_recent(recs, results)
+
+        # rerank every hit against its own query at once
+        query_sigs = np.array([rec['signature'] for rec in recs], dtype='int8')
+        if self._packed_hits():
+            dists = packed_normalized_distance(self._hit_packed_signatures(hits), pack_signatures(query_sigs)[owners])
+        else:
+            dists = paired_normalized_distance(self._hit_signatures(hits), query_sigs[owners])
+
+        for x, owner, dist in zip(hits, owners, dists):
+            if dist < self.distance_cutoff:
+                results[owner].append({'id': x['_id'],
+                                       'score': x['_score'],
+                                       'metadata': x['_source'].get('metadata'),
+                                       'path': x['_source'].get('url', x['_source'].get('path')),
+                                       'dist': dist})
+
+        return self._with_recent(recs, results)
+
+    def _with_recent(self, recs, results):
+        # add matches among recently inserted records, which may not be searchable yet
+        if self.recent_records is None:
+            return results
+
+        for result, recent in zip(results, self.recent_records.search(recs, self.distance_cutoff)):
+            ids = set(match['id'] for match in result)
+            result.extend(match for match in recent if match['id'] not in ids)
+
+        return results
+
+    def _word_query(self, rec):
+        # documents sharing at least min_word_match words with rec, in the word layout of the index
+        words = record_words(rec, self.N)
+
+        if self.word_layout == 'tokens':
+            tokens = [''.join([str(i), ':', str(word)]) for i, word in enumerate(words)]
+            return {'terms_set': {'words': {'terms': tokens,
+                                            'minimum_should_match_script': {
+                                                'source': 'Math.min(params.num_terms, params.min_word_match)',
+                                                'params': {'min_word_match': self.min_word_match}}}}}
+
+        should = [{'term': {''.join(['simple_word_', str(i)]): word}} for i, word in enumerate(words)]
+        query = {'bool': {'should': should}}
+        if self.min_word_match > 1:
+            query['bool']['minimum_should_match'] = self.min_word_match
+        return query
+
+    def _source_excludes(self):
+        # signatures come from the side store, if there is one
+        excludes = ['simple_word_*', 'words']
+        if self.signature_store is not None:
+            excludes.append('signature')
+        return excludes
+
+    def _hit_signatures(self, hits):
+        if self.signature_store is not None:
+            return self.stored_signatures([x['_id'] for x in hits])
+        return np.array([self._decode_signature(x['_source']['signature']) for x in hits])
+
+    def _document(self, rec):
+        # the Elasticsearch document for a record, in the word layout and signature format of the index
+        doc = rec
+        if ('words' in rec) != (self.word_layout == 'tokens'):
+            doc = convert_record(rec, self.N, self.word_layout)
+        if self.packed_signatures:
+            doc = dict(doc)
+            doc['signature'] = base64.b64encode(pack_signatures(rec['signature']).tobytes()).decode('ascii')
+        return doc
+
+    def _packed_hits(self):
+        # hits carry packed signatures, which are reranked as they are, without unpacking them
+        return self.packed_signatures and self.signature_store is None
+
+    def _hit_packed_signatures(self, hits):
+        return np.array([np.frombuffer(base64.b64decode(x['_source']['signature']), dtype=np.uint8) for x in hits])
+
+    def _decode_signature(self, value):
+        if self.packed_signatures:
+            return unpack_signatures(np.frombuffer(base64.b64decode(value), dtype=np.uint8), self.gis.sig_length)
+        return value
+
+    def index_mapping(self):
+        """Mapping for signature documents.
+
+        Words are exact-match keyword fields without norms, positions or doc values. The
+        signature is stored but not indexed. path and metadata.clusterid are keywords,
+        and words are left out of _source, since searches never return them. With the
+        'tokens' word layout, all words are in a single multi-valued 'words' field.
+
+        Returns:
+            the mapping for doc_type, as a dict
+        """
+        word_mapping = {'type': 'keyword', 'norms': False, 'index_options': 'docs', 'doc_values': False}
+        if self.packed_signatures:
+            signature_mapping = {'type': 'binary'}
+        else:
+            signature_mapping = {'type': 'byte', 'index': False, 'doc_values': False}
+
+        properties = {'path': {'type': 'keyword'},
+                      'signature': signature_mapping,
+                      'timestamp': {'type': 'date'},
+                      'metadata': {'type': 'object',
+                                   'properties': {'clusterid': {'type': 'keyword'}}}}
+        if self.word_layout == 'tokens':
+            properties['words'] = word_mapping
+        else:
+            for i in range(self.N):
+                properties[''.join(['simple_word_', str(i)])] = word_mapping
+
+        return {'dynamic': False,
+                '_source': {'excludes': ['simple_word_*', 'words']},
+                'properties': properties}
+
+    def index_settings(self, shards=5, replicas=1, refresh_interval='5s'):
+        """Index settings for write-heavy signature indices.
+
+        Args:
+            shards (Optional[int]): number of primary shards (default 5)
+            replicas (Optional[int]): number of replicas (default 1)
+            refresh_interval (Optional[string]): how often new documents become searchable
+                (default '5s')
+
+        Returns:
+            the index settings, as a dict
+        """
+        return {'number_of_shards': shards,
+                'number_of_replicas': replicas,
+                'refresh_interval': refresh_interval}
+
+    def create_index(self, **settings):
+        """Create the index with the signature mapping, or verify the mapping of an existing one.
+
+        Args:
+            **settings: keyword arguments for index_settings
+
+        Returns:
+            True if the index was created, False if it already existed
+        """
+        if self.es.indices.exists(index=self.index):
+            self.verify_mapping()
+            return False
+
+        try:
+            self.es.indices.create(index=self.index,
+                                   body={'settings': self.index_settings(**settings),
+                                         'mappings': {self.doc_type: self.index_mapping()}})
+        except RequestError as e:
+            # another worker created it in the meantime
+            if e.error not in ('resource_already_exists_exception', 'index_already_exists_exception'):
+                raise
+            self.verify_mapping()
+            return False
+
+        return True
+
+    def put_template(self, name, pattern, **settings):
+        """Install an index template, so that indices matching pattern get the signature mapping.
+
+        Args:
+            name (string): template name
+            pattern (string): index name pattern, e.g. 'images_*'
+            **settings: keyword arguments for index_settings
+        """
+        self.es.indices.put_template(name=name,
+                                     body={'index_patterns': [pattern],
+                                           'settings': self.index_settings(**settings),
+                                           'mappings': {self.doc_type: self.index_mapping()}})
+
+    def verify_mapping(self):
+        """Check the mapping of an existing index, and log the fields that differ from index_mapping.
+
+        Returns:
+            a list of field names whose mapping differs
+        """
+        mapping = self.es.indices.get_mapping(index=self.index)
+        properties = {}
+        for index_mapping in mapping.values():
+            properties = index_mapping['mappings'].get(self.doc_type, index_mapping['mappings']).get('properties', {})
+
+        expected = self.index_mapping()['properties']
+        mismatched = [field for field in sorted(expected)
+                      if field != 'metadata' and properties.get(field, {}).get('type') != expected[field]['type']]
+
+        if mismatched:
+            logger.warning("Index %s has dynamic or outdated mappings for %d fields (e.g. %s); "
+                           "migrate to an index created by create_index with migrate_from"
+                           % (self.index, len(mismatched), mismatched[0]))
+
+        return mismatched
+
+    def migrate_from(self, source, batch_size=500, refresh_after=None):
+        """Copy every document of another signature index into this one.
+
+        Words are recomputed from the stored signatures, so documents can be moved to a new word
+        layout or signature format even when the source index keeps words out of _source.
+        Document ids are kept, so a signature store stays valid. To migrate, create the new index
+        with create_index, migrate into it, then switch readers and writers over to it.
+
+        Args:
+            source (SignatureES): driver for the index to copy from, set up with its word layout
+                and signature format
+            batch_size (Optional[int]): number of documents to convert at once (default 500)
+            refresh_after (Optional[boolean or string]): refresh parameter for the bulk
+                requests (default bulk_refresh)
+
+        Returns:
+            a tuple of the number of copied documents and a list of the errors Elasticsearch
+                reported for documents it could not index
+        """
+        if refresh_after is None:
+            refresh_after = self.bulk_refresh
+
+        def actions():
+            hits = scan(source.es, index=source.index, doc_type=source.doc_type, size=batch_size,
+                        query={'query': {'match_all': {}}, '_source': {'excludes': ['simple_word_*', 'words']}})
+            batch = []
+            for hit in hits:
+                batch.append(hit)
+                if len(batch) == batch_size:
+                    for action in self._migration_actions(source, batch):
+                        yield action
+                    batch = []
+            for action in self._migration_actions(source, batch):
+                yield action
+
+        n_copied = 0
+        errors = []
+        for ok, item in streaming_bulk(self.es, actions(),
+                                       chunk_size=self.bulk_size,
+                                       max_chunk_bytes=self.bulk_bytes,
+                                       raise_on_error=False,
+                                       raise_on_exception=False,
+                                       refresh=refresh_after):
+            result = item.get('index', item)
+            if ok:
+                n_copied += 1
+            else:
+                errors.append(result.get('error', result))
+
+        return n_copied, errors
+
+    def _migration_actions(self, source, hits):
+        if len(hits) == 0:
+            return []
+
+        signatures = np.array([source._decode_signature(hit['_source']['signature']) for hit in hits], dtype='int8')
+        words = signatures_to_words(signatures, self.k, self.N).tolist()
+
+        actions = []
+        for hit, signature, w in zip(hits, signatures, words):
+            rec = make_record_from_signature(hit['_source'].get('path'), signature, self.k, self.N,
+                                             metadata=hit['_source'].get('metadata'), words=w,
+                                             word_layout=self.word_layout)
+            if 'timestamp' in hit['_source']:
+                rec['timestamp'] = hit['_source']['timestamp']
+            actions.append({'_index': self.index, '_type': self.doc_type, '_id': hit['_id'],
+                            '_source': self._document(rec)})
+
+        return actions
+
+    def path_exists(self, path):
+        """Check whether an image is indexed, by document id. Requires path_ids.
+
+        Args:
+            path (string): path or URL of the image
+
+        Returns:
+            True if a document with id path_id(path) exists
+        """
+        return self.es.exists(index=self.index, doc_type=self.doc_type, id=path_id(path))
+
+    def paths_exist(self, paths):
+        """Check whether many images are indexed, with one mget request. Requires path_ids.
+
+        Args:
+            paths (List[string]): paths or URLs of the images
+
+        Returns:
+            a list of booleans, in the order of paths
+        """
+        if len(paths) == 0:
+            return []
+
+        docs = self.es.mget(index=self.index, doc_type=self.doc_type,
+                            body={'ids': [path_id(path) for path in paths]}, _source=False)['docs']
+        return [bool(doc.get('found')) for doc in docs]
+
+    def paths_metadata(self, paths):
+        """Look up the metadata of many images by path, with one mget request. Requires path_ids.
+
+        Args:
+            paths (List[string]): paths or URLs of the images
+
+        Returns:
+            a list of metadata, in the order of paths, with None for images that are not indexed
+                or have no metadata
+        """
+        if len(paths) == 0:
+            return []
+
+        docs = self.es.mget(index=self.index, doc_type=self.doc_type,
+                            body={'ids': [path_id(path) for path in paths]}, _source=['metadata'])['docs']
+        return [doc['_source'].get('metadata') if doc.get('found') else None for doc in docs]
 
     def insert_single_record(self, rec, refresh_after=False):
         rec['timestamp'] = datetime.now()
-        self.es.index(index=self.index, doc_type=self.doc_type, body=rec, refresh=refresh_after)
+        if self.path_ids:
+            doc_id = path_id(rec['path'])
+            try:
+                self.es.index(index=self.index, doc_type=self.doc_type, body=self._document(rec), id=doc_id,
+                              op_type='create', refresh=refresh_after)
+            except ConflictError:
+                # already indexed
+                pass
+        else:
+            doc_id = self.es.index(index=self.index, doc_type=self.doc_type, body=self._document(rec),
+                                   refresh=refresh_after)['_id']
+
+        if self.signature_store is not None:
+            self.signature_store.add(doc_id, rec['signature'])
+        if self.recent_records is not None:
+            self.recent_records.add(doc_id, rec)
+
+    def insert_records(self, recs, refresh_after=None):
+        """Insert many records with bulk requests.
+
+        Records are sent in chunks of at most bulk_size documents and bulk_bytes bytes.
+
+        Args:
+            recs (List[dict]): image records, in the format returned by make_record
+            refresh_after (Optional[boolean or string]): refresh parameter for the bulk
+                requests (default bulk_refresh)
+
+        Returns:
+            a list with one entry per record, in order: None if it was indexed (or, with
+                path_ids, already was), otherwise the error Elasticsearch reported for it
+        """
+        if refresh_after is None:
+            refresh_after = self.bulk_refresh
+
+        op_type = 'create' if self.path_ids else 'index'
+
+        timestamp = datetime.now()
+        actions = []
+        for rec in recs:
+            rec['timestamp'] = timestamp
+            action = {'_index': self.index, '_type': self.doc_type, '_op_type': op_type,
+                      '_source': self._document(rec)}
+            if self.path_ids:
+                action['_id'] = path_id(rec['path'])
+            actions.append(action)
+
+        errors = []
+        for rec, (ok, item) in zip(recs, streaming_bulk(self.es, actions,
+                                                        chunk_size=self.bulk_size,
+                                                        max_chunk_bytes=self.bulk_bytes,
+                                                        raise_on_error=False,
+                                                        raise_on_exception=False,
+                                                        refresh=refresh_after)):
+            result = item.get(op_type, item)
+            if ok or result.get('status') == 409:
+                errors.append(None)
+                if self.signature_store is not None:
+                    self.signature_store.add(result['_id'], rec['signature'])
+                if self.recent_records is not None:
+                    self.recent_records.add(result['_id'], rec)
+            else:
+                errors.append(result.get('error', result))
+
+        return errors
+
+    def add_images(self, paths, imgs=None, bytestream=False, metadatas=None, workers=None, refresh_after=None):
+        """Add many images to the database with bulk requests.
+
+        Args:
+            paths (List[string]): paths or identifiers for the images, as for add_image
+            imgs (Optional[List[string]]): image data or locations, one per path, as for add_image
+                (default None)
+            bytestream (Optional[boolean]): are the entries of imgs raw bytes? (default False)
+            metadatas (Optional[List]): metadata, one per path (default None)
+            workers (Optional[int]): number of processes to compute signatures on (default None)
+            refresh_after (Optional[boolean or string]): refresh parameter for the bulk
+                requests (default bulk_refresh)
+
+        Returns:
+            a list with one entry per image, in order: None if it was indexed, otherwise the
+                CorruptImageError or the error Elasticsearch reported for it
+        """
+        recs = make_records(paths, self.gis, self.k, self.N, imgs=imgs, bytestream=bytestream,
+                            metadatas=metadatas, workers=workers, word_layout=self.word_layout)
+
+        good = [i for i, rec in enumerate(recs) if not isinstance(rec, CorruptImageError)]
+        errors = list(recs)
+        for i, error in zip(good, self.insert_records([recs[i] for i in good], refresh_after=refresh_after)):
+            errors[i] = error
+
+        return errors
+
+    def buffer_record(self, rec, callback=None):
+        """Queue a record for insertion with the next bulk request.
+
+        The buffer is flushed when it holds bulk_size records or bulk_bytes bytes, and at
+        least every bulk_interval seconds.
+
+        Args:
+            rec (dict): an image record, in the format returned by make_record
+            callback (Optional[callable]): called as callback(rec, error) once the record has
+                been sent, with error None if it was indexed
+        """
+        size = len(json.dumps(rec, default=str))
+
+        with self._buffer_lock:
+            self._buffer.append((rec, callback))
+            self._buffer_bytes += size
+            full = len(self._buffer) >= self.bulk_size or self._buffer_bytes >= self.bulk_bytes
+
+            if self._flusher is None:
+                self._flusher = Thread(target=self._flush_periodically)
+                self._flusher.daemon = True
+                self._flusher.start()
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Send all buffered records"""
+        with self._flush_lock:
+            with self._buffer_lock:
+                buffered = self._buffer
+                self._buffer = []
+                self._buffer_bytes = 0
+
+            if not buffered:
+                return
+
+            recs = [rec for rec, _ in buffered]
+            try:
+                errors = self.insert_records(recs)
+            except Exception as e:
+                errors = [e] * len(recs)
+
+            for (rec, callback), error in zip(buffered, errors):
+                if callback is not None:
+                    callback(rec, error)
+
+    def close(self):
+        """Flush buffered records and stop the periodic flush"""
+        self._closed.set()
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.bulk_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.error("Periodic bulk flush failure", exc_info=True)
+
+    def stored_signatures(self, ids):
+        """Get signatures from the side store, fetching any it does not have yet from Elasticsearch.
+
+        Args:
+            ids (List[string]): Elasticsearch document ids
+
+        Returns:
+            an int8 array with one signature per id
+        """
+        sigs, found = self.signature_store.get(ids)
+
+        if not np.all(found):
+            missing = [doc_id for doc_id, f in zip(ids, found) if not f]
+            docs = self.es.mget(index=self.index, doc_type=self.doc_type,
+                                body={'ids': missing}, _source=['signature'])['docs']
+            fetched = dict((doc['_id'], self._decode_signature(doc['_source']['signature']))
+                           for doc in docs if doc.get('found'))
+            for i in np.flatnonzero(~found):
+                if ids[i] in fetched:
+                    sigs[i] = fetched[ids[i]]
+                    self.signature_store.add(ids[i], fetched[ids[i]])
+
+        return sigs
 
     def delete_duplicates(self, path):
         """Delete all but one entries in elasticsearch whose `path` value is equivalent to that of path.
+
+        With path_ids, the document with id path_id(path) is the one kept, so this only cleans up
+        documents indexed before path_ids was turned on.
+
         Args:
             path (string): path value to compare to those in the elastic search
         """
@@ -96,10 +681,15 @@ class SignatureES(SignatureDatabaseBase):
                           self.es.search(body={'query':
                                                {'match':
                                                 {'path': path}
-                                               }
+                                               },
+                                               '_source': ['path']
                                               },
-                                         index=self.index)['hits']['hits']
+                                         index=self.index,
+                                         size=self.size)['hits']['hits']
                           if item['_source']['path'] == path]
         if len(matching_paths) > 0:
-            for id_tag in matching_paths[1:]:
-                self.es.delete(index=self.index, doc_type=self.doc_type, id=id_tag)
\ No newline at end of file
+            keep = path_id(path) if self.path_ids and path_id(path) in matching_paths else matching_paths[0]
+            actions = [{'_op_type': 'delete', '_index': self.index, '_type': self.doc_type, '_id': id_tag}
+                       for id_tag in matching_paths if id_tag != keep]
+            for _ in streaming_bulk(self.es, actions, raise_on_error=False):
+                pass
@@ -0,0 +1,325 @@
+from signature_database_base import SignatureDatabaseBase
+from signature_database_base import normalized_distance
+from signature_database_base import exact_matches
+from signature_database_base import squared_norms
+from signature_database_base import record_words
+import numpy as np
+import json
+import os
+
+# atomic rename over an existing file
+_replace = getattr(os, 'replace', os.rename)
+
+
+class SignatureEmbedded(SignatureDatabaseBase):
+    """In-process inverted index driver for viglink_image_match
+
+    Signatures are kept in a contiguous int8 matrix and words in an integer matrix,
+    one row per image. For candidate retrieval, every (word position, word value)
+    pair is mapped to the sorted row numbers of the images that have it, so a search
+    is a single binary search over all query words followed by a count of matching
+    words per image, like the 'should' query of SignatureES. The best candidates are
+    then reranked with normalized_distance.
+
+    Images are stored in two segments. The indexed segment is immutable and can be
+    memory-mapped from disk, so a restarted worker reopens a large index without
+    reading it into memory. New images are appended to a small pending segment,
+    preallocated arrays filled up to n_pending rows, which is searched by comparing
+    words directly, until merge or save folds it into the indexed segment.
+
+    """
+
+    def __init__(self, path=None, size=100, merge_threshold=16384, mmap_mode='r', *args, **kwargs):
+        """Extra setup for the embedded index
+
+        Args:
+            path (Optional[string]): directory to load a saved index from, and to save to.
+                If None, or if the directory holds no index yet, start empty (default None)
+            size (Optional[int]): maximum number of candidates to rerank per search (default 100)
+            merge_threshold (Optional[int]): merge pending images into the inverted index
+                once there are this many (default 16384)
+            mmap_mode (Optional[string]): numpy memory-map mode for loading the index, or
+                None to read it into memory (default 'r')
+            *args (Optional): Variable length argument list to pass to base constructor
+            **kwargs (Optional): Arbitrary keyword arguments to pass to base constructor
+
+        Examples:
+            >>> from viglink_image_match.embedded_driver import SignatureEmbedded
+            >>> ses = SignatureEmbedded('/var/lib/images_0.1', distance_cutoff=0.1)
+            >>> ses.add_image('https://pixabay.com/static/uploads/photo/2012/11/28/08/56/mona-lisa-67506_960_720.jpg')
+            >>> ses.search_image('https://pixabay.com/static/uploads/photo/2012/11/28/08/56/mona-lisa-67506_960_720.jpg')
+            [
+             {'dist': 0.0,
+              'id': 0,
+              'metadata': None,
+              'path': 'https://pixabay.com/static/uploads/photo/2012/11/28/08/56/mona-lisa-67506_960_720.jpg',
+              'score': 63}
+            ]
+            >>> ses.save()
+
+        """
+        super(SignatureEmbedded, self).__init__(*args, **kwargs)
+
+        self.path = path
+        self.size = size
+        self.merge_threshold = merge_threshold
+
+        # every word is below 3**k, so this makes (position, word) keys unique
+        self.word_base = 3 ** self.k
+
+        # indexed segment
+        self.signatures = np.zeros((0, self.gis.sig_length), dtype='int8')
+        self.signature_squared_norms = np.zeros(0, dtype=np.int32)
+        self.words = np.zeros((0, self.N), dtype=np.int64)
+        self.posting_keys = np.zeros(0, dtype=np.int64)
+        self.posting_starts = np.zeros(1, dtype=np.int64)
+        self.posting_rows = np.zeros(0, dtype=np.int32)
+
+        # pending segment, filled up to n_pending rows
+        self._clear_pending()
+
+        # per image, for both segments
+        self.paths = []
+        self.metadata = []
+
+        if path is not None and os.path.exists(os.path.join(path, 'signatures.npy')):
+            self.load(path, mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def search_single_record(self, rec):
+        signature = np.array(rec['signature'], dtype='int8')
+        query_words = np.array(record_words(rec, self.N), dtype=np.int64)
+
+        # number of matching words for every image in the indexed segment
+        query_keys = np.arange(self.N, dtype=np.int64) * self.word_base + query_words
+        if self.posting_keys.shape[0] > 0:
+            found = np.minimum(np.searchsorted(self.posting_keys, query_keys), self.posting_keys.shape[0] - 1)
+            found = found[self.posting_keys[found] == query_keys]
+        else:
+            found = []
+
+        if len(found) > 0:
+            rows = np.concatenate([self.posting_rows[self.posting_starts[i]:self.posting_starts[i + 1]]
+                                   for i in found])
+            counts = np.bincount(rows, minlength=self.signatures.shape[0])
+        else:
+            counts = np.zeros(self.signatures.shape[0], dtype=np.int64)
+
+        # and in the pending segment
+        if self.n_pending > 0:
+            counts = np.concatenate((counts, np.sum(self.pending_words[:self.n_pending] == query_words, axis=1)))
+
+        # keep the best candidates, as Elasticsearch would
+        candidates = np.flatnonzero(counts)
+        if candidates.shape[0] > self.size:
+            candidates = candidates[np.argsort(-counts[candidates], kind='mergesort')[:self.size]]
+
+        if candidates.shape[0] == 0:
+            return []
+
+        candidate_signatures = self._signature_rows(candidates)
+        candidate_squared_norms = np.zeros(candidates.shape[0], dtype=np.int32)
+        in_index = candidates < self.signatures.shape[0]
+        candidate_squared_norms[in_index] = self.signature_squared_norms[candidates[in_index]]
+        candidate_squared_norms[~in_index] = squared_norms(candidate_signatures[~in_index])
+
+        dists = normalized_distance(candidate_signatures, signature, target_squared_norms=candidate_squared_norms)
+
+        return [{'id': int(row),
+                 'score': int(counts[row]),
+                 'metadata': self.metadata[row],
+                 'path': self.paths[row],
+                 'dist': dist}
+                for row, dist in zip(candidates, dists) if dist < self.distance_cutoff]
+
+    def insert_single_record(self, rec, refresh_after=False):
+        if self.n_pending == self.pending_words.shape[0]:
+            # grow geometrically, so appends stay amortized O(1)
+            capacity = min(max(2 * self.n_pending, 64), max(self.merge_threshold, self.n_pending + 1))
+            for name in ['pending_signatures', 'pending_words']:
+                pending = getattr(self, name)
+                grown = np.zeros((capacity, pending.shape[1]), dtype=pending.dtype)
+                grown[:self.n_pending] = pending[:self.n_pending]
+                setattr(self, name, grown)
+
+        self.pending_signatures[self.n_pending] = rec['signature']
+        self.pending_words[self.n_pending] = record_words(rec, self.N)
+        self.n_pending += 1
+        self.paths.append(rec['path'])
+        self.metadata.append(rec.get('metadata'))
+
+        if self.n_pending >= self.merge_threshold:
+            self.merge()
+
+    def search_exact(self, recs, workers=None):
+        """Search for matches to many records by comparing against every stored signature
+
+        Finds exactly the images within distance_cutoff, without the word-based candidate
+        retrieval of search_single_record. Useful for small collections, and for measuring
+        what the candidate retrieval misses.
+
+        Args:
+            recs (List[dict]): image records, in the format returned by make_record
+            workers (Optional[int]): number of threads to use (default None, no threads)
+
+        Returns:
+            a list with one list of matches per record, in the format returned by
+                search_single_record but without score
+
+        """
+        self.merge()
+
+        queries = np.array([rec['signature'] for rec in recs], dtype='int8')
+        query_rows, rows, dists = exact_matches(queries, self.signatures, self.distance_cutoff,
+                                                target_squared_norms=self.signature_squared_norms,
+                                                workers=workers)
+
+        results = [[] for _ in recs]
+        for query_row, row, dist in zip(query_rows, rows, dists):
+            results[query_row].append({'id': int(row),
+                                       'metadata': self.metadata[row],
+                                       'path': self.paths[row],
+                                       'dist': dist})
+
+        return results
+
+    def recall(self, recs, workers=None):
+        """Measure the fraction of exact matches that search_single_record finds
+
+        Args:
+            recs (List[dict]): image records to use as queries
+            workers (Optional[int]): number of threads for the exact search (default None)
+
+        Returns:
+            the recall of the word-based search (float), or 1.0 if there are no exact matches
+
+        """
+        exact = self.search_exact(recs, workers=workers)
+
+        n_exact = 0
+        n_found = 0
+        for rec, exact_matches_of_rec in zip(recs, exact):
+            found = set(match['id'] for match in self.search_single_record(rec))
+            n_exact += len(exact_matches_of_rec)
+            n_found += len([match for match in exact_matches_of_rec if match['id'] in found])
+
+        return float(n_found) / n_exact if n_exact > 0 else 1.0
+
+    def merge(self):
+        """Fold pending images into the indexed segment and its inverted index"""
+        if self.n_pending == 0:
+            return
+
+        first_row = self.signatures.shape[0]
+        pending_signatures = self.pending_signatures[:self.n_pending]
+        pending_words = self.pending_words[:self.n_pending]
+        self.signatures = np.concatenate((self.signatures, pending_signatures))
+        self.signature_squared_norms = np.concatenate((self.signature_squared_norms,
+                                                       squared_norms(pending_signatures)))
+        self.words = np.concatenate((self.words, pending_words))
+        self._clear_pending()
+
+        # sort only the new (position, word) keys; a stable sort keeps rows sorted within each key
+        keys = (np.arange(self.N, dtype=np.int64) * self.word_base + pending_words).ravel()
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        rows = (first_row + order // self.N).astype(np.int32)
+
+        # new rows come after all indexed ones, so each goes at the end of its key's postings
+        self.posting_rows = np.insert(self.posting_rows,
+                                      self.posting_starts[np.searchsorted(self.posting_keys, keys, side='right')],
+                                      rows)
+
+        # add the keys seen for the first time, then recount postings per key
+        indexed_keys, indexed_counts = self.posting_keys, np.diff(self.posting_starts)
+        new_keys, new_counts = np.unique(keys, return_counts=True)
+        found = np.searchsorted(indexed_keys, new_keys)
+        seen = found < indexed_keys.shape[0]
+        seen[seen] = indexed_keys[found[seen]] == new_keys[seen]
+        self.posting_keys = np.insert(indexed_keys, found[~seen], new_keys[~seen])
+
+        counts = np.zeros(self.posting_keys.shape[0], dtype=np.int64)
+        counts[np.searchsorted(self.posting_keys, indexed_keys)] += indexed_counts
+        counts[np.searchsorted(self.posting_keys, new_keys)] += new_counts
+        self.posting_starts = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    def save(self, path=None):
+        """Merge pending images and write the index to a directory
+
+        Every file is written next to its destination and renamed into place, so saving
+        over the files the index is memory-mapped from is safe.
+
+        Args:
+            path (Optional[string]): directory to write to (default the path given to the constructor)
+
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError('No path to save the index to')
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.merge()
+
+        for name in ['signatures', 'signature_squared_norms', 'words', 'posting_keys', 'posting_starts', 'posting_rows']:
+            filename = os.path.join(path, name + '.npy')
+            with open(filename + '.tmp', 'wb') as f:
+                np.save(f, getattr(self, name))
+            _replace(filename + '.tmp', filename)
+
+        filename = os.path.join(path, 'records.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump({'k': self.k, 'N': self.N, 'paths': self.paths, 'metadata': self.metadata}, f)
+        _replace(filename + '.tmp', filename)
+
+        self.path = path
+
+    def load(self, path, mmap_mode='r'):
+        """Open an index written by save
+
+        Args:
+            path (string): directory the index was saved to
+            mmap_mode (Optional[string]): numpy memory-map mode, or None to read the index
+                into memory (default 'r')
+
+        """
+        with open(os.path.join(path, 'records.json')) as f:
+            records = json.load(f)
+
+        if records['k'] != self.k or records['N'] != self.N:
+            raise ValueError('Index at %s was built with k=%d, N=%d' % (path, records['k'], records['N']))
+
+        for name in ['signatures', 'words', 'posting_keys', 'posting_starts', 'posting_rows']:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+
+        # indexes saved before norms were stored
+        norms_path = os.path.join(path, 'signature_squared_norms.npy')
+        if os.path.exists(norms_path):
+            self.signature_squared_norms = np.load(norms_path, mmap_mode=mmap_mode)
+        else:
+            self.signature_squared_norms = squared_norms(self.signatures)
+
+        self.paths = records['paths']
+        self.metadata = records['metadata']
+        self._clear_pending()
+
+        self.path = path
+
+    def _signature_rows(self, rows):
+        # gather signatures from both segments
+        indexed = self.signatures.shape[0]
+        in_index = rows < indexed
+
+        signatures = np.empty((rows.shape[0], self.signatures.shape[1]), dtype='int8')
+        signatures[in_index] = self.signatures[rows[in_index]]
+        if not np.all(in_index):
+            signatures[~in_index] = self.pending_signatures[rows[~in_index] - indexed]
+
+        return signatures
+
+    def _clear_pending(self):
+        self.pending_signatures = np.zeros((0, self.gis.sig_length), dtype='int8')
+        self.pending_words = np.zeros((0, self.N), dtype=np.int64)
+        self.n_pending = 0
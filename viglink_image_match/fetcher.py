@@ -0,0 +1,160 @@
+from multiprocessing.pool import ThreadPool
+from threading import BoundedSemaphore, Lock
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+import urllib3
+
+
+class FetchError(RuntimeError):
+    pass
+
+
+class ImageFetcher(object):
+    """Pooled, concurrent image downloader
+
+    Downloads raw image bytes over a pool of keep-alive HTTP connections, with many
+    downloads in flight on a thread pool. The bytes can be passed straight to
+    ImageSignature.preprocess_image (or make_record) with bytestream=True.
+
+    """
+
+    def __init__(self, workers=32, per_host=8, timeout=10., max_bytes=20 * 2**20, retries=2,
+                 num_pools=64, headers=None):
+        """Set up the connection pools and the download thread pool
+
+        Args:
+            workers (Optional[int]): maximum number of downloads in flight (default 32)
+            per_host (Optional[int]): maximum number of concurrent downloads, and of pooled
+                connections, per host (default 8)
+            timeout (Optional[float]): connect and read timeout, in seconds (default 10)
+            max_bytes (Optional[int]): largest response body to accept, in bytes (default 20 MiB)
+            retries (Optional[int]): number of retries on connection errors and 429 or 5xx
+                responses (default 2)
+            num_pools (Optional[int]): number of hosts to keep connection pools for (default 64)
+            headers (Optional[dict]): extra headers to send with every request (default None)
+
+        Examples:
+            >>> fetcher = ImageFetcher(workers=64)
+            >>> data = fetcher.fetch('https://pixabay.com/static/uploads/photo/2012/11/28/08/56/mona-lisa-67506_960_720.jpg')
+            >>> gis.generate_signature(data, bytestream=True)
+            array([ 0,  0,  0, ...,  0,  0,  0], dtype=int8)
+
+        """
+        assert type(workers) is int and workers > 0, 'workers should be a positive integer'
+        assert type(per_host) is int and per_host > 0, 'per_host should be a positive integer'
+
+        self.workers = workers
+        self.per_host = per_host
+        self.max_bytes = max_bytes
+
+        self.http = urllib3.PoolManager(num_pools=num_pools,
+                                        maxsize=per_host,
+                                        headers=headers,
+                                        timeout=urllib3.Timeout(connect=timeout, read=timeout),
+                                        retries=urllib3.Retry(total=retries,
+                                                              backoff_factor=0.1,
+                                                              status_forcelist=[429, 500, 502, 503, 504]))
+
+        self._host_slots = {}
+        self._host_slots_lock = Lock()
+        self._pool = None
+
+    def fetch(self, url):
+        """Download an image
+
+        Args:
+            url (string): http or https URL of the image
+
+        Returns:
+            the raw response body (bytes)
+
+        Raises:
+            FetchError: if the request fails, returns a non-200 status, or the body is
+                larger than max_bytes
+
+        """
+        with self._slot(urlparse(url).netloc):
+            try:
+                response = self.http.request('GET', url, preload_content=False)
+            except urllib3.exceptions.HTTPError as e:
+                raise FetchError('Failed to fetch %s: %s' % (url, e))
+
+            try:
+                if response.status != 200:
+                    raise FetchError('Failed to fetch %s: HTTP %d' % (url, response.status))
+
+                content_length = response.headers.get('content-length')
+                if content_length is not None and content_length.isdigit() \
+                        and int(content_length) > self.max_bytes:
+                    raise FetchError('Image at %s is too large (%s bytes)' % (url, content_length))
+
+                chunks = []
+                size = 0
+                for chunk in response.stream(64 * 1024):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise FetchError('Image at %s is larger than %d bytes' % (url, self.max_bytes))
+                    chunks.append(chunk)
+            except urllib3.exceptions.HTTPError as e:
+                raise FetchError('Failed to fetch %s: %s' % (url, e))
+            finally:
+                response.release_conn()
+
+        return b''.join(chunks)
+
+    def fetch_many(self, urls):
+        """Download many images concurrently
+
+        A failed download only fails its own entry: the FetchError is returned in place
+        of its bytes.
+
+        Args:
+            urls (Iterable[string]): http or https URLs of the images
+
+        Returns:
+            a list of raw response bodies (or FetchError instances), in input order
+
+        """
+        return self._get_pool().map(self._fetch_or_error, urls)
+
+    def imap(self, urls):
+        """Download many images concurrently, yielding them as they complete, in input order
+
+        Args:
+            urls (Iterable[string]): http or https URLs of the images
+
+        Returns:
+            an iterator of (url, bytes or FetchError) tuples
+
+        """
+        return self._get_pool().imap(self._fetch_with_url, urls)
+
+    def close(self):
+        """Stop the download threads and close all pooled connections"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self.http.clear()
+
+    def _fetch_or_error(self, url):
+        try:
+            return self.fetch(url)
+        except FetchError as e:
+            return e
+
+    def _fetch_with_url(self, url):
+        return url, self._fetch_or_error(url)
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(processes=self.workers)
+        return self._pool
+
+    def _slot(self, host):
+        with self._host_slots_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
@@ -0,0 +1,124 @@
+from signature_database_base import exact_matches
+from signature_database_base import squared_norms
+from signature_database_base import record_words
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+import time
+
+
+class RecentRecords(object):
+    """In-memory overlay of recently inserted records, for read-your-writes searches
+
+    Documents indexed into Elasticsearch only become searchable at the next index
+    refresh, so near-duplicates arriving within a second or two of each other would
+    not find each other. Drivers add every record they insert here, and merge matches
+    against the overlay into their search results. Entries expire after ttl seconds,
+    which should be longer than the refresh interval of the index.
+
+    The overlay is per process: writes from other processes are only seen once
+    Elasticsearch has refreshed.
+
+    """
+
+    def __init__(self, N=63, ttl=30., max_records=65536):
+        """Set up an empty overlay
+
+        Args:
+            N (Optional[int]): number of words per record (default 63)
+            ttl (Optional[float]): how long to keep records, in seconds (default 30)
+            max_records (Optional[int]): maximum number of records to keep; the oldest are
+                dropped first (default 65536)
+
+        Examples:
+            >>> recent = RecentRecords(ttl=10.)
+            >>> ses = SignatureES(es, recent_records=recent)
+
+        """
+        self.N = N
+        self.ttl = ttl
+        self.max_records = max_records
+
+        # doc id -> (insertion time, record), oldest first
+        self._records = OrderedDict()
+        self._lock = Lock()
+
+        # stacked signatures, norms and words of _records, rebuilt after changes
+        self._arrays = None
+
+    def __len__(self):
+        with self._lock:
+            self._expire()
+            return len(self._records)
+
+    def add(self, doc_id, rec):
+        """Remember an inserted record
+
+        Args:
+            doc_id (string): the document id the record was indexed with
+            rec (dict): the image record, in the format returned by make_record
+
+        """
+        entry = {'path': rec['path'],
+                 'metadata': rec.get('metadata'),
+                 'signature': np.array(rec['signature'], dtype='int8'),
+                 'words': np.array(record_words(rec, self.N), dtype=np.int64)}
+
+        with self._lock:
+            self._records.pop(doc_id, None)
+            self._records[doc_id] = (time.time(), entry)
+            while len(self._records) > self.max_records:
+                self._records.popitem(last=False)
+            self._arrays = None
+
+    def search(self, recs, distance_cutoff):
+        """Find recent records within distance_cutoff of each query record
+
+        Args:
+            recs (List[dict]): image records to search for, in the format returned by make_record
+            distance_cutoff (float): maximum distance of a match
+
+        Returns:
+            a list with one list of matches per record, in the format returned by
+                search_single_record, with the number of shared words as score
+
+        """
+        with self._lock:
+            self._expire()
+            if not self._records:
+                return [[] for _ in recs]
+
+            if self._arrays is None:
+                entries = [entry for _, entry in self._records.values()]
+                signatures = np.array([entry['signature'] for entry in entries])
+                self._arrays = (list(self._records.keys()), entries, signatures, squared_norms(signatures),
+                                np.array([entry['words'] for entry in entries]))
+            doc_ids, entries, signatures, norms, words = self._arrays
+
+        queries = np.array([rec['signature'] for rec in recs], dtype='int8')
+        query_words = np.array([record_words(rec, self.N) for rec in recs], dtype=np.int64)
+
+        query_rows, rows, dists = exact_matches(queries, signatures, distance_cutoff, target_squared_norms=norms)
+
+        results = [[] for _ in recs]
+        for query_row, row, dist in zip(query_rows, rows, dists):
+            results[query_row].append({'id': doc_ids[row],
+                                       'score': int(np.sum(words[row] == query_words[query_row])),
+                                       'metadata': entries[row]['metadata'],
+                                       'path': entries[row]['path'],
+                                       'dist': dist})
+
+        return results
+
+    def clear(self):
+        """Forget all records"""
+        with self._lock:
+            self._records.clear()
+            self._arrays = None
+
+    def _expire(self):
+        # drop records older than ttl; call with lock held
+        oldest = time.time() - self.ttl
+        while self._records and next(iter(self._records.values()))[0] < oldest:
+            self._records.popitem(last=False)
+            self._arrays = None
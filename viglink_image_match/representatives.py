@@ -0,0 +1,257 @@
+from signature_database_base import normalized_distances
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+
+
+class ClusterRepresentatives(object):
+    """Secondary index of a few representative images per cluster
+
+    Large clusters of near-duplicates fill member-level search results with
+    redundant hits. This index holds at most max_representatives images per
+    cluster instead, chosen incrementally as a cover: an image becomes a
+    representative of its cluster if it is further than spread from all the
+    cluster's representatives so far. Every member is then within about spread of
+    a representative, so searching representatives within distance_cutoff + spread
+    finds every cluster the image could join.
+
+    The search is only trusted when it is unambiguous: all representatives found
+    belong to one cluster and one of them is within distance_cutoff. Otherwise,
+    including when no representative is close enough, the caller should fall back to
+    member-level search, since a cluster at max_representatives may have members
+    outside the cover.
+
+    Normalized distance is not a true metric, and a cluster at max_representatives
+    may have members outside the cover, so this is a heuristic that trades a little
+    accuracy for much smaller searches.
+
+    The number of representatives of each cluster is counted locally, seeded from the
+    index the first time a cluster is seen, since representatives added moments ago
+    are not counted by Elasticsearch until the next refresh.
+
+    """
+
+    def __init__(self, ses, distance_cutoff, spread=None, max_representatives=3, max_clusters=65536):
+        """Set up the representative index
+
+        Args:
+            ses (SignatureES): driver for the representative index. Its
+                distance_cutoff should be at least distance_cutoff + spread. Use
+                path_ids, so that re-adding a representative is a no-op, and
+                recent_records, so that new representatives are found right away
+            distance_cutoff (float): maximum distance between near-duplicates
+            spread (Optional[float]): maximum distance from a member to the nearest
+                representative of its cluster (default distance_cutoff / 2)
+            max_representatives (Optional[int]): maximum number of representatives per
+                cluster (default 3)
+            max_clusters (Optional[int]): maximum number of clusters to keep local
+                representative counts for; the least recently used are dropped first, and
+                counted again in the index when seen again (default 65536)
+
+        Examples:
+            >>> reps = ClusterRepresentatives(SignatureES(es, index='images_0.1_representatives',
+            ...                                           distance_cutoff=0.15, path_ids=True), 0.1)
+            >>> near_dups = reps.near_duplicates(rec)
+
+        """
+        self.ses = ses
+        self.distance_cutoff = distance_cutoff
+        self.spread = distance_cutoff / 2. if spread is None else spread
+        self.max_representatives = max_representatives
+        self.max_clusters = max_clusters
+
+        # cluster id -> number of representatives, least recently used first
+        self._counts = OrderedDict()
+        self._lock = Lock()
+
+        if ses.distance_cutoff < distance_cutoff + self.spread:
+            raise ValueError('The representative index should have distance_cutoff >= %r (got %r)'
+                             % (distance_cutoff + self.spread, ses.distance_cutoff))
+
+    def search(self, rec):
+        """Search for representatives near a record
+
+        Args:
+            rec (dict): an image record, in the format returned by make_record
+
+        Returns:
+            matching representatives, as returned by search_record
+
+        """
+        return self.ses.search_record(rec)
+
+    def near_duplicates(self, rec, hits=None):
+        """Find the cluster of a record from representatives, if that is unambiguous
+
+        Args:
+            rec (dict): an image record, in the format returned by make_record
+            hits (Optional[List[dict]]): representatives near rec, as returned by search
+                (default None, search for them)
+
+        Returns:
+            a list of near-duplicate metadata to take the majority vote over, as
+                get_near_duplicates in DuplicateClusterAssignment returns: the metadata of
+                the one cluster rec belongs to. None if the caller should fall back to
+                member-level search
+
+        """
+        if hits is None:
+            hits = self.search(rec)
+
+        if len(hits) == 0:
+            return None
+
+        clusters = set(_cluster_id(hit) for hit in hits)
+        if len(clusters) == 1 and None not in clusters and hits[0]['dist'] < self.distance_cutoff:
+            return [hits[0]['metadata']]
+
+        return None
+
+    def add_member(self, rec, cluster_id, hits=None):
+        """Update representatives after a record was added to a cluster
+
+        Args:
+            rec (dict): the image record, in the format returned by make_record
+            cluster_id (string): the cluster it was added to
+            hits (Optional[List[dict]]): representatives near rec, as returned by search
+                (default None, search for them)
+
+        Returns:
+            True if rec became a representative of its cluster
+
+        """
+        if hits is None:
+            hits = self.search(rec)
+
+        own = [hit['dist'] for hit in hits if _cluster_id(hit) == cluster_id]
+        if own and min(own) <= self.spread:
+            return False
+
+        if len(own) >= self.max_representatives:
+            return False
+
+        # claim a slot before inserting, so that concurrent members cannot exceed the limit
+        self.counts([cluster_id])
+        with self._lock:
+            count = max(self._counts.get(cluster_id, 0), len(own))
+            if count >= self.max_representatives:
+                return False
+            self._counts[cluster_id] = count + 1
+
+        self.ses.insert_single_record(self.representative_record(rec, cluster_id))
+
+        return True
+
+    def counts(self, cluster_ids):
+        """Count the representatives of many clusters
+
+        Clusters without a local count are counted in the index, with one terms
+        aggregation for all of them. Call this once per batch, before add_member.
+
+        Args:
+            cluster_ids (List[string]): cluster ids
+
+        Returns:
+            a dict of the number of representatives by cluster id
+
+        """
+        with self._lock:
+            missing = [cluster_id for cluster_id in OrderedDict.fromkeys(cluster_ids)
+                       if cluster_id not in self._counts]
+
+        stored = {}
+        if missing:
+            body = {'size': 0,
+                    'query': {'terms': {'metadata.clusterid': missing}},
+                    'aggs': {'clusters': {'terms': {'field': 'metadata.clusterid', 'size': len(missing)}}}}
+            buckets = self.ses.es.search(index=self.ses.index, doc_type=self.ses.doc_type,
+                                         body=body)['aggregations']['clusters']['buckets']
+            stored = dict((bucket['key'], bucket['doc_count']) for bucket in buckets)
+
+        with self._lock:
+            counts = {}
+            for cluster_id in cluster_ids:
+                count = self._counts.pop(cluster_id, None)
+                if count is None:
+                    count = stored.get(cluster_id, 0)
+                self._counts[cluster_id] = counts[cluster_id] = count
+            while len(self._counts) > self.max_clusters:
+                self._counts.popitem(last=False)
+
+        return counts
+
+    def add_cluster(self, recs, cluster_id, sample_size=256):
+        """Add representatives for a whole cluster at once, e.g. after bulk clustering
+
+        Args:
+            recs (List[dict]): image records of the members of the cluster
+            cluster_id (string): the cluster id
+            sample_size (Optional[int]): as for choose (default 256)
+
+        Returns:
+            the number of representatives added
+
+        """
+        signatures = np.array([rec['signature'] for rec in recs], dtype='int8')
+        representatives = [self.representative_record(recs[i], cluster_id)
+                           for i in self.choose(signatures, sample_size=sample_size)]
+        self.ses.insert_records(representatives)
+
+        with self._lock:
+            self._counts[cluster_id] = self._counts.pop(cluster_id, 0) + len(representatives)
+            while len(self._counts) > self.max_clusters:
+                self._counts.popitem(last=False)
+
+        return len(representatives)
+
+    def choose(self, signatures, sample_size=256):
+        """Choose representatives among the members of a cluster
+
+        The first representative is the medoid of the cluster, the member with the
+        smallest total distance to the others. Further ones are added greedily, as the
+        member furthest from the representatives so far, while it is further than spread.
+
+        Args:
+            signatures (numpy.ndarray): signatures of the members of the cluster
+            sample_size (Optional[int]): compute distances among at most this many
+                members, chosen evenly (default 256)
+
+        Returns:
+            a list of row numbers of the representatives in signatures
+
+        """
+        if signatures.shape[0] == 1:
+            return [0]
+
+        rows = np.arange(signatures.shape[0])
+        if rows.shape[0] > sample_size:
+            rows = np.linspace(0, rows.shape[0] - 1, sample_size).astype(int)
+        dists = normalized_distances(signatures[rows], signatures[rows])
+
+        chosen = [int(np.argmin(np.sum(dists, axis=1)))]
+        nearest = dists[chosen[0]].copy()
+        while len(chosen) < self.max_representatives and np.max(nearest) > self.spread:
+            chosen.append(int(np.argmax(nearest)))
+            nearest = np.minimum(nearest, dists[chosen[-1]])
+
+        return [int(rows[i]) for i in chosen]
+
+    @staticmethod
+    def representative_record(rec, cluster_id):
+        """Make the representative index record for a member
+
+        Args:
+            rec (dict): image record of the member
+            cluster_id (string): its cluster id
+
+        Returns:
+            a copy of rec, with only the cluster id as metadata
+
+        """
+        representative = dict((key, value) for key, value in rec.items() if key != 'metadata')
+        representative['metadata'] = {'clusterid': cluster_id}
+        return representative
+
+
+def _cluster_id(hit):
+    return (hit.get('metadata') or {}).get('clusterid')
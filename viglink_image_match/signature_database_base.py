@@ -1,7 +1,11 @@
-from goldberg import ImageSignature
-from itertools import product
+from goldberg import ImageSignature, CorruptImageError
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
+from threading import Lock
 import numpy as np
+import hashlib
+import sqlite3
 
 
 class SignatureDatabaseBase(object):
@@ -72,6 +76,22 @@ class SignatureDatabaseBase(object):
         """
         raise NotImplementedError
 
+    def search_records(self, recs):
+        """Search for matches to many image records at once.
+
+        The default implementation calls search_single_record for each record. Derived
+        classes can override it to send all queries to the database in one request.
+
+        Args:
+            recs (List[dict]): image records, in the format returned by make_record
+
+        Returns:
+            a list with one list of matches per record, each in the format returned by
+                search_single_record
+
+        """
+        return [self.search_single_record(rec) for rec in recs]
+
     def insert_single_record(self, rec):
         """Insert an image record.
 
@@ -153,6 +173,11 @@ class SignatureDatabaseBase(object):
                 considering how much variance to keep in the image (default (5, 95))
             distance_cutoff (Optional [float]): maximum image signature distance to
                 be considered a match (default 0.45)
+            signature_cache (Optional[SignatureCache]): keyword only. Cache of signatures and
+                words to consult before downloading and signing an image (default None)
+            word_layout (Optional[string]): keyword only. How records store their words:
+                'fields', one simple_word_<i> field per word, or 'tokens', a single 'words' list
+                of position-tagged tokens like '17:4302911' (default 'fields')
             *signature_args: Variable length argument list to pass to ImageSignature
             **signature_kwargs: Arbitrary keyword arguments to pass to ImageSignature
 
@@ -179,6 +204,14 @@ class SignatureDatabaseBase(object):
 
         self.crop_percentile = crop_percentile
 
+        self.signature_cache = signature_kwargs.pop('signature_cache', None)
+
+        word_layout = signature_kwargs.pop('word_layout', 'fields')
+        if word_layout not in WORD_LAYOUTS:
+            raise ValueError('word_layout should be one of %r (got %r)' % (WORD_LAYOUTS, word_layout))
+
+        self.word_layout = word_layout
+
         self.gis = ImageSignature(n=n_grid, crop_percentiles=crop_percentile, *signature_args, **signature_kwargs)
 
     def add_image(self, path, img=None, bytestream=False, metadata=None, refresh_after=False):
@@ -198,21 +231,33 @@ class SignatureDatabaseBase(object):
                 (default False)
             metadata (Optional): any other information you want to include, can be nested (default None)
 
+        Returns:
+            the inserted image record, in the format returned by make_record
+
         """
-        rec = make_record(path, self.gis, self.k, self.N, img=img, bytestream=bytestream, metadata=metadata)
+        rec = make_record(path, self.gis, self.k, self.N, img=img, bytestream=bytestream, metadata=metadata,
+                          cache=self.signature_cache, word_layout=self.word_layout)
         self.insert_single_record(rec, refresh_after=refresh_after)
 
-    def search_image(self, path, all_orientations=False, bytestream=False):
+        return rec
+
+    def search_image(self, path, all_orientations=False, bytestream=False, approximate_orientations=False):
         """Search for matches
 
         Args:
             path (string): path or image data. If bytestream=False, then path is assumed to be
                 a URL or filesystem path. Otherwise, it's assumed to be raw image data
             all_orientations (Optional[boolean]): if True, search for all combinations of mirror
-                images, rotations, and color inversions (default False)
+                images, rotations, and color inversions. The image is decoded once, and all
+                variants are searched with a single call to search_records (default False)
             bytestream (Optional[boolean]): will the image be passed as raw bytes?
                 That is, is the 'path_or_image' argument an in-memory image?
                 (default False)
+            approximate_orientations (Optional[boolean]): with all_orientations, derive the
+                rotations and mirror images from the signature of the image as given instead
+                of signing each transformed image. Faster, but the variants can be as far as
+                a near-duplicate threshold from the true ones, see
+                ImageSignature.compute_orientation_signatures (default False)
 
         Returns:
             a formatted list of dicts representing unique matches, sorted by dist
@@ -232,54 +277,238 @@ class SignatureDatabaseBase(object):
             ]
 
         """
-        img = self.gis.preprocess_image(path, bytestream)
-
+        if all_orientations and not approximate_orientations:
+            # the first variant is the image as given
+            orientations = self.gis.generate_orientation_signatures(path, bytestream=bytestream)
+            rec = make_record_from_signature(path, orientations[0], self.k, self.N, word_layout=self.word_layout)
+            return self.search_record(rec, orientations=orientations)
+
+        rec = make_record(path, self.gis, self.k, self.N, bytestream=bytestream, cache=self.signature_cache,
+                          word_layout=self.word_layout)
         if all_orientations:
-            # initialize an iterator of composed transformations
-            inversions = [lambda x: x, lambda x: -x]
-
-            mirrors = [lambda x: x, np.fliplr]
+            return self.search_record(rec, orientations=self.gis.compute_orientation_signatures(rec['signature']))
 
-            # an ugly solution for function composition
-            rotations = [lambda x: x,
-                         np.rot90,
-                         lambda x: np.rot90(x, 2),
-                         lambda x: np.rot90(x, 3)]
+        return self.search_record(rec)
 
-            # cartesian product of all possible orientations
-            orientations = product(inversions, rotations, mirrors)
+    def search_record(self, rec, orientations=None):
+        """Search for matches to a precomputed image record
 
-        else:
-            # otherwise just use the identity transformation
-            orientations = [lambda x: x]
+        Unlike search_single_record, rec is left unchanged, so the same record can be
+        searched for and then inserted without computing its signature again.
 
-        # try for every possible combination of transformations; if all_orientations=False,
-        # this will only take one iteration
-        result = []
+        Args:
+            rec (dict): an image record, in the format returned by make_record
+            orientations (Optional[numpy.ndarray]): signatures of rotations, mirror images and
+                color inversions of the image to search for as well, as returned by
+                ImageSignature.generate_orientation_signatures (default None)
 
-        orientations = set(np.ravel(list(orientations)))
-        for transform in orientations:
-            # compose all functions and apply on signature
-            transformed_img = transform(img)
+        Returns:
+            a formatted list of dicts representing unique matches, sorted by dist, as
+                returned by search_image
 
-            # generate the signature
-            transformed_record = make_record(transformed_img, self.gis, self.k, self.N)
+        """
+        if orientations is not None:
+            # featureless images have fewer distinct variants
+            signatures = np.unique(np.concatenate(([rec['signature']], orientations)).astype('int8'), axis=0)
+
+            words = signatures_to_words(signatures, self.k, self.N).tolist()
+            records = [make_record_from_signature(rec['path'], signature, self.k, self.N, words=w,
+                                                  word_layout=self.word_layout)
+                       for signature, w in zip(signatures, words)]
+        else:
+            records = [dict((key, value) for key, value in rec.items()
+                            if key in ('path', 'signature', 'words') or key.startswith('simple_word_'))]
 
-            l = self.search_single_record(transformed_record)
+        result = []
+        for l in self.search_records(records):
             result.extend(l)
 
+        # keep the closest match for each id
         ids = set()
         unique = []
-        for item in result:
+        for item in sorted(result, key=itemgetter('dist')):
             if item['id'] not in ids:
                 unique.append(item)
                 ids.add(item['id'])
 
-        r = sorted(unique, key=itemgetter('dist'))
-        return r
+        return unique
+
+
+class SignatureCache(object):
+    """Cache of image signatures and words, so that repeated images are not signed again
+
+    Entries are kept in an in-process LRU, evicted by total size, and optionally in an
+    sqlite database on disk that survives restarts and can be shared between processes.
+
+    Entries are keyed by image URL or path and, if hash_content is True, also by a hash
+    of the raw image bytes, so that the same bytes under a different URL still hit.
+    Every key is namespaced by a fingerprint of k, N and the ImageSignature parameters,
+    so changing any of them invalidates all existing entries.
+
+    """
+
+    def __init__(self, max_bytes=64 * 2**20, path=None, hash_content=False):
+        """Set up the cache
+
+        Args:
+            max_bytes (Optional[int]): approximate maximum size of the in-process tier, in
+                bytes (default 64 MiB)
+            path (Optional[string]): filesystem path of an sqlite database to use as a second,
+                on-disk tier. If None, only the in-process tier is used (default None)
+            hash_content (Optional[boolean]): also key entries by a hash of the raw image
+                bytes, when those are available (default False)
+
+        """
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+        self.path = path
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS signatures '
+                             '(key TEXT PRIMARY KEY, signature BLOB, words BLOB)')
+            self._db.commit()
+        else:
+            self._db = None
+
+    def keys_for(self, path, gis, k, N, img=None, bytestream=False):
+        """Computes the cache keys of an image, as passed to make_record
+
+        Args:
+            path (string): path or image data, as for make_record
+            gis (ImageSignature): the signature generator that will be used
+            k (int): width of words for encoding
+            N (int): number of words for encoding
+            img (Optional[string]): image data or location, as for make_record (default None)
+            bytestream (Optional[boolean]): as for make_record (default False)
+
+        Returns:
+            a list of keys, possibly empty if the image cannot be identified
+
+        """
+        if bytestream:
+            location, content = (path, img) if img is not None else (None, path)
+        else:
+            location, content = (img, None) if img is not None else (path, None)
+
+        fingerprint = signature_fingerprint(gis, k, N)
+
+        keys = []
+        if location is not None and not isinstance(location, np.ndarray):
+            keys.append(':'.join([fingerprint, 'path', location]))
+        if content is not None and self.hash_content:
+            keys.append(':'.join([fingerprint, 'sha1', hashlib.sha1(content).hexdigest()]))
+
+        return keys
+
+    def get(self, keys):
+        """Look up an entry under any of several keys
+
+        On a hit, the entry is also stored in the in-process tier under the other keys.
+
+        Args:
+            keys (List[string]): keys, as returned by keys_for
+
+        Returns:
+            a (signature, words) tuple, or None on a miss
+
+        """
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    entry, size = self._entries.pop(key)
+                    self._entries[key] = (entry, size)
+                    break
+
+                if self._db is not None:
+                    row = self._db.execute('SELECT signature, words FROM signatures WHERE key = ?',
+                                           (key,)).fetchone()
+                    if row is not None:
+                        entry = (np.frombuffer(bytes(row[0]), dtype='int8'),
+                                 np.frombuffer(bytes(row[1]), dtype='int64').tolist())
+                        break
+            else:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._remember(keys, entry)
+
+        return entry
+
+    def put(self, keys, signature, words):
+        """Store an entry under several keys
+
+        Args:
+            keys (List[string]): keys, as returned by keys_for
+            signature (numpy.ndarray): the image signature
+            words (List[int]): the integer words of signature
+
+        """
+        entry = (np.asarray(signature, dtype='int8'), list(words))
+
+        with self._lock:
+            self._remember(keys, entry)
+
+            if self._db is not None and keys:
+                self._db.executemany('INSERT OR REPLACE INTO signatures VALUES (?, ?, ?)',
+                                     [(key, sqlite3.Binary(entry[0].tobytes()),
+                                       sqlite3.Binary(np.array(entry[1], dtype='int64').tobytes()))
+                                      for key in keys])
+                self._db.commit()
+
+    def _remember(self, keys, entry):
+        # store in the in-process tier and evict least recently used entries; call with lock held
+        size = entry[0].nbytes + 8 * len(entry[1])
+
+        for key in keys:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (entry, size + len(key))
+            self._size += size + len(key)
+
+        while self._size > self.max_bytes and self._entries:
+            self._size -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        """Remove all entries from both tiers and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+            if self._db is not None:
+                self._db.execute('DELETE FROM signatures')
+                self._db.commit()
 
 
-def make_record(path, gis, k, N, img=None, bytestream=False, metadata=None):
+WORD_LAYOUTS = ('fields', 'tokens')
+
+
+def signature_fingerprint(gis, k, N):
+    """Identifies the parameters that determine signatures and words.
+
+    Args:
+        gis (ImageSignature): an instance of ImageSignature
+        k (int): width of words for encoding
+        N (int): number of words for encoding
+
+    Returns:
+        a short string that changes whenever k, N or any ImageSignature parameter does
+
+    """
+    parameters = sorted(vars(gis).items())
+    return hashlib.md5(repr((k, N, parameters)).encode('utf-8')).hexdigest()[:12]
+
+
+def make_record(path, gis, k, N, img=None, bytestream=False, metadata=None, cache=None, word_layout='fields'):
     """Makes a record suitable for database insertion.
 
     Note:
@@ -299,11 +528,16 @@ def make_record(path, gis, k, N, img=None, bytestream=False, metadata=None):
             not None, then img is assumed to be the URL or filesystem path. Thus, you can store
             image records with a different 'path' than the actual image location (default None)
         bytestream (Optional[boolean]): will the image be passed as raw bytes?
-            That is, is the 'path_or_image' argument an in-memory image? If img is None but, this
-            argument will be ignored.  If img is not None, and bytestream is False, then the behavior
+            That is, is the 'path_or_image' argument an in-memory image? If img is None, path
+            itself is the raw image data.  If img is not None, and bytestream is False, then the behavior
             is as described in the explanation for the img argument
             (default False)
         metadata (Optional): any other information you want to include, can be nested (default None)
+        cache (Optional[SignatureCache]): cache to look the signature and words up in, and to
+            store them in after computing them (default None)
+        word_layout (Optional[string]): 'fields' to store words as simple_word_<i> fields, or
+            'tokens' to store them as a single 'words' list of position-tagged tokens,
+            e.g. ['0:42252475', '1:23885671', ...] (default 'fields')
 
     Returns:
         An image record.
@@ -333,29 +567,170 @@ def make_record(path, gis, k, N, img=None, bytestream=False, metadata=None):
          }
 
     """
-    record = dict()
-    record['path'] = path
+    if cache is not None:
+        keys = cache.keys_for(path, gis, k, N, img=img, bytestream=bytestream)
+        cached = cache.get(keys)
+        if cached is not None:
+            signature, words = cached
+            return make_record_from_signature(path, signature, k, N, metadata=metadata, words=words,
+                                              word_layout=word_layout)
+
     if img is not None:
         signature = gis.generate_signature(img, bytestream=bytestream)
     else:
-        signature = gis.generate_signature(path)
+        signature = gis.generate_signature(path, bytestream=bytestream)
+
+    words = signatures_to_words(signature, k, N).tolist()
+    record = make_record_from_signature(path, signature, k, N, metadata=metadata, words=words,
+                                        word_layout=word_layout)
+
+    if cache is not None:
+        cache.put(keys, signature, words)
+
+    return record
+
+
+def make_records(paths, gis, k, N, imgs=None, bytestream=False, metadatas=None, workers=None,
+                 word_layout='fields'):
+    """Makes many records suitable for database insertion.
+
+    Signatures are generated across a process pool with ImageSignature.generate_signatures.
+    An image that cannot be decoded only fails its own entry: the CorruptImageError is
+    returned in place of its record.
+
+    Args:
+        paths (List[string]): paths or identifiers for the images, as for make_record
+        gis (ImageSignature): an instance of ImageSignature for generating the
+            signatures
+        k (int): width of words for encoding
+        N (int): number of words for encoding
+        imgs (Optional[List[string]]): image data or locations, one per path, as the img
+            argument of make_record (default None)
+        bytestream (Optional[boolean]): are the entries of imgs raw bytes? Ignored if imgs
+            is None (default False)
+        metadatas (Optional[List]): metadata, one per path (default None)
+        workers (Optional[int]): number of worker processes (default None, no pool)
+        word_layout (Optional[string]): 'fields' or 'tokens', as for make_record (default 'fields')
+
+    Returns:
+        a list of image records (or CorruptImageError instances), in input order
+
+    """
+    if imgs is not None:
+        signatures = gis.generate_signatures(imgs, bytestream=bytestream, workers=workers)
+    else:
+        signatures = gis.generate_signatures(paths, workers=workers)
 
+    if metadatas is None:
+        metadatas = [None] * len(paths)
+
+    # encode the words of all good signatures in one batch
+    good = [i for i, signature in enumerate(signatures) if not isinstance(signature, CorruptImageError)]
+    words = dict()
+    if good:
+        words = dict(zip(good, signatures_to_words(np.array([signatures[i] for i in good]), k, N).tolist()))
+
+    return [signature if isinstance(signature, CorruptImageError)
+            else make_record_from_signature(path, signature, k, N, metadata=metadata, words=words[i],
+                                            word_layout=word_layout)
+            for i, (path, signature, metadata) in enumerate(zip(paths, signatures, metadatas))]
+
+
+def make_record_from_signature(path, signature, k, N, metadata=None, words=None, word_layout='fields'):
+    """Makes a record from an already computed signature.
+
+    Args:
+        path (string): path or identifier for the image
+        signature (numpy.ndarray): the image signature, as returned by
+            ImageSignature.generate_signature
+        k (int): width of words for encoding
+        N (int): number of words for encoding
+        metadata (Optional): any other information you want to include, can be nested (default None)
+        words (Optional[List[int]]): the N integer words of signature, if already known (default None)
+        word_layout (Optional[string]): 'fields' or 'tokens', as for make_record (default 'fields')
+
+    Returns:
+        An image record, in the format returned by make_record
+
+    """
+    record = dict()
+    record['path'] = path
     record['signature'] = signature.tolist()
 
     if metadata:
         record['metadata'] = metadata
 
-    words = get_words(signature, k, N)
-    max_contrast(words)
-
-    words = words_to_int(words)
+    if words is None:
+        words = signatures_to_words(signature, k, N).tolist()
 
-    for i in range(N):
-        record[''.join(['simple_word_', str(i)])] = words[i].tolist()
+    set_record_words(record, words, word_layout)
 
     return record
 
 
+def record_words(rec, N):
+    """Gets the integer words of a record, in either word layout.
+
+    Args:
+        rec (dict): an image record, in the format returned by make_record
+        N (int): number of words
+
+    Returns:
+        a list of N integer words, in position order
+
+    """
+    if 'words' in rec:
+        words = [0] * N
+        for token in rec['words']:
+            position, word = token.split(':')
+            words[int(position)] = int(word)
+        return words
+
+    return [rec[''.join(['simple_word_', str(i)])] for i in range(N)]
+
+
+def set_record_words(rec, words, word_layout):
+    """Stores integer words in a record, replacing any words it already has.
+
+    Args:
+        rec (dict): an image record, modified in place
+        words (List[int]): integer words, in position order
+        word_layout (string): 'fields' or 'tokens', as for make_record
+
+    """
+    for key in [key for key in rec if key == 'words' or key.startswith('simple_word_')]:
+        del rec[key]
+
+    if word_layout == 'tokens':
+        rec['words'] = [''.join([str(i), ':', str(word)]) for i, word in enumerate(words)]
+    elif word_layout == 'fields':
+        for i, word in enumerate(words):
+            rec[''.join(['simple_word_', str(i)])] = word
+    else:
+        raise ValueError('word_layout should be one of %r (got %r)' % (WORD_LAYOUTS, word_layout))
+
+
+def convert_record(rec, N, word_layout):
+    """Makes a copy of a record in another word layout.
+
+    Useful for migrating records, e.g. from one simple_word_<i> field per word to a
+    single field of position-tagged tokens.
+
+    Args:
+        rec (dict): an image record, in either word layout
+        N (int): number of words
+        word_layout (string): 'fields' or 'tokens', as for make_record
+
+    Returns:
+        a new image record, with the same words in word_layout
+
+    """
+    converted = dict(rec)
+    set_record_words(converted, record_words(rec, N), word_layout)
+
+    return converted
+
+
 def get_words(array, k, N):
     """Gets N words of length k from an array.
 
@@ -371,36 +746,53 @@ def get_words(array, k, N):
     [0, 1]
 
     Args:
-        array (numpy.ndarray): array to split into words
+        array (numpy.ndarray): array to split into words, or an M x m array of
+            many signatures to split at once
         k (int): word length
         N (int): number of words
 
     Returns:
-        an array with N rows of length k
+        an array with N rows of length k (M x N x k for M signatures)
 
     """
+    length = array.shape[-1]
+
     # generate starting positions of each word
-    word_positions = np.linspace(0, array.shape[0],
+    word_positions = np.linspace(0, length,
                                  N, endpoint=False).astype('int')
 
     # check that inputs make sense
-    if k > array.shape[0]:
+    if k > length:
         raise ValueError('Word length cannot be longer than array length')
-    if word_positions.shape[0] > array.shape[0]:
+    if word_positions.shape[0] > length:
         raise ValueError('Number of words cannot be more than array length')
 
-    # create empty words array
-    words = np.zeros((N, k)).astype('int8')
+    # pad with zeros, so that words running past the end are zero-filled
+    padded = np.zeros(array.shape[:-1] + (length + k,), dtype='int8')
+    padded[..., :length] = array
 
-    for i, pos in enumerate(word_positions):
-        if pos + k <= array.shape[0]:
-            words[i] = array[pos:pos+k]
-        else:
-            temp = array[pos:].copy()
-            temp.resize(k)
-            words[i] = temp
+    # gather all words at once
+    return padded[..., word_positions[:, np.newaxis] + np.arange(k)]
+
+
+def signatures_to_words(signatures, k, N):
+    """Encodes many signatures as integer words at once.
 
-    return words
+    Equivalent to get_words, max_contrast and words_to_int applied to each signature,
+    with a handful of array operations for the whole batch.
+
+    Args:
+        signatures (numpy.ndarray): M x m array of signatures (or a single signature)
+        k (int): word length
+        N (int): number of words
+
+    Returns:
+        an M x N array of integer words (or an array of N for a single signature)
+
+    """
+    words = np.sign(get_words(np.asarray(signatures), k, N))
+
+    return words_to_int(words)
 
 
 def words_to_int(word_array):
@@ -417,13 +809,14 @@ def words_to_int(word_array):
     [ 0,   1,  0] -> 16
 
     Args:
-        word_array (numpy.ndarray): N x k array
+        word_array (numpy.ndarray): N x k array (or M x N x k for many signatures)
 
     Returns:
-        an array of integers of length N (the integer word encodings)
+        an array of integers of length N (M x N for many signatures), the integer
+            word encodings
 
     """
-    width = word_array.shape[1]
+    width = word_array.shape[-1]
 
     # Three states (-1, 0, 1)
     coding_vector = 3**np.arange(width)
@@ -447,7 +840,7 @@ def max_contrast(array):
     return None
 
 
-def normalized_distance(_target_array, _vec, nan_value=1.0):
+def normalized_distance(_target_array, _vec, nan_value=1.0, target_squared_norms=None):
     """Compute normalized distance to many points.
 
     Computes || vec - b || / ( ||vec|| + ||b||) for every b in target_array
@@ -457,16 +850,327 @@ def normalized_distance(_target_array, _vec, nan_value=1.0):
         _vec (numpy.ndarray): array of size m
         nan_value (Optional[float]): value to replace 0.0/0.0 = nan with
             (default 1.0, to take those featureless images out of contention)
+        target_squared_norms (Optional[numpy.ndarray]): squared norms of the rows of
+            _target_array, as returned by squared_norms. Computed if not given (default None)
 
     Returns:
         the normalized distance (float)
     """
-    target_array = _target_array.astype(int)
-    vec = _vec.astype(int)
-    topvec = np.linalg.norm(vec - target_array, axis=1)
-    norm1 = np.linalg.norm(vec, axis=0)
-    norm2 = np.linalg.norm(target_array, axis=1)
-    finvec = topvec / (norm1 + norm2)
+    # signature elements are small, so int16 differences and int32 sums are exact
+    target_array = np.asarray(_target_array, dtype=np.int16)
+    vec = np.asarray(_vec, dtype=np.int16)
+    diff = target_array - vec
+    topvec = np.sqrt(np.einsum('ij,ij->i', diff, diff, dtype=np.int32))
+    norm1 = np.sqrt(np.dot(vec.astype(np.int32), vec))
+    if target_squared_norms is None:
+        target_squared_norms = squared_norms(target_array)
+    norm2 = np.sqrt(target_squared_norms)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        finvec = topvec / (norm1 + norm2)
+    finvec[np.isnan(finvec)] = nan_value
+
+    return finvec
+
+
+def paired_normalized_distance(_a, _b, nan_value=1.0):
+    """Compute normalized distances between corresponding rows of two arrays.
+
+    Computes || a_i - b_i || / ( ||a_i|| + ||b_i|| ) for every row i
+
+    Args:
+        _a (numpy.ndarray): N x m array
+        _b (numpy.ndarray): N x m array
+        nan_value (Optional[float]): value to replace 0.0/0.0 = nan with (default 1.0)
+
+    Returns:
+        an array of N normalized distances
+    """
+    a = np.asarray(_a, dtype=np.int16)
+    b = np.asarray(_b, dtype=np.int16)
+    diff = a - b
+    topvec = np.sqrt(np.einsum('ij,ij->i', diff, diff, dtype=np.int32))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        finvec = topvec / (np.sqrt(squared_norms(a)) + np.sqrt(squared_norms(b)))
+    finvec[np.isnan(finvec)] = nan_value
+
+    return finvec
+
+
+def normalized_distances(queries, targets, target_squared_norms=None, distance_cutoff=None,
+                         block_size=1024, workers=None, nan_value=1.0):
+    """Compute normalized distances between many queries and many points.
+
+    Many-to-many version of normalized_distance. With distance_cutoff, the full distance
+    matrix is never built: pairs are filtered block by block, as in exact_matches, and
+    only the pairs below the cutoff are returned.
+
+    Args:
+        queries (numpy.ndarray): M x m array of signatures
+        targets (numpy.ndarray): K x m array of signatures
+        target_squared_norms (Optional[numpy.ndarray]): squared norms of targets, as
+            returned by squared_norms. Computed if not given (default None)
+        distance_cutoff (Optional[float]): if given, only return pairs with a distance
+            below this (default None)
+        block_size (Optional[int]): number of queries and of targets per block (default 1024)
+        workers (Optional[int]): number of threads to process query blocks on (default None)
+        nan_value (Optional[float]): value to replace 0.0/0.0 = nan with (default 1.0)
+
+    Returns:
+        an M x K array of distances or, if distance_cutoff is given, a tuple of three arrays
+            (query rows, target rows, distances) as returned by exact_matches
+
+    """
+    if distance_cutoff is not None:
+        return exact_matches(queries, targets, distance_cutoff, target_squared_norms=target_squared_norms,
+                             block_size=block_size, workers=workers, nan_value=nan_value)
+
+    queries = np.atleast_2d(queries)
+    if target_squared_norms is None:
+        target_squared_norms = squared_norms(targets)
+
+    dists = np.empty((queries.shape[0], targets.shape[0]))
+    for query_start in range(0, queries.shape[0], block_size):
+        block = queries[query_start:query_start + block_size].astype(np.float32)
+        for target_start in range(0, targets.shape[0], block_size):
+            target_slice = slice(target_start, target_start + block_size)
+            dists[query_start:query_start + block.shape[0], target_slice] = _block_distances(
+                block, targets[target_slice].astype(np.float32), target_squared_norms[target_slice],
+                nan_value)
+
+    return dists
+
+
+def squared_norms(signatures):
+    """Computes squared norms of many signatures.
+
+    Args:
+        signatures (numpy.ndarray): M x m array of signatures
+
+    Returns:
+        an array of M integer squared norms
+
+    """
+    signatures = np.asarray(signatures, dtype=np.int16)
+    return np.einsum('ij,ij->i', signatures, signatures, dtype=np.int32)
+
+
+def exact_matches(queries, targets, distance_cutoff, target_squared_norms=None, block_size=1024,
+                  workers=None, nan_value=1.0):
+    """Finds all pairs of signatures closer than a cutoff, by brute force.
+
+    Computes normalized_distance between every query and every target, in blocks of
+    block_size x block_size so memory stays bounded. Squared distances use the expansion
+    ||a - b||**2 = ||a||**2 + ||b||**2 - 2 a.b, so each block is one matrix product.
+    Signature elements are small integers, so the float32 products are exact. Pairs are
+    compared with the cutoff before any square root or division is taken.
+
+    Args:
+        queries (numpy.ndarray): M x m array of query signatures (or a single signature)
+        targets (numpy.ndarray): K x m array of signatures to search
+        distance_cutoff (float): only return pairs with a distance below this
+        target_squared_norms (Optional[numpy.ndarray]): squared norms of targets, as
+            returned by squared_norms. Computed if not given (default None)
+        block_size (Optional[int]): number of queries and of targets per block (default 1024)
+        workers (Optional[int]): number of threads to process query blocks on. If None,
+            blocks are processed in this thread (default None)
+        nan_value (Optional[float]): distance to use for two featureless signatures
+            (default 1.0)
+
+    Returns:
+        a tuple of three arrays (query rows, target rows, distances), sorted by query row
+            and then by distance
+
+    """
+    queries = np.atleast_2d(queries)
+    if target_squared_norms is None:
+        target_squared_norms = squared_norms(targets)
+
+    def match_block(query_start):
+        block = queries[query_start:query_start + block_size].astype(np.float32)
+
+        matches = []
+        for target_start in range(0, targets.shape[0], block_size):
+            target_slice = slice(target_start, target_start + block_size)
+            query_rows, target_rows, dists = _block_distances(
+                block, targets[target_slice].astype(np.float32), target_squared_norms[target_slice],
+                nan_value, distance_cutoff=distance_cutoff)
+            matches.append((query_rows + query_start, target_rows + target_start, dists))
+
+        return matches
+
+    starts = range(0, queries.shape[0], block_size)
+    if workers is None or workers <= 1:
+        blocks = [match_block(start) for start in starts]
+    else:
+        pool = ThreadPool(processes=workers)
+        try:
+            blocks = pool.map(match_block, starts)
+        finally:
+            pool.close()
+            pool.join()
+
+    matches = [m for block in blocks for m in block]
+    if not matches:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+    query_rows, target_rows, dists = [np.concatenate(x) for x in zip(*matches)]
+    order = np.lexsort((dists, query_rows))
+
+    return query_rows[order], target_rows[order], dists[order]
+
+
+def _block_distances(queries, targets, target_squared_norms, nan_value, distance_cutoff=None):
+    # normalized distances between two float32 blocks of signatures, as a matrix or, with
+    # distance_cutoff, as (query rows, target rows, distances) of the pairs below it
+    query_squared_norms = np.einsum('ij,ij->i', queries, queries)
+    target_squared_norms = np.asarray(target_squared_norms, dtype=np.float32)
+
+    # exact in float32, since all terms are small integers
+    squared_dists = query_squared_norms[:, np.newaxis] + target_squared_norms[np.newaxis, :] \
+        - 2 * np.dot(queries, targets.T)
+
+    query_norms = np.sqrt(query_squared_norms.astype(np.float64))
+    target_norms = np.sqrt(target_squared_norms.astype(np.float64))
+
+    if distance_cutoff is None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dists = np.sqrt(squared_dists.astype(np.float64)) / \
+                (query_norms[:, np.newaxis] + target_norms[np.newaxis, :])
+        dists[np.isnan(dists)] = nan_value
+        return dists
+
+    # d < c  <=>  ||a - b||**2 < c**2 (||a|| + ||b||)**2, so no division is needed to filter
+    denominators = query_norms[:, np.newaxis] + target_norms[np.newaxis, :]
+    mask = squared_dists < distance_cutoff ** 2 * denominators ** 2
+    if nan_value < distance_cutoff:
+        mask |= denominators == 0
+
+    query_rows, target_rows = np.nonzero(mask)
+    denominators = denominators[query_rows, target_rows]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dists = np.sqrt(squared_dists[query_rows, target_rows].astype(np.float64)) / denominators
+    dists[np.isnan(dists)] = nan_value
+
+    # guard against rounding at the boundary of the squared comparison
+    keep = dists < distance_cutoff
+
+    return query_rows[keep], target_rows[keep], dists[keep]
+
+
+# Packed signatures store three signature elements (-2..2) per byte as base-5 digits,
+# so a 648 element signature takes 216 bytes.
+PACKED_ELEMENTS_PER_BYTE = 3
+
+# base-5 digits of every byte value; values above 124 never occur in packed signatures
+_PACKED_DIGITS = np.array([[(b // 5**i) % 5 for i in range(PACKED_ELEMENTS_PER_BYTE)]
+                           for b in range(256)], dtype=np.int16) - 2
+_PACKED_DIGITS[5**PACKED_ELEMENTS_PER_BYTE:] = 0
+
+# squared difference of the three elements packed in each pair of bytes (at most 3 * 4**2)
+_PACKED_SQUARED_DIFFERENCE = np.sum(
+    (_PACKED_DIGITS[:, np.newaxis, :] - _PACKED_DIGITS[np.newaxis, :, :])**2,
+    axis=2).astype(np.uint8)
+
+# squared norm of the three elements packed in each byte
+_PACKED_SQUARED_NORM = np.sum(_PACKED_DIGITS**2, axis=1).astype(np.uint8)
+
+
+def pack_signatures(signatures):
+    """Packs signatures three elements per byte.
+
+    Each element is shifted to 0..4 and used as a base-5 digit, first element least
+    significant. Signatures are padded with zeros to a multiple of three elements,
+    which changes neither distances nor norms.
+
+    Args:
+        signatures (numpy.ndarray): M x m array (or array of size m) of signature
+            elements in -2..2
+
+    Returns:
+        an M x ceil(m / 3) uint8 array (or an array of size ceil(m / 3))
+
+    Examples:
+        >>> pack_signatures(np.array([0, 1, 2, -2], dtype='int8'))
+        array([117,  60], dtype=uint8)
+
+    """
+    signatures = np.asarray(signatures, dtype=np.int16)
+    width = signatures.shape[-1]
+    padding = -width % PACKED_ELEMENTS_PER_BYTE
+
+    digits = np.pad(signatures + 2, [(0, 0)] * (signatures.ndim - 1) + [(0, padding)],
+                    mode='constant', constant_values=2)
+    digits = digits.reshape(digits.shape[:-1] + (-1, PACKED_ELEMENTS_PER_BYTE))
+
+    return np.dot(digits, 5**np.arange(PACKED_ELEMENTS_PER_BYTE)).astype(np.uint8)
+
+
+def unpack_signatures(packed, length):
+    """Unpacks signatures packed by pack_signatures.
+
+    Args:
+        packed (numpy.ndarray): M x b (or size b) uint8 array of packed signatures
+        length (int): number of elements in each signature
+
+    Returns:
+        an M x length (or size length) int8 array of signatures
+
+    """
+    packed = np.asarray(packed, dtype=np.uint8)
+    digits = _PACKED_DIGITS[packed]
+
+    return digits.reshape(packed.shape[:-1] + (-1,))[..., :length].astype('int8')
+
+
+def packed_squared_norms(packed):
+    """Computes squared norms of packed signatures.
+
+    Args:
+        packed (numpy.ndarray): M x b (or size b) uint8 array of packed signatures
+
+    Returns:
+        an array of M (or a single) integer squared norms
+
+    """
+    return np.sum(_PACKED_SQUARED_NORM[np.asarray(packed, dtype=np.uint8)], axis=-1, dtype=np.int32)
+
+
+def packed_normalized_distance(packed_targets, packed_vec, target_squared_norms=None,
+                               vec_squared_norm=None, nan_value=1.0):
+    """Compute normalized distance from a packed signature to many packed signatures.
+
+    Computes || vec - b || / ( ||vec|| + ||b||) for every b in packed_targets, as
+    normalized_distance does for unpacked signatures, with one table lookup per byte
+    instead of three subtractions and multiplications. With one packed_vec per target,
+    computes paired distances instead, as paired_normalized_distance does.
+
+    Args:
+        packed_targets (numpy.ndarray): K x b uint8 array of packed signatures
+        packed_vec (numpy.ndarray): uint8 array of size b, a packed signature, or K x b
+            array, one packed signature per target
+        target_squared_norms (Optional[numpy.ndarray]): squared norms of packed_targets,
+            as returned by packed_squared_norms. Computed if not given (default None)
+        vec_squared_norm (Optional[int or numpy.ndarray]): squared norm of packed_vec, or
+            of each of its rows. Computed if not given (default None)
+        nan_value (Optional[float]): value to replace 0.0/0.0 = nan with
+            (default 1.0, to take those featureless images out of contention)
+
+    Returns:
+        the normalized distances (array of K floats)
+
+    """
+    packed_targets = np.asarray(packed_targets, dtype=np.uint8)
+    packed_vec = np.asarray(packed_vec, dtype=np.uint8)
+
+    if target_squared_norms is None:
+        target_squared_norms = packed_squared_norms(packed_targets)
+    if vec_squared_norm is None:
+        vec_squared_norm = packed_squared_norms(packed_vec)
+
+    squared_diff = np.sum(_PACKED_SQUARED_DIFFERENCE[packed_targets, packed_vec], axis=1, dtype=np.int32)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        finvec = np.sqrt(squared_diff) / (np.sqrt(vec_squared_norm) + np.sqrt(target_squared_norms))
     finvec[np.isnan(finvec)] = nan_value
 
-    return finvec
\ No newline at end of file
+    return finvec
@@ -0,0 +1,138 @@
+from threading import Lock
+import numpy as np
+import fcntl
+import os
+
+
+class SignatureStore(object):
+    """Memory-mapped side store of signatures, keyed by document id
+
+    Signatures are rows of an int8 matrix in a flat file, which every process on a
+    node maps into memory, so reranking is a fancy index instead of parsing the
+    signature out of each search hit. A second, append-only file lists the document
+    id of every row. Appends from several processes are serialized with a file lock,
+    and each signature is written before its id, so readers never see an id whose
+    signature is missing.
+
+    """
+
+    def __init__(self, path, sig_length=648, grow_rows=65536):
+        """Open or create a store
+
+        Args:
+            path (string): path prefix of the store files (path.sig and path.ids)
+            sig_length (Optional[int]): length of each signature (default 648, for
+                ImageSignature defaults)
+            grow_rows (Optional[int]): number of rows to grow the signature file by when
+                it is full (default 65536)
+
+        Examples:
+            >>> store = SignatureStore('/dev/shm/images_0.1')
+            >>> ses = SignatureES(es, index='images_0.1', signature_store=store)
+
+        """
+        self.sig_length = sig_length
+        self.grow_rows = grow_rows
+
+        self.sig_path = path + '.sig'
+        self.ids_path = path + '.ids'
+        for p in [self.sig_path, self.ids_path]:
+            if not os.path.exists(p):
+                open(p, 'ab').close()
+
+        self._rows = {}
+        self._ids_offset = 0
+        self._matrix = np.zeros((0, sig_length), dtype='int8')
+        self._lock = Lock()
+
+        self.refresh()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._rows
+
+    def refresh(self):
+        """Pick up rows appended by other processes"""
+        with self._lock:
+            self._refresh()
+
+    def get(self, doc_ids):
+        """Look up signatures by document id
+
+        Args:
+            doc_ids (List[string]): document ids
+
+        Returns:
+            a tuple of an M x sig_length int8 array of signatures, in the order of doc_ids,
+                and a boolean array of size M telling which were found. Rows of missing
+                signatures are zero
+
+        """
+        with self._lock:
+            rows = np.array([self._rows.get(doc_id, -1) for doc_id in doc_ids], dtype=np.int64)
+            if np.any(rows < 0):
+                self._refresh()
+                rows = np.array([self._rows.get(doc_id, -1) for doc_id in doc_ids], dtype=np.int64)
+            matrix = self._matrix
+
+        found = rows >= 0
+        signatures = np.zeros((rows.shape[0], self.sig_length), dtype='int8')
+        signatures[found] = matrix[rows[found]]
+
+        return signatures, found
+
+    def add(self, doc_id, signature):
+        """Store the signature of a document, if not already stored
+
+        Args:
+            doc_id (string): document id
+            signature (numpy.ndarray or List[int]): the image signature
+
+        """
+        signature = np.asarray(signature, dtype='int8')
+        if signature.shape != (self.sig_length,):
+            raise ValueError('Signature should have length %d (got %r)' % (self.sig_length, signature.shape))
+
+        with self._lock:
+            with open(self.ids_path, 'ab') as ids_file:
+                fcntl.flock(ids_file, fcntl.LOCK_EX)
+                try:
+                    self._refresh()
+                    if doc_id in self._rows:
+                        return
+
+                    # rows are numbered by position in the id file
+                    row = len(self._rows)
+
+                    with open(self.sig_path, 'r+b') as sig_file:
+                        sig_file.seek(0, os.SEEK_END)
+                        if sig_file.tell() < (row + 1) * self.sig_length:
+                            sig_file.truncate((row + self.grow_rows) * self.sig_length)
+                        sig_file.seek(row * self.sig_length)
+                        sig_file.write(signature.tobytes())
+
+                    ids_file.write(doc_id.encode('utf-8') + b'\n')
+                    ids_file.flush()
+                finally:
+                    fcntl.flock(ids_file, fcntl.LOCK_UN)
+
+            self._refresh()
+
+    def _refresh(self):
+        # read ids appended since the last refresh; call with lock held
+        with open(self.ids_path, 'rb') as ids_file:
+            ids_file.seek(self._ids_offset)
+            appended = ids_file.read()
+
+        # ignore a partially written last line
+        complete = appended.rfind(b'\n') + 1
+        for doc_id in appended[:complete].splitlines():
+            self._rows[doc_id.decode('utf-8')] = len(self._rows)
+        self._ids_offset += complete
+
+        # remap when the signature file has grown past the mapped rows
+        if len(self._rows) > self._matrix.shape[0]:
+            n_rows = os.path.getsize(self.sig_path) // self.sig_length
+            self._matrix = np.memmap(self.sig_path, dtype='int8', mode='r', shape=(n_rows, self.sig_length))